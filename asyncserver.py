@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Server handles for use with asyncio
+
+import asyncio
+import weakref
+import functools
+import threading
+import concurrent.futures
+
+if __package__:
+    from .query import apply_update
+else:
+    from query import apply_update
+
+
+class AsyncJSONServer(object):
+    """ Abstract superclass for NoSQL-style servers that are used from asyncio
+    code. Mirrors `JSONServer`, with all methods being coroutines and `find()`
+    being an async iterator.
+    """
+    
+    id_generator = None
+    """ The `idgen.IdGenerator` making the ids the server keeps best, see
+    `JSONServer.id_generator`. """
+    
+    async def load_document(self, bucket, doc_id):
+        """ Load an individual document.
+        
+        :param str bucket: The bucket/collection name
+        :param str doc_id: The document id
+        :returns: A JSON string representing the document
+        """
+        return None
+    
+    async def load_documents(self, bucket, doc_ids):
+        """ Load several documents at once.
+        
+        :param str bucket: The bucket/collection name
+        :param list doc_ids: The document ids
+        :returns: A list with the document for each id, in the order of
+            `doc_ids`, with None for documents that were not found
+        """
+        return [await self.load_document(bucket, doc_id) for doc_id in doc_ids]
+    
+    async def add_documents(self, bucket, documents):
+        """ Store one or more documents in the database.
+        
+        :param str bucket: The bucket/collection name
+        :param documents: Can be a single document/dictionary or a list thereof
+        :returns: A list of document ids for all created documents
+        """
+        return None
+    
+    async def store_document(self, bucket, document):
+        """ Store a complete document.
+        
+        :param str bucket: The bucket/collection name
+        :param document: A complete JSON document
+        :returns: The document id on success
+        """
+        return None
+    
+    async def store_documents(self, bucket, documents):
+        """ Store several complete documents, replacing existing ones with
+        the same id.
+        
+        :param str bucket: The bucket/collection name
+        :param list documents: Complete JSON documents
+        :returns: A list with the document id of each document
+        """
+        return [await self.store_document(bucket, document) for document in documents]
+    
+    async def update_document(self, bucket, doc_id, values=None, unset=None):
+        """ Apply a partial update to a document. The default implementation
+        loads the document, applies the changes and stores it again.
+        
+        :param str bucket: The bucket/collection name
+        :param str doc_id: The document id
+        :param dict values: New values by dotted key path, like ``$set``
+        :param list unset: Dotted key paths to remove, like ``$unset``
+        :returns: False if the document was not found
+        """
+        doc = await self.load_document(bucket, doc_id)
+        if doc is None:
+            return False
+        await self.store_document(bucket, apply_update(doc, values, unset))
+        return True
+    
+    async def remove_document(self, bucket, doc_id):
+        """ Deletes a given document.
+        
+        :param str bucket: The bucket/collection name
+        :param str doc_id: The document id of the document to remove.
+        """
+        pass
+    
+    async def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        """ Find documents.
+        
+        :param str bucket: The bucket/collection name
+        :param dict dictionary: The NoSQL query dictionary
+        :param list fields: The key paths to return, None for all
+        :returns: An async iterator over matching results
+        """
+        return
+        yield
+    
+    async def count(self, bucket, dictionary):
+        """ Count matching documents.
+        
+        :param str bucket: The bucket/collection name
+        :param dict dictionary: The NoSQL query dictionary
+        :returns: The number of matching documents
+        """
+        return None
+    
+    def cached_instance(self, cls, bucket, doc_id):
+        """ Servers keeping an identity map return the instance of `cls` that
+        was already loaded for the given document id, see
+        `JSONServer.cached_instance()`. Not a coroutine, identity maps live in
+        memory.
+        """
+        return None
+    
+    def cache_instance(self, instance, bucket):
+        """ Servers keeping an identity map remember the given, loaded
+        JSONDocument instance, see `JSONServer.cache_instance()`.
+        """
+        pass
+
+
+class ThreadedAsyncServer(AsyncJSONServer):
+    """ Makes any synchronous `JSONServer` usable from asyncio code by running
+    its calls on a bounded thread pool, so the event loop never blocks and at
+    most `max_workers` calls are in flight at the same time.
+    """
+    
+    def __init__(self, server, max_workers=16, find_batch_size=100):
+        """
+        :param JSONServer server: The synchronous server to forward to
+        :param int max_workers: The number of calls that can run concurrently
+        :param int find_batch_size: The number of results pulled from the
+            server per thread hop while iterating `find()` results
+        """
+        super().__init__()
+        self.server = server
+        self.id_generator = getattr(server, 'id_generator', None)
+        self.find_batch_size = find_batch_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jsonserver')
+    
+    async def run(self, func, *args):
+        """ Runs the callable on the thread pool and returns its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+    
+    def close(self):
+        """ Shuts down the thread pool.
+        """
+        self.executor.shutdown(wait=True)
+    
+    
+    # MARK: - Overrides
+    
+    async def load_document(self, bucket, doc_id):
+        return await self.run(self.server.load_document, bucket, doc_id)
+    
+    async def load_documents(self, bucket, doc_ids):
+        return await self.run(self.server.load_documents, bucket, doc_ids)
+    
+    async def add_documents(self, bucket, documents):
+        return await self.run(self.server.add_documents, bucket, documents)
+    
+    async def store_document(self, bucket, document):
+        return await self.run(self.server.store_document, bucket, document)
+    
+    async def store_documents(self, bucket, documents):
+        return await self.run(self.server.store_documents, bucket, documents)
+    
+    async def update_document(self, bucket, doc_id, values=None, unset=None):
+        return await self.run(self.server.update_document, bucket, doc_id, values, unset)
+    
+    async def remove_document(self, bucket, doc_id):
+        return await self.run(self.server.remove_document, bucket, doc_id)
+    
+    async def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        """ Runs the query on the thread pool and then pulls results in
+        batches, since iterating database cursors may block as well.
+        """
+        if fields is None:
+            found = await self.run(self.server.find, bucket, dictionary, skip, limit, sort, descending)
+        else:
+            found = await self.run(self.server.find, bucket, dictionary, skip, limit, sort, descending, fields)
+        if found is None:
+            return
+        iterator = iter(found)
+        while True:
+            batch = await self.run(_next_batch, iterator, self.find_batch_size)
+            for doc in batch:
+                yield doc
+            if len(batch) < self.find_batch_size:
+                break
+    
+    async def count(self, bucket, dictionary):
+        return await self.run(self.server.count, bucket, dictionary)
+    
+    def cached_instance(self, cls, bucket, doc_id):
+        return self.server.cached_instance(cls, bucket, doc_id)
+    
+    def cache_instance(self, instance, bucket):
+        self.server.cache_instance(instance, bucket)
+
+
+def _next_batch(iterator, size):
+    batch = []
+    for doc in iterator:
+        batch.append(doc)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+_adapters = weakref.WeakKeyDictionary()
+_adapters_lock = threading.Lock()
+
+def adapter_for(server):
+    """ Returns the shared `ThreadedAsyncServer` for the given synchronous
+    server, creating it if needed. The adapter only holds a proxy to the
+    server, so both go away once the server is no longer used.
+    """
+    with _adapters_lock:
+        adapter = _adapters.get(server)
+        if adapter is None:
+            adapter = ThreadedAsyncServer(weakref.proxy(server))
+            weakref.finalize(server, adapter.executor.shutdown, wait=False)
+            _adapters[server] = adapter
+        return adapter
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Benchmarks of the document model and of server round trips
+#
+#   Run with:
+#       python3 benchmark.py --output results.json
+#       python3 benchmark.py --baseline benchmark_baseline.json --threshold 0.15
+
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from .query import updateDictionaryByKeyPath
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    from query import updateDictionaryByKeyPath
+
+
+benchmarks = []
+
+def benchmark(name):
+    """ Registers a benchmark. The decorated function gets the scale factor
+    and returns a tuple of a callable to time and the number of operations
+    one call of it performs.
+    """
+    def register(func):
+        benchmarks.append((name, func))
+        return func
+    return register
+
+
+class Item(JSONDocument):
+    pass
+
+
+def flat_json(i):
+    return {'name': 'Item {}'.format(i), 'price': i * 1.25, 'active': 0 == i % 2, 'count': i, 'tags': ['a', 'b', 'c']}
+
+def nested_document(depth, width, cls=Item):
+    doc = cls(None, json=flat_json(depth))
+    if depth > 0:
+        doc.children = [nested_document(depth - 1, width, cls) for i in range(width)]
+        doc.by_name = {'first': cls.from_embedded(flat_json(depth))}
+    return doc
+
+
+# MARK: - Model
+
+@benchmark('init_with_id')
+def bench_init_with_id(scale):
+    n = 1000 * scale
+    def run():
+        for i in range(n):
+            Item('id', json={'a': 1, 'b': 'two', 'c': [3]})
+    return run, n
+
+@benchmark('init_without_id')
+def bench_init_without_id(scale):
+    n = 1000 * scale
+    def run():
+        for i in range(n):
+            Item(None, json={'a': 1, 'b': 'two', 'c': [3]})
+    return run, n
+
+@benchmark('update_with')
+def bench_update_with(scale):
+    n = 1000 * scale
+    doc = Item('id')
+    values = flat_json(1)
+    def run():
+        for i in range(n):
+            doc.update_with(values)
+    return run, n
+
+@benchmark('set_attribute')
+def bench_set_attribute(scale):
+    n = 10000 * scale
+    doc = Item('id', json=flat_json(1))
+    def run():
+        for i in range(n):
+            doc.count = i
+    return run, n
+
+@benchmark('set_attribute_tracked')
+def bench_set_attribute_tracked(scale):
+    n = 10000 * scale
+    doc = Item('id', json=flat_json(1))
+    doc.mark_clean()
+    def run():
+        for i in range(n):
+            doc.count = i
+    return run, n
+
+@benchmark('as_json_flat')
+def bench_as_json_flat(scale):
+    docs = [Item(None, json=flat_json(i)) for i in range(1000 * scale)]
+    def run():
+        for doc in docs:
+            doc.as_json()
+    return run, len(docs)
+
+@benchmark('for_api_flat')
+def bench_for_api_flat(scale):
+    docs = [Item(None, json=flat_json(i)) for i in range(1000 * scale)]
+    def run():
+        for doc in docs:
+            doc.for_api()
+    return run, len(docs)
+
+@benchmark('as_json_nested')
+def bench_as_json_nested(scale):
+    docs = [nested_document(3, 3) for i in range(10 * scale)]
+    def run():
+        for doc in docs:
+            doc.as_json()
+    return run, len(docs)
+
+@benchmark('for_api_nested')
+def bench_for_api_nested(scale):
+    docs = [nested_document(3, 3) for i in range(10 * scale)]
+    def run():
+        for doc in docs:
+            doc.for_api()
+    return run, len(docs)
+
+@benchmark('for_api_bytes_nested')
+def bench_for_api_bytes_nested(scale):
+    docs = [nested_document(3, 3) for i in range(10 * scale)]
+    def run():
+        for doc in docs:
+            doc.for_api_bytes()
+    return run, len(docs)
+
+@benchmark('for_api_dumps_nested')
+def bench_for_api_dumps_nested(scale):
+    """ `for_api()` and encoding, for comparison with `for_api_bytes_nested`.
+    """
+    docs = [nested_document(3, 3) for i in range(10 * scale)]
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    def run():
+        for doc in docs:
+            encoder.encode(doc.for_api()).encode('utf-8')
+    return run, len(docs)
+
+@benchmark('for_api_nested_cached')
+def bench_for_api_nested_cached(scale):
+    class CachedItem(Item):
+        render_cache = True
+    docs = [nested_document(3, 3, CachedItem) for i in range(10 * scale)]
+    def run():
+        for doc in docs:
+            doc.for_api()
+    return run, len(docs)
+
+@benchmark('load_embedded_untouched')
+def bench_load_embedded(scale):
+    class Line(JSONDocument):
+        pass
+    class Order(Item):
+        embedded = {'lines': [Line]}
+    raw = [dict(flat_json(i), lines=[flat_json(j) for j in range(50)]) for i in range(100 * scale)]
+    def run():
+        for js in raw:
+            Order(None, json=js).as_json()
+    return run, len(raw)
+
+@benchmark('update_keypath')
+def bench_update_keypath(scale):
+    n = 1000 * scale
+    def run():
+        for i in range(n):
+            updateDictionaryByKeyPath({'a': {'b': {}}}, 'a.b.c.d', i)
+    return run, n
+
+
+# MARK: - Server
+
+@benchmark('find_on_hydration')
+def bench_find_on(scale):
+    server = MemoryServer()
+    server.add_documents('items', [flat_json(i) for i in range(5000 * scale)])
+    def run():
+        Item.find_on({}, server, 'items', limit=None)
+    return run, 5000 * scale
+
+@benchmark('find_on_adopt')
+def bench_find_on_adopt(scale):
+    class AdoptedItem(Item):
+        adopt_documents = True
+    server = MemoryServer()
+    server.add_documents('items', [flat_json(i) for i in range(5000 * scale)])
+    def run():
+        AdoptedItem.find_on({}, server, 'items', limit=None)
+    return run, 5000 * scale
+
+@benchmark('store_load_roundtrip')
+def bench_roundtrip(scale):
+    server = MemoryServer()
+    raw = [flat_json(i) for i in range(500 * scale)]
+    def run():
+        for i, js in enumerate(raw):
+            doc = Item(str(i), json=js)
+            doc.store_to(server, 'items')
+            doc.load_from(server, 'items')
+    return run, len(raw)
+
+@benchmark('store_changes_roundtrip')
+def bench_changes_roundtrip(scale):
+    server = MemoryServer()
+    docs = [Item(str(i), json=flat_json(i)) for i in range(500 * scale)]
+    for doc in docs:
+        doc.store_to(server, 'items')
+    def run():
+        for doc in docs:
+            doc.count += 1
+            doc.store_to(server, 'items')
+            doc.load_from(server, 'items')
+    return run, len(docs)
+
+
+# MARK: - Running
+
+def measure(func, scale, repeat):
+    """ Runs the benchmark `repeat` times and returns the best time per
+    operation, which is the least disturbed by other processes.
+    """
+    run, ops = func(scale)
+    run()
+    best = None
+    gc_enabled = gc.isenabled()
+    for i in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'seconds_per_op': best / ops,
+        'ops_per_second': ops / best if best > 0 else None,
+        'ops': ops,
+        'repeat': repeat,
+    }
+
+def run_benchmarks(names=None, scale=1, repeat=5, out=None):
+    """ Runs the registered benchmarks, or those whose names contain one of
+    `names`, and returns the results dictionary.
+    """
+    results = {}
+    for name, func in benchmarks:
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = measure(func, scale, repeat)
+        if out is not None:
+            out.write('{:<24} {:>12.3f} µs/op {:>14,.0f} ops/s\n'.format(name, 1e6 * results[name]['seconds_per_op'], results[name]['ops_per_second'] or 0))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'scale': scale,
+        'results': results,
+    }
+
+def compare(results, baseline, threshold):
+    """ Compares results to a baseline.
+    
+    :param float threshold: The fraction by which a benchmark may be slower
+        than its baseline before it counts as a regression
+    :returns: A list of ``(name, ratio)`` tuples for regressed benchmarks,
+        ratio being the current over the baseline time
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if base is None or not base.get('seconds_per_op'):
+            continue
+        ratio = result['seconds_per_op'] / base['seconds_per_op']
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark JSONDocument and server round trips')
+    parser.add_argument('names', nargs='*', help='only run benchmarks whose names contain one of these')
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    parser.add_argument('-b', '--baseline', help='compare to results previously written with --output')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1, help='allowed slowdown relative to the baseline, default 0.1')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed runs per benchmark, default 5')
+    parser.add_argument('-s', '--scale', type=int, default=1, help='multiplies the amount of work per run, default 1')
+    parser.add_argument('-l', '--list', action='store_true', help='list benchmarks and exit')
+    args = parser.parse_args(argv)
+    
+    if args.list:
+        for name, func in benchmarks:
+            print(name)
+        return 0
+    
+    results = run_benchmarks(args.names, args.scale, args.repeat, sys.stdout)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+    
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as handle:
+            baseline = json.load(handle)
+        if baseline.get('scale') != args.scale:
+            print('Baseline was run with scale {}, comparing anyway'.format(baseline.get('scale')))
+        regressions = compare(results, baseline, args.threshold)
+        for name, ratio in regressions:
+            print('REGRESSION {}: {:.1f}% slower than baseline'.format(name, 100 * (ratio - 1)))
+        if len(regressions) > 0:
+            return 1
+        print('No regressions beyond {:.0f}%'.format(100 * args.threshold))
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Inserting large numbers of documents in parallel chunks
+
+import itertools
+import collections
+import concurrent.futures
+
+if __package__:
+    from .jsonserver import JSONServer
+else:
+    from jsonserver import JSONServer
+
+
+class ChunkReport(object):
+    """ The outcome of inserting one chunk of documents.
+    """
+    
+    def __init__(self, index, start, count):
+        self.index = index
+        """ The position of the chunk, counting from 0. """
+        self.start = start
+        """ The position of the chunk's first document in the input. """
+        self.count = count
+        """ The number of documents in the chunk. """
+        self.doc_ids = None
+        """ The ids of the chunk's documents if it was inserted. """
+        self.error = None
+        """ The exception raised while inserting the chunk, if any. """
+    
+    @property
+    def ok(self):
+        return self.error is None
+    
+    def __repr__(self):
+        if self.ok:
+            return '<ChunkReport {} of {} documents, ok>'.format(self.index, self.count)
+        return '<ChunkReport {} of {} documents, failed: {}>'.format(self.index, self.count, self.error)
+
+
+def bulk_insert(server, bucket, documents, chunk_size=1000, max_workers=4, on_chunk=None):
+    """ Inserts documents in chunks, writing several chunks at once.
+    
+    Documents are read from `documents` lazily and at most two chunks per
+    worker are held in memory, so generators of any length can be inserted.
+    Every chunk goes to the server's `add_documents()` in one call. Once a
+    chunk has been inserted, the assigned ids are written back, see
+    `assign_ids()`.
+    
+    A failed chunk does not stop the others; look for reports that aren't
+    `ok` and retry their documents, found at ``start`` to
+    ``start + count`` in the input.
+    
+    :param JSONServer server: The server to insert to
+    :param str bucket: The bucket/collection name
+    :param documents: An iterable of JSONDocument instances or dictionaries
+    :param int chunk_size: The number of documents per server call
+    :param int max_workers: The number of chunks written at once
+    :param on_chunk: Called with each ChunkReport in input order, as soon as
+        it and all chunks before it are done
+    :returns: A list of ChunkReport, in input order
+    """
+    if not isinstance(server, JSONServer):
+        raise Exception('Need a JSONServer instance but got {}'.format(server))
+    if chunk_size < 1 or max_workers < 1:
+        raise Exception('Need a positive chunk size and number of workers, got {} and {}'.format(chunk_size, max_workers))
+    
+    reports = []
+    in_flight = collections.deque()
+    
+    def finish():
+        report, chunk, future = in_flight.popleft()
+        try:
+            report.doc_ids = future.result()
+            assign_ids(chunk, report.doc_ids)
+        except Exception as e:
+            report.error = e
+        reports.append(report)
+        if on_chunk is not None:
+            on_chunk(report)
+    
+    iterator = iter(documents)
+    start = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bulk-insert') as executor:
+        for index in itertools.count():
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if 0 == len(chunk):
+                break
+            if len(in_flight) >= 2 * max_workers:
+                finish()
+            report = ChunkReport(index, start, len(chunk))
+            payload = [doc if isinstance(doc, dict) else doc.as_json() for doc in chunk]
+            in_flight.append((report, chunk, executor.submit(server.add_documents, bucket, payload)))
+            start += len(chunk)
+        while len(in_flight) > 0:
+            finish()
+    return reports
+
+def assign_ids(documents, doc_ids):
+    """ Writes the ids a server assigned back onto the inserted documents:
+    instances get theirs via `did_store()`, dictionaries without `_id` get
+    the key added.
+    """
+    if doc_ids is None:
+        return
+    if len(doc_ids) != len(documents):
+        raise Exception('The server returned {} ids for {} documents'.format(len(doc_ids), len(documents)))
+    for doc, doc_id in zip(documents, doc_ids):
+        if isinstance(doc, dict):
+            if doc.get('_id') is None:
+                doc['_id'] = doc_id
+        else:
+            doc.did_store(doc_id)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest bulkinsert_test.py
+
+import unittest
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from .bulkinsert import bulk_insert
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    from bulkinsert import bulk_insert
+
+
+class Record(JSONDocument):
+    pass
+
+
+class TestBulkInsert(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = MemoryServer()
+    
+    def test_chunks(self):
+        """ Test inserting a generator in parallel chunks. """
+        def records():
+            for i in range(250):
+                yield Record(None, json={'n': i}) if 0 == i % 2 else {'n': i}
+        docs = []
+        def generate():
+            for doc in records():
+                docs.append(doc)
+                yield doc
+        seen = []
+        reports = bulk_insert(self.server, 'b', generate(), chunk_size=40, max_workers=3, on_chunk=lambda r: seen.append(r.index))
+        self.assertEqual(list(range(7)), [r.index for r in reports])
+        self.assertEqual(list(range(7)), seen, 'Must report chunks in input order')
+        self.assertEqual([40] * 6 + [10], [r.count for r in reports])
+        self.assertTrue(all(r.ok for r in reports))
+        self.assertEqual(250, self.server.count('b', {}))
+        
+        ids = [doc.id if isinstance(doc, Record) else doc['_id'] for doc in docs]
+        self.assertEqual(ids, [doc_id for r in reports for doc_id in r.doc_ids])
+        self.assertEqual(ids[123], self.server.find('b', {'n': 123})[0]['_id'])
+        docs[0].n = -1
+        docs[0].store_to(self.server, 'b')
+        self.assertEqual(-1, self.server.load_document('b', docs[0].id)['n'], 'Must store inserted instances as updates')
+    
+    def test_failures(self):
+        """ Test that failed chunks are reported and don't stop the others. """
+        self.server.store_document('b', {'_id': '5'})
+        reports = Record.bulk_insert_to(({'_id': str(i)} for i in range(20)), self.server, 'b', chunk_size=4)
+        self.assertEqual([True, False, True, True, True], [r.ok for r in reports])
+        self.assertEqual(4, reports[1].start)
+        self.assertIsNone(reports[1].doc_ids)
+        self.assertEqual(17, self.server.count('b', {}))
+    
+    def test_insert_to(self):
+        """ Test that a single insert writes ids back. """
+        record = Record(None, json={'n': 1})
+        doc_ids = Record.insert_to([record, {'n': 2}], self.server, 'b')
+        self.assertEqual(record.id, doc_ids[0])
+        self.assertEqual(1, self.server.load_document('b', record.id)['n'])
+        self.assertEqual([doc_ids[1]], Record.insert_to({'_id': doc_ids[1]}, MemoryServer(), 'b'))
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   A read-through caching wrapper around any JSONServer
+
+import time
+import threading
+import itertools
+import contextlib
+import collections
+
+if __package__:
+    from .jsonserver import JSONServer
+    from .query import copy_json
+else:
+    from jsonserver import JSONServer
+    from query import copy_json
+
+
+class CachingServer(JSONServer):
+    """ Wraps another server and serves `load_document()` from a bounded LRU
+    cache, with an optional time to live for entries.
+    
+    Entries are invalidated when documents are stored or removed through this
+    server and filled from loads and the results of `find()`, except for
+    documents written through this server while they were being read.
+    Documents are copied in and out of the cache since `JSONDocument` takes
+    ownership of the dictionaries it's handed.
+    
+    Within `identity_scope()`, loading the same document of the same class
+    from the same bucket reuses one hydrated instance, see
+    `JSONDocument.get()`.
+    """
+    
+    def __init__(self, server, max_size=10000, ttl=None):
+        """
+        :param JSONServer server: The server to cache
+        :param int max_size: The maximum number of documents to cache
+        :param float ttl: Seconds after which cached documents expire, None
+            to keep them until evicted
+        """
+        super().__init__()
+        if not isinstance(server, JSONServer):
+            raise Exception('Need a JSONServer instance but got {}'.format(server))
+        self.server = server
+        self.id_generator = server.id_generator
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.written = collections.OrderedDict()
+        self.forgotten = 0
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._local = threading.local()
+    
+    def stats(self):
+        """ Returns a dictionary with the cache's hit, miss, eviction and
+        expiration counts and its current size.
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self.cache),
+            }
+    
+    def clear(self):
+        """ Empties the cache, leaving the counters alone.
+        """
+        with self.lock:
+            self.cache.clear()
+    
+    def invalidate(self, bucket, doc_id):
+        """ Drops the given document from the cache.
+        """
+        key = self._key(bucket, doc_id)
+        with self.lock:
+            self.cache.pop(key, None)
+            self.writes += 1
+            self.written[key] = self.writes
+            self.written.move_to_end(key)
+            if len(self.written) > self.max_size:
+                self.forgotten = self.written.popitem(last=False)[1]
+            entry = self.loading.get(key)
+            if entry is not None:
+                entry[1] += 1
+    
+    
+    # MARK: - Cache
+    
+    def _key(self, bucket, doc_id):
+        return (bucket or None, str(doc_id))
+    
+    def _get(self, bucket, doc_id):
+        key = self._key(bucket, doc_id)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                expires, doc = entry
+                if expires is not None and expires < time.monotonic():
+                    del self.cache[key]
+                    self.expirations += 1
+                else:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return copy_json(doc)
+            self.misses += 1
+        return None
+    
+    def _put(self, bucket, doc, writes=None):
+        """ Caches the document, unless `writes` is given and the document
+        was written through this server since `self.writes` was at that count.
+        `self.written` has the write count of each document's last write, for
+        as many documents as the cache holds; older writes only leave their
+        count in `self.forgotten`, when in doubt nothing is cached.
+        """
+        if doc is None or doc.get('_id') is None:
+            return
+        key = self._key(bucket, doc['_id'])
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        doc = copy_json(doc)
+        with self.lock:
+            if writes is None or (writes >= self.forgotten and self.written.get(key, 0) <= writes):
+                self._insert(key, expires, doc)
+    
+    def _insert(self, key, expires, doc):
+        """ Adds an entry and evicts the oldest ones; the lock must be held.
+        """
+        self.cache[key] = (expires, doc)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+    
+    def _put_found(self, bucket, found, writes):
+        for doc in found:
+            self._put(bucket, doc, writes)
+            yield doc
+    
+    def _loading(self, bucket, doc_id):
+        """ Registers a load from the wrapped server and returns the key and
+        the document's generation, to hand to `_loaded()` when done.
+        """
+        key = self._key(bucket, doc_id)
+        with self.lock:
+            entry = self.loading.get(key)
+            if entry is None:
+                entry = self.loading[key] = [0, 0]
+            entry[0] += 1
+            return key, entry[1]
+    
+    def _loaded(self, key, generation, doc):
+        """ Ends a load registered with `_loading()` and caches the document,
+        unless it was written to while it was being loaded.
+        """
+        if doc is not None:
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            doc = copy_json(doc)
+        with self.lock:
+            entry = self.loading[key]
+            entry[0] -= 1
+            if 0 == entry[0]:
+                del self.loading[key]
+            if doc is not None and entry[1] == generation:
+                self._insert(key, expires, doc)
+    
+    
+    # MARK: - Identity Map
+    
+    @contextlib.contextmanager
+    def identity_scope(self):
+        """ Context manager within which, on the current thread, documents of
+        the same class loaded from the same bucket with the same id are one
+        and the same instance.
+        """
+        previous = getattr(self._local, 'identities', None)
+        self._local.identities = {}
+        try:
+            yield self._local.identities
+        finally:
+            self._local.identities = previous
+    
+    def cached_instance(self, cls, bucket, doc_id):
+        identities = getattr(self._local, 'identities', None)
+        if identities is None:
+            return None
+        return identities.get((cls, bucket or None, str(doc_id)))
+    
+    def cache_instance(self, instance, bucket):
+        identities = getattr(self._local, 'identities', None)
+        if identities is not None:
+            identities.setdefault((instance.__class__, bucket or None, str(instance.id)), instance)
+    
+    
+    # MARK: - Overrides
+    
+    def load_document(self, bucket, doc_id):
+        doc = self._get(bucket, doc_id)
+        if doc is None:
+            key, generation = self._loading(bucket, doc_id)
+            try:
+                doc = self.server.load_document(bucket, doc_id)
+            finally:
+                self._loaded(key, generation, doc)
+        return doc
+    
+    def load_documents(self, bucket, doc_ids):
+        docs = [self._get(bucket, doc_id) for doc_id in doc_ids]
+        missing = [doc_id for doc_id, doc in zip(doc_ids, docs) if doc is None]
+        if len(missing) > 0:
+            loads = [self._loading(bucket, doc_id) for doc_id in missing]
+            found = []
+            try:
+                found = self.server.load_documents(bucket, missing)
+            finally:
+                for (key, generation), doc in itertools.zip_longest(loads, found):
+                    self._loaded(key, generation, doc)
+            loaded = dict(zip(missing, found))
+            docs = [loaded.get(doc_id) if doc is None else doc for doc_id, doc in zip(doc_ids, docs)]
+        return docs
+    
+    def add_documents(self, bucket, documents):
+        doc_ids = self.server.add_documents(bucket, documents)
+        for doc_id in doc_ids or []:
+            self.invalidate(bucket, doc_id)
+        return doc_ids
+    
+    def store_document(self, bucket, document):
+        if document.get('_id') is not None:
+            self.invalidate(bucket, document['_id'])
+        doc_id = self.server.store_document(bucket, document)
+        self.invalidate(bucket, doc_id)
+        return doc_id
+    
+    def store_documents(self, bucket, documents):
+        for document in documents:
+            if document.get('_id') is not None:
+                self.invalidate(bucket, document['_id'])
+        doc_ids = self.server.store_documents(bucket, documents)
+        for doc_id in doc_ids or []:
+            self.invalidate(bucket, doc_id)
+        return doc_ids
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        self.invalidate(bucket, doc_id)
+        found = self.server.update_document(bucket, doc_id, values, unset)
+        self.invalidate(bucket, doc_id)
+        return found
+    
+    def remove_document(self, bucket, doc_id):
+        self.invalidate(bucket, doc_id)
+        self.server.remove_document(bucket, doc_id)
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        """ Caches the documents found, unless only some of their fields
+        were asked for. """
+        if fields is not None:
+            return self.server.find(bucket, dictionary, skip, limit, sort, descending, fields)
+        writes = self.writes
+        found = self.server.find(bucket, dictionary, skip, limit, sort, descending)
+        if found is None:
+            return None
+        if isinstance(found, list):
+            return list(self._put_found(bucket, found, writes))
+        return self._put_found(bucket, found, writes)
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        if fields is not None:
+            yield from self.server.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit, fields)
+            return
+        writes = self.writes
+        for batch in self.server.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit):
+            yield list(self._put_found(bucket, batch, writes))
+    
+    def count(self, bucket, dictionary):
+        return self.server.count(bucket, dictionary)
+    
+    def changes(self, since=0, bucket=None, limit=None):
+        return self.server.changes(since, bucket, limit)
+    
+    def last_sequence(self):
+        return self.server.last_sequence()
+    
+    def native_id(self, doc_id):
+        return self.server.native_id(doc_id)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Change feeds of JSONServer writes and incremental replication
+
+import logging
+import threading
+import collections
+
+if __package__:
+    from .jsonserver import JSONServer
+    from . import query
+else:
+    from jsonserver import JSONServer
+    import query
+
+
+ChangeEvent = collections.namedtuple('ChangeEvent', ['sequence', 'bucket', 'op', 'doc_id', 'document'])
+""" One write in a change feed. `op` is "store" with the whole document,
+"update" with a dictionary of the `values` set and the key paths `unset`,
+or "remove" with None. """
+
+
+class FeedTruncated(Exception):
+    """ Raised when asking for changes older than a feed still keeps. """
+    pass
+
+
+class ChangeFeedServer(JSONServer):
+    """ Wraps another server and keeps an ordered feed of the writes made
+    through it, numbered by an increasing sequence number, see `changes()`.
+    
+    Inserts and stores are recorded with a copy of the whole document,
+    updates with their changes and removals with the document id, which
+    keeps the type the wrapped server returned. Writes
+    are serialized so the feed has them in the order the server applied
+    them; writes made to the wrapped server by others are not seen.
+    
+    The feed keeps the latest `max_events` events in memory. Consumers that
+    fall further behind get a `FeedTruncated` and have to start over, which
+    `BucketSync` does by copying the whole bucket.
+    """
+    
+    def __init__(self, server, max_events=100000):
+        """
+        :param JSONServer server: The server to record writes to
+        :param int max_events: The number of events to keep
+        """
+        super().__init__()
+        if not isinstance(server, JSONServer):
+            raise Exception('Need a JSONServer instance but got {}'.format(server))
+        self.server = server
+        self.id_generator = server.id_generator
+        self.events = collections.deque(maxlen=max_events)
+        self.sequence = 0
+        self.lock = threading.RLock()
+        self.appended = threading.Condition(self.lock)
+    
+    def _append(self, bucket, op, doc_id, document):
+        self.sequence += 1
+        self.events.append(ChangeEvent(self.sequence, bucket, op, doc_id, document))
+    
+    def _stored(self, bucket, documents, doc_ids):
+        for doc, doc_id in zip(documents, doc_ids):
+            doc = query.copy_json(doc)
+            doc['_id'] = doc_id
+            self._append(bucket, 'store', doc_id, doc)
+        self.appended.notify_all()
+    
+    
+    # MARK: - Feed
+    
+    def changes(self, since=0, bucket=None, limit=None):
+        with self.lock:
+            if since > self.sequence:
+                raise Exception('Sequence {} is ahead of the feed, which is at {}'.format(since, self.sequence))
+            oldest = self.events[0].sequence if len(self.events) > 0 else self.sequence + 1
+            if since + 1 < oldest and since < self.sequence:
+                raise FeedTruncated('Changes after {} are gone, the feed starts at {}'.format(since, oldest))
+            found = []
+            for event in reversed(self.events):
+                if event.sequence <= since:
+                    break
+                if bucket is None or event.bucket == bucket:
+                    found.append(event)
+        found.reverse()
+        return found if limit is None else found[:limit]
+    
+    def last_sequence(self):
+        with self.lock:
+            return self.sequence
+    
+    def wait_for_changes(self, since, timeout=None):
+        """ Blocks until the feed has events after `since` or the timeout
+        has passed.
+        
+        :returns: Whether there are events after `since`
+        """
+        with self.appended:
+            return self.appended.wait_for(lambda: self.sequence > since, timeout)
+    
+    
+    # MARK: - Overrides
+    
+    def load_document(self, bucket, doc_id):
+        return self.server.load_document(bucket, doc_id)
+    
+    def load_documents(self, bucket, doc_ids):
+        return self.server.load_documents(bucket, doc_ids)
+    
+    def add_documents(self, bucket, documents):
+        if isinstance(documents, dict):
+            documents = [documents]
+        with self.lock:
+            doc_ids = self.server.add_documents(bucket, documents)
+            self._stored(bucket, documents, doc_ids)
+        return doc_ids
+    
+    def store_document(self, bucket, document):
+        with self.lock:
+            doc_id = self.server.store_document(bucket, document)
+            self._stored(bucket, [document], [doc_id])
+        return doc_id
+    
+    def store_documents(self, bucket, documents):
+        documents = list(documents)
+        with self.lock:
+            doc_ids = self.server.store_documents(bucket, documents)
+            self._stored(bucket, documents, doc_ids)
+        return doc_ids
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        with self.lock:
+            found = self.server.update_document(bucket, doc_id, values, unset)
+            if found is not False:
+                self._append(bucket, 'update', doc_id, {'values': query.copy_json(values or {}), 'unset': list(unset or [])})
+                self.appended.notify_all()
+        return found
+    
+    def remove_document(self, bucket, doc_id):
+        with self.lock:
+            self.server.remove_document(bucket, doc_id)
+            self._append(bucket, 'remove', doc_id, None)
+            self.appended.notify_all()
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        if fields is None:
+            return self.server.find(bucket, dictionary, skip, limit, sort, descending)
+        return self.server.find(bucket, dictionary, skip, limit, sort, descending, fields)
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        if fields is None:
+            return self.server.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit)
+        return self.server.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit, fields)
+    
+    def count(self, bucket, dictionary):
+        return self.server.count(bucket, dictionary)
+    
+    def native_id(self, doc_id):
+        return self.server.native_id(doc_id)
+
+
+# MARK: - Sync
+
+class BucketSync(object):
+    """ Replicates a bucket from a server with a change feed to another
+    server, e.g. from a ChangeFeedServer around MongoServer to a
+    MemoryServer serving reads.
+    
+    The first `sync()` copies the whole bucket, later ones only apply the
+    changes since, so their cost depends on the write rate rather than the
+    size of the bucket. `sequence` is the last change applied; persist it
+    and pass it back in to resume after a restart.
+    """
+    
+    def __init__(self, source, target, bucket, target_bucket=None, sequence=None, batch_size=1000):
+        """
+        :param JSONServer source: The server to replicate from, must support
+            `changes()`
+        :param JSONServer target: The server to replicate to
+        :param str bucket: The bucket to replicate
+        :param str target_bucket: The bucket to write to, `bucket` if None
+        :param int sequence: The sequence number the target is at, None to
+            start with a full copy
+        :param int batch_size: The number of documents copied or changes
+            applied per call to the target
+        """
+        if not isinstance(source, JSONServer) or not isinstance(target, JSONServer):
+            raise Exception('Need JSONServer instances but got {} and {}'.format(source, target))
+        self.source = source
+        self.target = target
+        self.bucket = bucket
+        self.target_bucket = target_bucket or bucket
+        self.sequence = sequence
+        self.batch_size = batch_size
+        self.copied = 0
+        self.applied = 0
+    
+    def sync(self):
+        """ Brings the target up to date, copying the whole bucket if it's
+        new or has fallen behind the feed.
+        
+        :returns: The number of documents copied or changes applied
+        """
+        if self.sequence is not None:
+            try:
+                return self.apply_changes()
+            except FeedTruncated as e:
+                logging.warning('Copying bucket "{}" again: {}'.format(self.bucket, e))
+        return self.copy_bucket()
+    
+    def copy_bucket(self):
+        """ Copies all documents of the bucket and removes the target's
+        documents that aren't in the source, then applies the changes made
+        meanwhile.
+        """
+        start = self.source.last_sequence()
+        seen = set()
+        count = 0
+        for batch in self.source.find_batches(self.bucket, {}, self.batch_size):
+            self.target.store_documents(self.target_bucket, batch)
+            seen.update(doc['_id'] for doc in batch)
+            count += len(batch)
+        stale = []
+        for batch in self.target.find_batches(self.target_bucket, {}, self.batch_size, fields=['_id']):
+            stale.extend(doc['_id'] for doc in batch if doc['_id'] not in seen)
+        for doc_id in stale:
+            self.target.remove_document(self.target_bucket, doc_id)
+        self.copied += count
+        self.sequence = start
+        return count + self.apply_changes()
+    
+    def apply_changes(self):
+        """ Applies the changes since `sequence`; consecutive stores go to
+        the target in batches.
+        """
+        count = 0
+        while True:
+            events = self.source.changes(self.sequence, self.bucket, self.batch_size)
+            if 0 == len(events):
+                self.sequence = max(self.sequence, self.source.last_sequence())
+                return count
+            stores = []
+            for event in events:
+                if 'store' == event.op:
+                    stores.append(event.document)
+                    continue
+                if len(stores) > 0:
+                    self.target.store_documents(self.target_bucket, query.copy_json(stores))
+                    stores = []
+                if 'update' == event.op:
+                    self.target.update_document(self.target_bucket, event.doc_id, event.document['values'], event.document['unset'])
+                elif 'remove' == event.op:
+                    self.target.remove_document(self.target_bucket, event.doc_id)
+            if len(stores) > 0:
+                self.target.store_documents(self.target_bucket, query.copy_json(stores))
+            self.sequence = events[-1].sequence
+            count += len(events)
+            self.applied += len(events)
+    
+    def follow(self, stop, interval=1.0):
+        """ Keeps the target up to date until the `threading.Event` `stop` is
+        set, syncing as soon as there are changes or every `interval`
+        seconds if the source can't be waited on.
+        """
+        while not stop.is_set():
+            self.sync()
+            wait = getattr(self.source, 'wait_for_changes', None)
+            if wait is not None:
+                wait(self.sequence, interval)
+            else:
+                stop.wait(interval)
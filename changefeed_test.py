@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest changefeed_test.py
+
+import threading
+import unittest
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from .sqliteserver import SQLiteServer
+    from .changefeed import ChangeFeedServer, BucketSync, FeedTruncated
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    from sqliteserver import SQLiteServer
+    from changefeed import ChangeFeedServer, BucketSync, FeedTruncated
+
+
+class Item(JSONDocument):
+    pass
+
+
+class TestChangeFeed(unittest.TestCase):
+    
+    def test_feed(self):
+        """ Test that writes are recorded in order and can be read from any
+        sequence number. """
+        server = ChangeFeedServer(MemoryServer(), max_events=5)
+        with self.assertRaises(Exception):
+            MemoryServer().changes()
+        item = Item(None, json={'n': 1})
+        item.store_to(server, 'b')
+        item.n = 2
+        item.store_to(server, 'b')
+        server.add_documents('c', [{'_id': 'x'}])
+        server.remove_document('b', item.id)
+        events = server.changes()
+        self.assertEqual([1, 2, 3, 4], [e.sequence for e in events])
+        self.assertEqual([('b', 'store'), ('b', 'update'), ('c', 'store'), ('b', 'remove')], [(e.bucket, e.op) for e in events])
+        self.assertEqual({'_id': item.id, 'n': 1}, events[0].document)
+        self.assertEqual({'values': {'n': 2}, 'unset': []}, events[1].document)
+        self.assertEqual([3], [e.sequence for e in server.changes(1, 'c')])
+        self.assertEqual([2], [e.sequence for e in server.changes(1, limit=1)])
+        self.assertEqual([], server.changes(4))
+        for i in range(4):
+            server.store_document('c', {'_id': str(i)})
+        self.assertEqual(8, server.last_sequence())
+        with self.assertRaises(FeedTruncated):
+            server.changes(2)
+        self.assertEqual(5, len(server.changes(3)))
+        self.assertTrue(server.wait_for_changes(7, 0))
+        self.assertFalse(server.wait_for_changes(8, 0.01))
+    
+    def test_sync(self):
+        """ Test replicating a bucket incrementally, and starting over when
+        the feed was truncated. """
+        source = ChangeFeedServer(MemoryServer(), max_events=10)
+        source.add_documents('b', [{'_id': str(i), 'n': i} for i in range(20)])
+        source.store_document('other', {'_id': 'o'})
+        target = SQLiteServer()
+        target.store_document('replica', {'_id': 'stale'})
+        sync = BucketSync(source, target, 'b', 'replica', batch_size=7)
+        self.assertEqual(20, sync.sync())
+        self.assertIsNone(target.load_document('replica', 'stale'), 'Must remove documents missing in the source')
+        
+        source.update_document('b', '3', {'n': 30}, None)
+        source.remove_document('b', '4')
+        source.store_document('b', {'_id': '20', 'n': 20})
+        source.store_document('other', {'_id': 'p'})
+        self.assertEqual(3, sync.sync())
+        self.assertEqual(0, sync.sync())
+        expected = sorted(source.find('b', {}, limit=None), key=lambda d: d['_id'])
+        self.assertEqual(expected, sorted(target.find('replica', {}, limit=None), key=lambda d: d['_id']))
+        
+        for i in range(12):
+            source.update_document('b', '5', {'n': i}, None)
+        source.remove_document('b', '6')
+        self.assertEqual(19, sync.sync(), 'Must copy again after falling behind the feed')
+        self.assertEqual(11, target.load_document('replica', '5')['n'])
+        self.assertIsNone(target.load_document('replica', '6'))
+        
+        stop = threading.Event()
+        follower = threading.Thread(target=sync.follow, args=(stop, 0.01))
+        follower.start()
+        source.store_document('b', {'_id': 'live'})
+        for i in range(100):
+            if target.load_document('replica', 'live') is not None:
+                break
+            stop.wait(0.01)
+        stop.set()
+        follower.join()
+        self.assertIsNotNone(target.load_document('replica', 'live'))
+        
+        source = ChangeFeedServer(MemoryServer())
+        source.store_document('b', {'_id': 1, 'n': 1})
+        target = MemoryServer()
+        sync = BucketSync(source, target, 'b')
+        sync.sync()
+        source.store_document('b', {'_id': 2, 'n': 2})
+        source.update_document('b', 1, {'n': 10})
+        sync.sync()
+        self.assertEqual([1, 2, 1], [event.doc_id for event in source.changes()])
+        self.assertEqual([{'_id': 1, 'n': 10}, {'_id': 2, 'n': 2}], sorted(target.find('b', {}, limit=None), key=lambda d: d['_id']), 'Must keep id types')
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Generating document ids in preallocated blocks
+
+import os
+import time
+import random
+import weakref
+import threading
+import collections
+
+
+class IdGenerator(object):
+    """ Abstract superclass of document id generators.
+    
+    Ids are generated `block_size` at a time and handed out from a queue,
+    so creating many documents doesn't pay the cost of generating an id,
+    e.g. reading random bytes from the OS, for each. Subclasses implement
+    `generate()`. Generators are thread-safe; share one between classes.
+    Forked child processes drop the ids the parent preallocated, see
+    `after_fork()`.
+    """
+    
+    def __init__(self, block_size=256):
+        """
+        :param int block_size: The number of ids generated at once
+        """
+        if block_size < 1:
+            raise Exception('Need a positive block size, got {}'.format(block_size))
+        self.block_size = block_size
+        self.ids = collections.deque()
+        self.lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            ref = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: _after_fork(ref))
+    
+    def after_fork(self):
+        """ Called in the child process after a fork, so it doesn't hand out
+        the same ids as its parent. """
+        self.ids = collections.deque()
+        self.lock = threading.Lock()
+    
+    def new_id(self):
+        """ Returns a new id, a string. """
+        ids = self.ids
+        while True:
+            try:
+                return ids.popleft()
+            except IndexError:
+                with self.lock:
+                    if 0 == len(ids):
+                        ids.extend(self.generate(self.block_size))
+    
+    def new_ids(self, count):
+        """ Returns a list of `count` new ids. """
+        found = []
+        while len(found) < count:
+            try:
+                found.append(self.ids.popleft())
+            except IndexError:
+                with self.lock:
+                    found.extend(self.generate(count - len(found)))
+        return found
+    
+    def generate(self, count):
+        """ Generates `count` new ids. Called with `lock` held.
+        
+        :returns: A list of strings
+        """
+        raise Exception('{} must implement `generate()`'.format(self.__class__.__name__))
+
+def _after_fork(ref):
+    generator = ref()
+    if generator is not None:
+        generator.after_fork()
+
+
+class UUID4Generator(IdGenerator):
+    """ Random version 4 UUIDs in their canonical string form, like
+    ``str(uuid.uuid4())``. Random ids land anywhere in a B-tree index, so
+    inserting many touches many of its pages.
+    """
+    
+    def generate(self, count):
+        raw = os.urandom(16 * count).hex()
+        ids = []
+        for i in range(0, 32 * count, 32):
+            h = raw[i:i + 32]
+            ids.append('{}-{}-4{}-{}{}-{}'.format(h[:8], h[8:12], h[13:16], _variant[h[16]], h[17:20], h[20:32]))
+        return ids
+
+_variant = {c: '89ab'[int(c, 16) & 3] for c in '0123456789abcdef'}
+
+
+class ObjectIdGenerator(IdGenerator):
+    """ Ids compatible with MongoDB's ObjectId, as 24 hex characters: a
+    timestamp in seconds, 5 random bytes per process and a counter. Ids of
+    a process increase, apart from the counter wrapping around after 16
+    million ids, so they are appended to the end of B-tree indexes.
+    """
+    
+    def __init__(self, block_size=256):
+        super().__init__(block_size)
+        self.pid = None
+        self.process = None
+        self.counter = 0
+    
+    def after_fork(self):
+        super().after_fork()
+        self.pid = None
+    
+    def generate(self, count):
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.process = os.urandom(5).hex()
+            self.counter = random.SystemRandom().randrange(0xffffff)
+        prefix = '{:08x}{}'.format(int(time.time()) & 0xffffffff, self.process)
+        counter = self.counter
+        ids = ['{}{:06x}'.format(prefix, (counter + i) & 0xffffff) for i in range(1, count + 1)]
+        self.counter = (counter + count) & 0xffffff
+        return ids
+
+
+class ULIDGenerator(IdGenerator):
+    """ ULIDs: a timestamp in milliseconds and 80 random bits, as 26
+    characters of Crockford's base 32, which sort in the order they were
+    generated. Ids generated within the same millisecond, or of a block,
+    increment the random part of the previous one, so they're monotonic.
+    Because ids of a block share its timestamp, keep blocks small if the
+    timestamps should be accurate.
+    """
+    
+    def __init__(self, block_size=64):
+        super().__init__(block_size)
+        self.last_time = 0
+        self.last_random = 0
+    
+    def after_fork(self):
+        super().after_fork()
+        self.last_time = 0
+    
+    def generate(self, count):
+        now = int(time.time() * 1000)
+        if now > self.last_time:
+            self.last_time = now
+            rand = int.from_bytes(os.urandom(10), 'big') >> 1
+        else:
+            rand = self.last_random + 1
+        if rand + count > 1 << 80:
+            raise Exception('Generated too many ULIDs within one millisecond')
+        prefix = _base32(self.last_time, 10)
+        ids = []
+        for i in range(count):
+            r = rand + i
+            ids.append(prefix + ''.join([_pairs[(r >> shift) & 0x3ff] for shift in (70, 60, 50, 40, 30, 20, 10, 0)]))
+        self.last_random = rand + count - 1
+        return ids
+
+_crockford = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_pairs = [_crockford[i >> 5] + _crockford[i & 31] for i in range(1024)]
+
+def _base32(value, length):
+    chars = []
+    for i in range(length):
+        chars.append(_crockford[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+uuid4 = UUID4Generator()
+""" The generator used if neither a class nor its server name one. """
+
+objectid = ObjectIdGenerator()
+ulid = ULIDGenerator()
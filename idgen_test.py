@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest idgen_test.py
+
+import os
+import re
+import json
+import uuid
+import unittest
+import concurrent.futures
+if __package__:
+    from .jsondocument import JSONDocument
+    from .schemadocument import SchemaDocument
+    from .memoryserver import MemoryServer
+    from .sqliteserver import SQLiteServer
+    from .cachingserver import CachingServer
+    from . import idgen
+else:
+    from jsondocument import JSONDocument
+    from schemadocument import SchemaDocument
+    from memoryserver import MemoryServer
+    from sqliteserver import SQLiteServer
+    from cachingserver import CachingServer
+    import idgen
+
+
+class TestIdGen(unittest.TestCase):
+    
+    def test_formats(self):
+        """ Test that generated ids have their format and don't repeat. """
+        ids = idgen.UUID4Generator(block_size=10).new_ids(25)
+        self.assertEqual(25, len(set(ids)))
+        for doc_id in ids:
+            self.assertEqual(4, uuid.UUID(doc_id).version)
+            self.assertEqual(doc_id, str(uuid.UUID(doc_id)))
+        
+        generator = idgen.ObjectIdGenerator(block_size=7)
+        ids = [generator.new_id() for i in range(20)]
+        self.assertTrue(all(re.match(r'^[0-9a-f]{24}$', doc_id) for doc_id in ids))
+        self.assertEqual(20, len(set(ids)))
+        self.assertEqual(1, len(set(doc_id[:18] for doc_id in ids[:7])))
+        
+        generator = idgen.ULIDGenerator(block_size=5)
+        ids = generator.new_ids(3) + [generator.new_id() for i in range(20)]
+        self.assertTrue(all(re.match(r'^[0-9A-HJKMNP-TV-Z]{26}$', doc_id) for doc_id in ids))
+        self.assertEqual(sorted(set(ids)), ids, 'Must be strictly increasing')
+    
+    def test_threads(self):
+        """ Test that concurrent callers get distinct ids. """
+        generator = idgen.ULIDGenerator(block_size=16)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            ids = list(executor.map(lambda i: generator.new_id(), range(2000)))
+        self.assertEqual(2000, len(set(ids)))
+    
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Needs os.fork()')
+    def test_fork(self):
+        """ Test that forked processes don't hand out their parent's ids. """
+        generators = [idgen.UUID4Generator(), idgen.ObjectIdGenerator(), idgen.ULIDGenerator()]
+        for generator in generators:
+            generator.new_id()
+        read, write = os.pipe()
+        pid = os.fork()
+        if 0 == pid:
+            try:
+                os.write(write, json.dumps([g.new_ids(3) for g in generators]).encode('utf-8'))
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read, 'rb') as handle:
+            child = json.loads(handle.read().decode('utf-8'))
+        os.waitpid(pid, 0)
+        for generator, ids in zip(generators, child):
+            self.assertEqual(3, len(ids))
+            self.assertFalse(set(ids) & set(generator.new_ids(3)), 'Must not repeat the parent\'s ids in the child')
+    
+    def test_documents(self):
+        """ Test that classes use their own, their server's or the default
+        generator. """
+        class Plain(JSONDocument):
+            pass
+        class Sorted(JSONDocument):
+            id_generator = idgen.ulid
+        class Person(SchemaDocument):
+            fields = ('name',)
+        
+        self.assertEqual(36, len(Plain(None).id))
+        self.assertEqual(26, len(Sorted(None).id))
+        self.assertEqual(36, len(Person(None).id))
+        self.assertEqual('x', Sorted('x').id)
+        Plain.hookup(CachingServer(SQLiteServer()))
+        Person.hookup(MemoryServer())
+        self.assertEqual(26, len(Plain(None).id), "Must use the server's generator")
+        self.assertEqual(26, len(Plain.adopt({'n': 1}).id))
+        self.assertEqual(36, len(Person(None).id))
+        self.assertEqual(26, len(SQLiteServer().store_document('b', {'n': 1})))
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Call counts, latencies and sizes of server calls, hydration and
+#   serialization
+
+import json
+import time
+import bisect
+import logging
+import threading
+import functools
+
+if __package__:
+    from .jsonserver import JSONServer
+else:
+    from jsonserver import JSONServer
+
+
+enabled = False
+""" Whether metrics are recorded; checked before doing any work, so the
+hooks cost next to nothing while disabled. """
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram(object):
+    """ Counts observations per bucket, given by the buckets' upper bounds,
+    and keeps their count and sum.
+    """
+    
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+    
+    def quantile(self, q):
+        """ The upper bound of the bucket the given quantile falls into,
+        None if there are no observations or it's above the largest bound.
+        """
+        if 0 == self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+    
+    def as_json(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip([str(b) for b in self.bounds] + ['+Inf'], self.counts)),
+        }
+
+
+class MetricsRegistry(object):
+    """ Holds counters and histograms by metric name and label values.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.bounds = {}
+    
+    def count(self, name, labels, amount=1):
+        """ Adds to the counter with the given name and labels.
+        
+        :param str name: The metric name
+        :param tuple labels: ``(label, value)`` tuples
+        """
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, labels, value, bounds=LATENCY_BUCKETS):
+        """ Records a value in the histogram with the given name and labels,
+        which gets the given bucket bounds when it's created.
+        """
+        with self.lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(self.bounds.setdefault(name, bounds))
+                self.histograms[key] = histogram
+            histogram.observe(value)
+    
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+    
+    def snapshot(self):
+        """ Returns all metrics as a dictionary of lists of label and value
+        dictionaries, by metric name.
+        """
+        snap = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                snap.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                entry = histogram.as_json()
+                entry['labels'] = dict(labels)
+                snap.setdefault(name, []).append(entry)
+        return snap
+    
+    def export(self, exporter, *args, **kwargs):
+        """ Hands the registry to the given exporter, e.g. one of those in
+        `exporters`, and returns what it returns.
+        """
+        return exporter(self, *args, **kwargs)
+
+
+registry = MetricsRegistry()
+""" The registry used unless another one is given. """
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+
+# MARK: - Document Classes
+
+_local = threading.local()
+
+def current_class():
+    """ The name of the JSONDocument subclass whose CRUD method is running on
+    this thread, '-' outside of those. """
+    return getattr(_local, 'cls', '-')
+
+def document_operation(func):
+    """ Decorates JSONDocument CRUD methods so server calls made from them are
+    attributed to the document class.
+    """
+    @functools.wraps(func)
+    def wrapper(receiver, *args, **kwargs):
+        if not enabled:
+            return func(receiver, *args, **kwargs)
+        previous = getattr(_local, 'cls', '-')
+        _local.cls = (receiver if isinstance(receiver, type) else receiver.__class__).__name__
+        try:
+            return func(receiver, *args, **kwargs)
+        finally:
+            _local.cls = previous
+    return wrapper
+
+def timed_serialization(cls, func, *args):
+    """ Calls the serializing function and records how long it took.
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    record_serialization(cls, time.perf_counter() - start)
+    return result
+
+def record_serialization(cls, seconds):
+    """ Records serializing a document of the class. """
+    registry.observe('jsondocument_serialize_seconds', (('class', cls.__name__),), seconds)
+
+def record_hydration(cls, count, seconds):
+    """ Records instantiating `count` documents of the class from server
+    results. """
+    labels = (('class', cls.__name__),)
+    registry.observe('jsondocument_hydration_seconds', labels, seconds)
+    registry.count('jsondocument_hydrated_documents_total', labels, count)
+
+
+# MARK: - Server
+
+class InstrumentedServer(JSONServer):
+    """ Wraps another server and records, per operation, bucket and document
+    class, the number of calls and errors, latency, payload size and the
+    number of documents returned.
+    
+    While instrumentation is disabled calls go straight through. Results of
+    `find()` that are iterated lazily are timed until exhausted.
+    """
+    
+    def __init__(self, server, registry=None, payload_sizes=True):
+        """
+        :param JSONServer server: The server to instrument
+        :param MetricsRegistry registry: Where to record, the module's
+            `registry` if None
+        :param bool payload_sizes: Whether to measure the size of stored
+            documents, which means JSON-encoding them once more
+        """
+        super().__init__()
+        if not isinstance(server, JSONServer):
+            raise Exception('Need a JSONServer instance but got {}'.format(server))
+        self.server = server
+        self.id_generator = server.id_generator
+        self.registry = registry
+        self.payload_sizes = payload_sizes
+    
+    def _call(self, op, bucket, func, *args, payload=None):
+        if not enabled:
+            return func(*args)
+        metrics = self.registry or registry
+        labels = (('bucket', bucket or '-'), ('class', current_class()), ('op', op))
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            metrics.count('jsonserver_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('jsonserver_call_seconds', labels, time.perf_counter() - start)
+            metrics.count('jsonserver_calls_total', labels)
+        if payload is not None and self.payload_sizes:
+            metrics.observe('jsonserver_payload_bytes', labels, _size(payload), SIZE_BUCKETS)
+        if 'load_document' == op:
+            metrics.observe('jsonserver_result_documents', labels, 0 if result is None else 1, COUNT_BUCKETS)
+        elif 'load_documents' == op:
+            metrics.observe('jsonserver_result_documents', labels, sum(1 for doc in result if doc is not None), COUNT_BUCKETS)
+        elif 'find' == op and result is not None:
+            if isinstance(result, list):
+                metrics.observe('jsonserver_result_documents', labels, len(result), COUNT_BUCKETS)
+            else:
+                result = self._counted(metrics, labels, result)
+        return result
+    
+    def _counted(self, metrics, labels, found):
+        count = 0
+        start = time.perf_counter()
+        try:
+            for doc in found:
+                count += 1
+                yield doc
+        finally:
+            metrics.observe('jsonserver_iteration_seconds', labels, time.perf_counter() - start)
+            metrics.observe('jsonserver_result_documents', labels, count, COUNT_BUCKETS)
+    
+    
+    def _batched(self, metrics, labels, batches):
+        """ Records walking the batches as one call, whose latency is the
+        time spent fetching batches, not the time the consumer takes. """
+        count = 0
+        seconds = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = next(batches, None)
+                except Exception:
+                    metrics.count('jsonserver_errors_total', labels)
+                    raise
+                finally:
+                    seconds += time.perf_counter() - start
+                if batch is None:
+                    break
+                count += len(batch)
+                yield batch
+        finally:
+            metrics.observe('jsonserver_call_seconds', labels, seconds)
+            metrics.count('jsonserver_calls_total', labels)
+            metrics.observe('jsonserver_result_documents', labels, count, COUNT_BUCKETS)
+    
+    
+    # MARK: - Overrides
+    
+    def load_document(self, bucket, doc_id):
+        return self._call('load_document', bucket, self.server.load_document, bucket, doc_id)
+    
+    def load_documents(self, bucket, doc_ids):
+        return self._call('load_documents', bucket, self.server.load_documents, bucket, doc_ids)
+    
+    def add_documents(self, bucket, documents):
+        return self._call('add_documents', bucket, self.server.add_documents, bucket, documents, payload=documents)
+    
+    def store_document(self, bucket, document):
+        return self._call('store_document', bucket, self.server.store_document, bucket, document, payload=document)
+    
+    def store_documents(self, bucket, documents):
+        return self._call('store_documents', bucket, self.server.store_documents, bucket, documents, payload=documents)
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        return self._call('update_document', bucket, self.server.update_document, bucket, doc_id, values, unset, payload=values)
+    
+    def remove_document(self, bucket, doc_id):
+        return self._call('remove_document', bucket, self.server.remove_document, bucket, doc_id)
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        if fields is None:
+            return self._call('find', bucket, self.server.find, bucket, dictionary, skip, limit, sort, descending)
+        return self._call('find', bucket, self.server.find, bucket, dictionary, skip, limit, sort, descending, fields)
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        if fields is None:
+            batches = self.server.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit)
+        else:
+            batches = self.server.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit, fields)
+        if not enabled:
+            return batches
+        labels = (('bucket', bucket or '-'), ('class', current_class()), ('op', 'find_batches'))
+        return self._batched(self.registry or registry, labels, batches)
+    
+    def count(self, bucket, dictionary):
+        return self._call('count', bucket, self.server.count, bucket, dictionary)
+    
+    def changes(self, since=0, bucket=None, limit=None):
+        return self.server.changes(since, bucket, limit)
+    
+    def last_sequence(self):
+        return self.server.last_sequence()
+    
+    def native_id(self, doc_id):
+        return self.server.native_id(doc_id)
+    
+    def cached_instance(self, cls, bucket, doc_id):
+        return self.server.cached_instance(cls, bucket, doc_id)
+    
+    def cache_instance(self, instance, bucket):
+        self.server.cache_instance(instance, bucket)
+
+
+def _size(payload):
+    return len(json.dumps(payload, separators=(',', ':'), default=str).encode('utf-8'))
+
+
+# MARK: - Exporters
+
+def snapshot(metrics=None):
+    """ Returns the metrics as a dictionary, see `MetricsRegistry.snapshot()`.
+    """
+    return (metrics or registry).snapshot()
+
+def log_line(metrics=None):
+    """ Returns the metrics as a single line of text, histograms summarized
+    by count, mean and the bucket bounds of their median and 99th percentile.
+    """
+    metrics = metrics or registry
+    parts = []
+    with metrics.lock:
+        for (name, labels), value in sorted(metrics.counters.items()):
+            parts.append('{}{}={}'.format(name, _labels(labels), value))
+        for (name, labels), histogram in sorted(metrics.histograms.items(), key=lambda item: item[0]):
+            parts.append('{}{} count={} mean={:.6g} p50<={} p99<={}'.format(name, _labels(labels), histogram.count,
+                histogram.sum / histogram.count if histogram.count else 0, histogram.quantile(0.5), histogram.quantile(0.99)))
+    return '; '.join(parts)
+
+def log(metrics=None, logger=None, level=logging.INFO):
+    """ Logs `log_line()`. """
+    (logger or logging.getLogger(__name__)).log(level, log_line(metrics))
+
+def prometheus_text(metrics=None):
+    """ Returns the metrics in the Prometheus text exposition format.
+    """
+    metrics = metrics or registry
+    lines = []
+    with metrics.lock:
+        seen = set()
+        for (name, labels), value in sorted(metrics.counters.items()):
+            if name not in seen:
+                lines.append('# TYPE {} counter'.format(name))
+                seen.add(name)
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        for (name, labels), histogram in sorted(metrics.histograms.items(), key=lambda item: item[0]):
+            if name not in seen:
+                lines.append('# TYPE {} histogram'.format(name))
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(list(histogram.bounds) + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', str(bound)),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), histogram.count))
+    return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+    if 0 == len(labels):
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, val in labels) + '}'
+
+
+exporters = {
+    'snapshot': snapshot,
+    'log': log,
+    'prometheus': prometheus_text,
+}
+""" The available exporters by name; add your own to have them picked up by
+code that exports by name. """
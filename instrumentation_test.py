@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest instrumentation_test.py
+
+import unittest
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from . import instrumentation
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    import instrumentation
+
+
+class Gadget(JSONDocument):
+    pass
+
+
+class TestInstrumentation(unittest.TestCase):
+    
+    def setUp(self):
+        instrumentation.registry.reset()
+        self.server = instrumentation.InstrumentedServer(MemoryServer())
+    
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.registry.reset()
+    
+    def test_disabled(self):
+        """ Test that nothing is recorded while disabled. """
+        Gadget('1', json={'a': 1}).store_to(self.server, 'b')
+        Gadget.find_on({}, self.server, 'b')
+        self.assertEqual({}, instrumentation.snapshot())
+    
+    def test_server(self):
+        """ Test recording server calls per bucket, operation and class. """
+        instrumentation.enable()
+        Gadget('1', json={'a': 1}).store_to(self.server, 'b')
+        Gadget('2', json={'a': 2}).store_to(self.server, 'b')
+        self.server.load_document('b', '1')
+        found = Gadget.find_on({'a': {'$gt': 0}}, self.server, 'b')
+        self.assertEqual(2, len(found))
+        self.assertEqual(2, len(list(Gadget.find_iter_on({}, self.server, 'b', 1))))
+        with self.assertRaises(Exception):
+            self.server.load_document('b', None)
+        
+        snap = instrumentation.snapshot()
+        calls = {(e['labels']['op'], e['labels']['class']): e['value'] for e in snap['jsonserver_calls_total']}
+        self.assertEqual(2, calls[('store_document', 'Gadget')])
+        self.assertEqual(1, calls[('find', 'Gadget')])
+        self.assertEqual(2, calls[('load_document', '-')], 'Must not attribute direct server calls to a class')
+        self.assertEqual([{'bucket': 'b', 'class': '-', 'op': 'load_document'}], [e['labels'] for e in snap['jsonserver_errors_total']])
+        results = {e['labels']['op']: e['sum'] for e in snap['jsonserver_result_documents']}
+        self.assertEqual(2, results['find'])
+        self.assertEqual(2, results['find_batches'])
+        self.assertEqual(1, sum(v for (op, cls), v in calls.items() if 'find_batches' == op))
+        self.assertEqual(2, snap['jsonserver_payload_bytes'][0]['count'])
+        self.assertEqual(2, snap['jsondocument_hydrated_documents_total'][0]['value'])
+        self.assertEqual(1, snap['jsondocument_hydration_seconds'][0]['count'])
+    
+    def test_export(self):
+        """ Test serialization timing and the exporters. """
+        instrumentation.enable()
+        doc = Gadget('1', json={'a': 1})
+        doc.as_json()
+        doc.for_api_bytes()
+        snap = instrumentation.registry.export(instrumentation.exporters['snapshot'])
+        self.assertEqual(2, snap['jsondocument_serialize_seconds'][0]['count'])
+        
+        text = instrumentation.prometheus_text()
+        self.assertIn('# TYPE jsondocument_serialize_seconds histogram', text)
+        self.assertIn('jsondocument_serialize_seconds_count{class="Gadget"} 2', text)
+        self.assertIn('jsondocument_serialize_seconds_bucket{class="Gadget",le="+Inf"} 2', text)
+        self.assertIn('jsondocument_serialize_seconds{class="Gadget"} count=2', instrumentation.log_line())
@@ -6,17 +6,68 @@
 #   2014-02-05  Created by Pascal Pfiffner
 #
 
-import uuid
+import time
+import weakref
 import logging
 
 if __package__:
     from .jsonserver import JSONServer
+    from .asyncserver import AsyncJSONServer, adapter_for
+    from .query import updateDictionaryByKeyPath, unset_keypath, value_at_keypath
+    from . import query
+    from . import serializer
+    from . import instrumentation
+    from . import bulkinsert
+    from . import idgen
+    from .serializer import Serializer, RenderCache, stock, instance_fields
 else:
     from jsonserver import JSONServer
+    from asyncserver import AsyncJSONServer, adapter_for
+    from query import updateDictionaryByKeyPath, unset_keypath, value_at_keypath
+    import query
+    import serializer
+    import instrumentation
+    import bulkinsert
+    import idgen
+    from serializer import Serializer, RenderCache, stock, instance_fields
 
 
-class JSONDocument(object):
-    """ Base class for documents living in a NoSQL database.
+class DocumentState(object):
+    """ Bookkeeping of a JSONDocument instance that is not part of its
+    contents. Documents only get one once they have been loaded or stored,
+    and changes are only recorded from then on. Documents loaded with only
+    some of their fields have those fields' key paths in `partial`.
+    Adopted documents are `shared` until they copy their storage.
+    
+    `lazy` holds the raw values of `embedded` attributes that haven't been
+    hydrated yet.
+    
+    `loaded` holds copies of the lists, dictionaries and embedded documents
+    the document had when it was last loaded or stored, to notice changes
+    made to them in place.
+    
+    `version` counts changes, `rendered` holds cached serialized output and
+    `parents` the documents embedding this one, with the key they embed it
+    under, which are told about its changes.
+    """
+    __slots__ = ('changes', 'persisted', 'partial', 'shared', 'lazy', 'loaded', 'version', 'rendered', 'parents')
+    
+    def __init__(self):
+        self.changes = None
+        self.persisted = False
+        self.partial = None
+        self.shared = False
+        self.lazy = None
+        self.loaded = None
+        self.version = 0
+        self.rendered = None
+        self.parents = None
+
+
+class BaseDocument(object):
+    """ Base class for documents living in a NoSQL database. Subclass
+    `JSONDocument`, which keeps the contents in the instance dictionary, or
+    `SchemaDocument`, which keeps them in slots.
     
     All CRUD methods have two versions, one where you specify the server and
     one where you rely on the document class being hooked up to a server
@@ -24,10 +75,58 @@ class JSONDocument(object):
     
     Currently supported servers are MongoDB or Couchbase, or can be simple file
     or memory "databases".
+    
+    Documents track which attributes and key paths change after they have
+    been loaded or stored, so `store()` only sends those changes to the
+    server. Top-level lists, dictionaries and embedded documents changed in
+    place, like by appending to a list, are found by comparing them to a
+    copy taken when loading or storing, and are sent as a whole.
+    
+    Set `api_omit` to a set of key names that `for_api()` should always
+    leave out. `to_json_bytes()` and `for_api_bytes()` serialize straight to
+    JSON; subclasses overriding `as_json()` or `for_api()` are honored there
+    and when embedded in other documents.
+    
+    Assigning a `WriteBehindQueue` to `write_behind` makes `store()`,
+    `insert()` and `remove()` queue their writes and return a Future
+    instead of waiting for the server.
+    
+    Set `adopt_documents` to have query results instantiated with
+    `adopt()`, which uses the dictionaries the server returns as storage
+    instead of copying them in.
+    
+    Set `render_cache` to True to have instances keep their serialized
+    output until they or their embedded documents change, or to a
+    `RenderCache` to additionally share the output of unchanged documents
+    across instances. Cached output is handed out as is and must not be
+    modified.
+    
+    New documents get their id from `id_generator`, an `idgen.IdGenerator`;
+    if None, from the one the class' server declares, and UUID4 if that
+    doesn't declare one either.
+    
+    Set `embedded` to a dictionary mapping attribute names to the
+    JSONDocument subclass their values are instances of, ``[Sub]`` for lists
+    of them or ``{str: Sub}`` for dictionaries of them. Dictionaries and
+    lists assigned to these attributes, e.g. when loading, are kept as they
+    are and only turned into documents when the attribute is first read.
+    Until then `as_json()` and `to_json_bytes()` return them unchanged, so
+    documents embedding large arrays of sub-documents only pay for those
+    they use. Changes to hydrated documents mark the attribute changed, so
+    `store()` sends them. `SchemaDocument` converts its `Field` doctypes
+    right away.
     """
+    __slots__ = ('_docstate',)
     
     server = None
+    async_server = None
     use_bucket = None
+    api_omit = None
+    write_behind = None
+    adopt_documents = False
+    render_cache = None
+    id_generator = None
+    embedded = None
     
     def __init__(self, ident, doctype=None, json=None):
         """ Initializing a document makes sure it has an id in the end by:
@@ -41,6 +140,8 @@ class JSONDocument(object):
         argument and contains the whole document. Intelligent initializers
         pull out ivars that they need from this document dictionary.
         """
+        object.__setattr__(self, '_docstate', None)
+        
         # find the document id
         if ident is None:
             if json is not None:
@@ -49,16 +150,13 @@ class JSONDocument(object):
                 elif 'id' in json:
                     ident = json['id']
             if ident is None:
-                ident = str(uuid.uuid4())
-        self._id = str(ident) if ident is not None else None
+                ident = self.new_id()
+        object.__setattr__(self, '_id', str(ident) if ident is not None else None)
         
         # set all attributes except '_id' and 'id'
         if json is not None:
-            if '_id' in json:
-                del json['_id']
-            if 'id' in json:
-                del json['id']
-            
+            if '_id' in json or 'id' in json:
+                json = {key: val for key, val in json.items() if '_id' != key and 'id' != key}
             self.update_with(json)
         
         # set document type
@@ -66,42 +164,286 @@ class JSONDocument(object):
             self.type = doctype
     
     def __getattr__(self, name):
-        """ This is called when we don't yet have the attribute. """
-        return None
+        """ This is called when we don't yet have the attribute, or haven't
+        hydrated it yet, see `embedded`. """
+        if '_docstate' == name:
+            return None
+        lazy = self._lazy
+        if lazy is None or name not in lazy:
+            return None
+        raw = lazy.pop(name)
+        value = _hydrate(self.__class__.embedded[name], raw)
+        state = self._docstate
+        if state is not None:
+            if state.shared:
+                self.own_storage()
+            if state.persisted and (state.changes is None or name not in state.changes):
+                if state.loaded is None:
+                    state.loaded = {}
+                state.loaded[name] = query.copy_json(raw)
+        object.__setattr__(self, name, value)
+        _watch(self, name, value)
+        return value
+    
+    def __setattr__(self, name, value):
+        state = self._docstate
+        if state is None:
+            cls = self.__class__
+            if cls.embedded is None and cls.set_value is _base_set_value:
+                object.__setattr__(self, name, value)
+            else:
+                self.set_value(name, value)
+            return
+        if state.shared:
+            self.own_storage()
+        self.set_value(name, value)
+        self.mark_changed(name)
+    
+    def __delattr__(self, name):
+        self.own_storage()
+        lazy = self._lazy
+        if lazy is not None and name in lazy:
+            del lazy[name]
+        else:
+            object.__delattr__(self, name)
+        self.mark_changed(name)
     
     @property
     def id(self):
         return self._id
     
+    @property
+    def _lazy(self):
+        state = self._docstate
+        return state.lazy if state is not None else None
+    
+    @classmethod
+    def new_id(cls):
+        """ Returns an id for a new document, see `id_generator`. """
+        generator = cls.id_generator
+        if generator is None:
+            generator = getattr(cls.server or cls.async_server, 'id_generator', None) or idgen.uuid4
+        return generator.new_id()
+    
+    @classmethod
+    def from_embedded(cls, json):
+        """ Instantiate a document embedded in another one. Unlike top-level
+        documents, embedded ones don't get an id if they don't have one, so
+        they serialize back to what they were created from.
+        """
+        has_id = '_id' in json or 'id' in json
+        doc = cls(None, json=json)
+        if not has_id:
+            object.__setattr__(doc, '_id', None)
+        return doc
+    
+    @classmethod
+    def adopt(cls, json):
+        """ Instantiate a document that uses the given dictionary as its
+        storage instead of copying its contents, which is considerably
+        faster for documents fresh from a server. `__init__()` is not called.
+        
+        The dictionary is shared until an attribute or key path of the
+        instance is set or removed, which first makes a deep copy of it.
+        Until then `as_json()` returns it as it is. Nested lists and
+        dictionaries are shared as well, so changing them in place, like
+        ``doc.tags.append(...)``, modifies the caller's dictionary; use
+        `set_keypath()` or assign a copy instead. `store()` still finds and
+        sends such changes.
+        """
+        ident = json.get('_id')
+        if ident is None or 'id' in json or str is not type(ident):
+            if ident is None:
+                ident = json.get('id')
+            json = {key: val for key, val in json.items() if 'id' != key}
+            json['_id'] = str(ident) if ident is not None else cls.new_id()
+        instance = cls.__new__(cls)
+        state = DocumentState()
+        state.shared = True
+        object.__setattr__(instance, '_docstate', state)
+        embedded = cls.embedded
+        if embedded is not None and not embedded.keys().isdisjoint(json):
+            json = dict(json)
+            state.lazy = {key: json.pop(key) for key in embedded if key in json and _is_raw(embedded[key], json[key])}
+        object.__setattr__(instance, '__dict__', json)
+        return instance
+    
+    def own_storage(self):
+        """ Makes an adopted document copy the dictionary it shares, called
+        before it's changed. """
+        state = self._docstate
+        if state is not None and state.shared:
+            state.shared = False
+            object.__setattr__(self, '__dict__', query.copy_json(self.__dict__))
+    
+    def get_value(self, name, default=None):
+        """ Returns the value of the given attribute, `default` if the
+        receiver doesn't have it. """
+        lazy = self._lazy
+        if lazy is not None and name in lazy:
+            return getattr(self, name)
+        return self.__dict__.get(name, default)
+    
+    def set_value(self, name, value):
+        """ Sets the value of the given attribute without recording a change.
+        Subclasses that store attributes elsewhere override this and
+        `get_value()`. """
+        embedded = self.__class__.embedded
+        if embedded is not None:
+            lazy = self._lazy
+            if name in embedded and _is_raw(embedded[name], value):
+                if lazy is None:
+                    lazy = self.document_state().lazy = {}
+                lazy[name] = value
+                self.__dict__.pop(name, None)
+                return
+            if lazy is not None:
+                lazy.pop(name, None)
+        object.__setattr__(self, name, value)
+    
+    def take_contents_from(self, other):
+        """ Makes the receiver use the contents of another instance of the
+        same class. """
+        self.own_storage()
+        self.__dict__.update(other.__dict__)
+        lazy = self._lazy
+        if lazy:
+            for key in other.__dict__:
+                lazy.pop(key, None)
+        if other._lazy:
+            for key, val in other._lazy.items():
+                self.set_value(key, val)
+    
+    def hydrate(self):
+        """ Turns the values of all `embedded` attributes that haven't been
+        read yet into documents. """
+        lazy = self._lazy
+        while lazy:
+            getattr(self, next(iter(lazy)))
+    
+    @stock
     def as_json(self):
-        """ Return the whole document ready to be JSONified. """
-        js = self.__dict__.copy()
-        for key, val in js.items():
-            if isinstance(val, list):
-                js[key] = [j.as_json() if isinstance(j, JSONDocument) else j for j in val]
-            elif isinstance(val, JSONDocument):
-                js[key] = val.as_json()
-        return js
+        """ Return the whole document ready to be JSONified. Adopted documents
+        that haven't been changed return the adopted dictionary, which must
+        not be modified. """
+        state = self._docstate
+        if state is not None and state.shared and not self._lazy:
+            return self.__dict__
+        render = self.json_serializer().render_json
+        if self.__class__.render_cache:
+            return self.cached_render('as_json', None, render, self)
+        if instrumentation.enabled:
+            return instrumentation.timed_serialization(self.__class__, render, self)
+        return render(self)
     
+    @stock
     def for_api(self, omit=None):
         """ Return the whole OR PARTS OF the receiver, as JSON, to be consumed
         by an API.
         
-        :param omit: List or set of key names to omit from the JSON; mostly
-            used by superclasses
-        """
-        js = self.__dict__.copy()
-        if omit is not None:
-            for key in omit:
-                if key in js:
-                    del js[key]
-        for key, val in js.items():
-            if isinstance(val, list):
-                js[key] = [j.for_api() if isinstance(j, JSONDocument) else j for j in val]
-            elif isinstance(val, JSONDocument):
-                js[key] = val.for_api()
+        :param omit: List or set of key names to omit from the JSON, in
+            addition to those in the class' `api_omit`; mostly used by
+            superclasses
+        """
+        render = self.json_serializer().render_api
+        if self.__class__.render_cache:
+            return self.cached_render('for_api', omit, render, self, omit)
+        if instrumentation.enabled:
+            return instrumentation.timed_serialization(self.__class__, render, self, omit)
+        return render(self, omit)
+    
+    @instance_fields
+    def json_fields(self):
+        """ The receiver's top-level fields, with embedded documents and
+        values not yet hydrated left as they are. The returned dictionary must
+        not be modified.
+        """
+        js = self.__dict__
+        if js.get('_id', 0) is None:
+            js = {key: val for key, val in js.items() if '_id' != key}
+        lazy = self._lazy
+        if lazy:
+            js = dict(js)
+            js.update(lazy)
         return js
     
+    def to_json_bytes(self):
+        """ Returns `as_json()` encoded as compact UTF-8 JSON, without
+        creating the intermediate dictionaries. """
+        if self.__class__.render_cache:
+            return self.cached_render('to_json_bytes', None, self.json_serializer().to_json_bytes, self)
+        if instrumentation.enabled:
+            return instrumentation.timed_serialization(self.__class__, self.json_serializer().to_json_bytes, self)
+        return self.json_serializer().to_json_bytes(self)
+    
+    def for_api_bytes(self, omit=None):
+        """ Returns `for_api()` encoded as compact UTF-8 JSON, without
+        creating the intermediate dictionaries. """
+        if self.__class__.render_cache:
+            return self.cached_render('for_api_bytes', omit, self.json_serializer().for_api_bytes, self, omit)
+        if instrumentation.enabled:
+            return instrumentation.timed_serialization(self.__class__, self.json_serializer().for_api_bytes, self, omit)
+        return self.json_serializer().for_api_bytes(self, omit)
+    
+    @classmethod
+    def json_serializer(cls):
+        """ Returns the `Serializer` for this class, created on first use. """
+        ser = cls.__dict__.get('_json_serializer')
+        if ser is None:
+            ser = Serializer(cls)
+            cls._json_serializer = ser
+        return ser
+    
+    def cached_render(self, kind, omit, render, *args):
+        """ Returns the serialized output `render(*args)` produces, from the
+        receiver's cache or the class' `RenderCache` if it's there.
+        
+        :param str kind: The name of the serializing method
+        :param omit: The key names omitted from the output, if any
+        """
+        key = (kind, frozenset(omit) if omit else None)
+        state = self.document_state()
+        rendered = state.rendered
+        if rendered is None:
+            rendered = state.rendered = {}
+            self.watch_embedded()
+        else:
+            found = rendered.get(key)
+            if found is not None:
+                return found
+        
+        cls = self.__class__
+        shared = cls.render_cache if isinstance(cls.render_cache, RenderCache) else None
+        if shared is not None and state.persisted and state.partial is None:
+            self.detect_changes()
+            if state.rendered is not rendered:
+                rendered = state.rendered = {}
+        if shared is not None and state.persisted and not state.changes and state.partial is None:
+            loaded = state.loaded or {}
+            source = {k: v if type(v) in _plain_types else loaded.get(k, v) for k, v in self.json_fields().items()}
+            found = shared.get(cls, self._id, key, source)
+            if found is None:
+                found = instrumentation.timed_serialization(cls, render, *args) if instrumentation.enabled else render(*args)
+                shared.put(cls, self._id, key, found, source)
+        else:
+            found = instrumentation.timed_serialization(cls, render, *args) if instrumentation.enabled else render(*args)
+        if state.rendered is rendered:
+            rendered[key] = found
+        return found
+    
+    def forget_rendered(self):
+        """ Drops the output the class' `RenderCache` holds for the receiver,
+        called after writing it to a server. """
+        cache = self.__class__.render_cache
+        if isinstance(cache, RenderCache) and self._id is not None:
+            cache.invalidate(self.__class__, self._id)
+    
+    def watch_embedded(self):
+        """ Makes the documents embedded in the receiver, however deeply,
+        tell it when they change. """
+        for key, val in self.json_fields().items():
+            _watch(self, key, val)
+    
     def __html__(self):
         """ For compatibility with other libraries, forwards to `for_api()`.
         
@@ -110,6 +452,139 @@ class JSONDocument(object):
         return self.for_api()
     
     
+    # MARK: - Changes
+    
+    def document_state(self):
+        """ Returns the receiver's `DocumentState`, creating it if needed. """
+        state = self._docstate
+        if state is None:
+            state = DocumentState()
+            object.__setattr__(self, '_docstate', state)
+        return state
+    
+    def mark_changed(self, keypath):
+        """ Record that the value at the given attribute name or dotted key
+        path has changed, e.g. after modifying a list in place.
+        """
+        state = self._docstate
+        if state is not None:
+            state.version += 1
+            state.rendered = None
+            if state.persisted:
+                if state.changes is None:
+                    state.changes = set()
+                state.changes.add(keypath)
+            if state.parents is not None:
+                self.notify_parents()
+    
+    def notify_parents(self):
+        """ Marks the key the receiver is embedded under as changed in the
+        documents embedding it. """
+        for parent, key in list(self._docstate.parents.items()):
+            parent.mark_changed(key)
+    
+    def mark_clean(self):
+        """ Forget all changes, called after the receiver has been loaded
+        from or stored to a server.
+        """
+        state = self.document_state()
+        state.changes = None
+        state.persisted = True
+        state.loaded = _snapshot(self.json_fields(), self._lazy)
+    
+    def detect_changes(self):
+        """ Records the top-level values changed in place since the receiver
+        was loaded or stored. """
+        state = self._docstate
+        if state is None or not state.loaded:
+            return
+        fields = self.json_fields()
+        recorded = {keypath.partition('.')[0] for keypath in state.changes} if state.changes else ()
+        for key, old in state.loaded.items():
+            if key in fields and key not in recorded:
+                if serializer.to_json(fields[key]) != old:
+                    self.mark_changed(key)
+    
+    def mark_partial(self, fields):
+        """ Record that the receiver was loaded with only the given fields,
+        None if it has all of them.
+        """
+        self.document_state().partial = frozenset(fields) if fields is not None else None
+    
+    @property
+    def is_partial(self):
+        """ Whether the receiver was loaded with only some of its fields, in
+        which case storing it only ever sends its changes. """
+        state = self._docstate
+        return state is not None and state.partial is not None
+    
+    @property
+    def changes(self):
+        """ The sorted key paths changed since the receiver was loaded or
+        stored, leaving out paths inside other changed paths.
+        """
+        self.detect_changes()
+        state = self._docstate
+        if state is None or state.changes is None:
+            return []
+        changed = state.changes
+        found = []
+        for keypath in sorted(changed):
+            if '_id' == keypath:
+                continue
+            parts = keypath.split('.')
+            if any('.'.join(parts[:i]) in changed for i in range(1, len(parts))):
+                continue
+            found.append(keypath)
+        return found
+    
+    def changed_values(self):
+        """ Returns the changes since the receiver was loaded or stored.
+        
+        :returns: A tuple with a dictionary of new values by key path and a
+            list of key paths that have been removed
+        """
+        values = {}
+        unset = []
+        js = None
+        for keypath in self.changes:
+            if js is None:
+                js = self.as_json()
+            val = value_at_keypath(js, keypath, self)
+            if val is self:
+                unset.append(keypath)
+            else:
+                values[keypath] = val
+        return values, unset
+    
+    def set_keypath(self, keypath, value):
+        """ Set the value at the dotted key path, creating the dictionaries
+        along the way, and record the change of only that path.
+        """
+        attr, _, rest = keypath.partition('.')
+        if not rest:
+            setattr(self, attr, value)
+            return
+        self.own_storage()
+        container = updateDictionaryByKeyPath(self.get_value(attr), rest, value)
+        self.set_value(attr, container)
+        self.mark_changed(keypath)
+    
+    def unset_keypath(self, keypath):
+        """ Remove the value at the dotted key path and record the change.
+        """
+        attr, _, rest = keypath.partition('.')
+        if not rest:
+            if self.get_value(attr, self) is not self:
+                delattr(self, attr)
+            return
+        self.own_storage()
+        container = self.get_value(attr)
+        if isinstance(container, dict):
+            unset_keypath(container, rest)
+            self.mark_changed(keypath)
+    
+    
     # MARK: - Server
     
     @classmethod
@@ -119,24 +594,45 @@ class JSONDocument(object):
         if cls.use_bucket is None:
             raise Exception("I don't yet have a bucket to use for class {}".format(cls))
         return cls.server
-
+    
     def assure_has_server(self):
         return self.__class__.assure_class_has_server()
     
+    @classmethod
+    def assure_class_has_async_server(cls):
+        """ Returns the AsyncJSONServer to use for the async CRUD methods. If
+        the class is only hooked up to a synchronous server, returns the
+        shared thread pool adapter for that server. The adapter is looked up
+        for the current `server` every time, so re-hooking a superclass also
+        switches subclasses that inherit its server.
+        """
+        srv = cls.async_server
+        if srv is None:
+            if cls.server is None:
+                raise Exception("I don't yet have a handle to the server in {}. Use `Class.hookup(JSONServer-instance)`.".format(cls))
+            srv = adapter_for(cls.server)
+        if cls.use_bucket is None:
+            raise Exception("I don't yet have a bucket to use for class {}".format(cls))
+        return srv
+    
     @classmethod
     def hookup(cls, jsonsrv=None, bucket=None):
         """ Sets the bucket/collection to use for instances of this class.
         
-        :param JSONServer jsonsrv: The JSONServer instance to hook this class
-            up to
+        :param jsonsrv: The JSONServer or AsyncJSONServer instance to hook
+            this class up to
         :param str bucket: The bucket/database name to use
         """
-        if cls.server is None and jsonsrv is None:
+        if cls.server is None and cls.async_server is None and jsonsrv is None:
             raise Exception('Need a JSONServer instance')
         if jsonsrv is not None:
-            if not isinstance(jsonsrv, JSONServer):
+            if isinstance(jsonsrv, AsyncJSONServer):
+                cls.async_server = jsonsrv
+            elif isinstance(jsonsrv, JSONServer):
+                cls.server = jsonsrv
+                cls.async_server = None
+            else:
                 raise Exception('Need a JSONServer instance but got {} with bases {}'.format(jsonsrv, jsonsrv.__class__.__bases__))
-            cls.server = jsonsrv
         
         if bucket is not None and len(bucket) > 0:
             cls.use_bucket = bucket
@@ -151,22 +647,117 @@ class JSONDocument(object):
         srv = self.assure_has_server()
         self.load_from(srv, self.__class__.use_bucket)
     
+    @instrumentation.document_operation
     def load_from(self, server, bucket=None):
         """ Loads the receiver's contents from the given server/database and
-        applies the document's contents.
+        applies the document's contents. If the server keeps an identity map
+        that already has an instance for this document, its contents are
+        taken over without asking the database.
         """
         assert server
         if self.id is None:
             raise Exception('Need to have an id to load contents')
         
-        doc = server.load_document(bucket, self.id)
+        if not self.take_cached_from(server, bucket):
+            self.did_load(server.load_document(bucket, self.id), server, bucket)
+    
+    def take_cached_from(self, server, bucket=None):
+        """ Takes over the contents of the instance the server's identity map
+        has for the receiver's id, if there is one.
+        
+        :returns: True if the contents were taken from a cached instance
+        """
+        cached = server.cached_instance(self.__class__, bucket, self.id)
+        if cached is None or cached is self:
+            return False
+        self.take_contents_from(cached)
+        self.mark_clean()
+        self.mark_partial(None)
+        return True
+    
+    def did_load(self, doc, server, bucket=None):
+        """ Called with the document the server returned when loading the
+        receiver, None if there is none. Applies its contents and remembers
+        the receiver in the server's identity map.
+        """
         self.update_with(doc)
+        if doc is not None:
+            self.mark_clean()
+            self.mark_partial(None)
+            server.cache_instance(self, bucket)
+    
+    @classmethod
+    def get(cls, ident):
+        """ Returns a loaded instance for the given document id. If the server
+        keeps an identity map, as `CachingServer` does within an identity
+        scope, repeated calls return the same instance.
         
+        :param str ident: The document id
+        :returns: An instance of the receiver class
+        """
+        srv = cls.assure_class_has_server()
+        return cls.get_from(ident, srv, cls.use_bucket)
+    
+    @classmethod
+    @instrumentation.document_operation
+    def get_from(cls, ident, server, bucket=None):
+        """ Returns a loaded instance for the given document id from the
+        given server/database, see `get()`.
+        """
+        assert server
+        cached = server.cached_instance(cls, bucket, ident)
+        if cached is not None:
+            return cached
+        doc = cls(ident)
+        doc.load_from(server, bucket)
+        return doc
+    
+    @classmethod
+    def load_many(cls, doc_ids):
+        """ Loads the documents with the given ids in as few round trips as
+        the server allows.
+        
+        :param list doc_ids: The ids of the documents to load
+        :returns: A tuple with a list of instances of the receiver class, in
+            the order of `doc_ids`, and a list of the ids that were not found
+        """
+        srv = cls.assure_class_has_server()
+        return cls.load_many_from(doc_ids, srv, cls.use_bucket)
+    
+    @classmethod
+    @instrumentation.document_operation
+    def load_many_from(cls, doc_ids, server, bucket=None):
+        """ Loads the documents with the given ids from the given
+        server/database.
+        
+        :param list doc_ids: The ids of the documents to load
+        :param JSONServer server: The server to use
+        :param str bucket: The bucket/collection to load from
+        :returns: A tuple with a list of instances of the receiver class, in
+            the order of `doc_ids`, and a list of the ids that were not found
+        """
+        assert server
+        doc_ids = list(doc_ids)
+        found = []
+        missing = []
+        for doc_id, doc in zip(doc_ids, server.load_documents(bucket, doc_ids)):
+            if doc is None:
+                missing.append(doc_id)
+            else:
+                instance = cls.adopt(doc) if cls.adopt_documents else cls(doc_id, json=doc)
+                instance.mark_clean()
+                found.append(instance)
+        return found, missing
     
     def update_with(self, doc):
         """ Update the receiver's contents with the supplied document (dict).
         """
         if doc is not None:
+            if self._docstate is None and self.__class__.embedded is None:
+                descriptors = _descriptors(self.__class__)
+                if descriptors is not None and descriptors.isdisjoint(doc):
+                    self.__dict__.update(doc)
+                    return
             for key, val in doc.items():
                 try:
                     setattr(self, key, val)
@@ -179,104 +770,494 @@ class JSONDocument(object):
         implementation of the underlying NoSQL database.
         
         :param documents: Can be a single document/dictionary or a list thereof
-        
-        :todo: This does NOT YET update each document's document id!!
+        :returns: A Future resolving to the list of document ids if the class
+            uses a write-behind queue, the list of document ids otherwise
         """
         srv = cls.assure_class_has_server()
-        cls.insert_to(documents, srv, cls.use_bucket)
+        if cls.write_behind is not None:
+            if not isinstance(documents, (list, tuple)):
+                documents = [documents]
+            queued = [doc if isinstance(doc, dict) else doc.as_json() for doc in documents]
+            future = cls.write_behind.insert(cls.use_bucket, queued)
+            bulkinsert.assign_ids(documents, [doc['_id'] for doc in queued])
+            return future
+        return cls.insert_to(documents, srv, cls.use_bucket)
     
     @classmethod
+    @instrumentation.document_operation
     def insert_to(cls, documents, server, bucket=None):
         """ Insert one or more documents. Forwards to the specific
-        implementation of the underlying NoSQL database.
+        implementation of the underlying NoSQL database, in one call. The
+        ids the server assigns are written back onto the documents.
         
         :param documents: Can be a single document/dictionary or a list thereof
         :param server:    The server to insert to
+        :returns: The list of document ids
+        """
+        if not isinstance(documents, (list, tuple)):
+            documents = [documents]
+        doc_ids = server.add_documents(bucket, [doc if isinstance(doc, dict) else doc.as_json() for doc in documents])
+        bulkinsert.assign_ids(documents, doc_ids)
+        return doc_ids
+    
+    @classmethod
+    def bulk_insert(cls, documents, chunk_size=1000, max_workers=4, on_chunk=None):
+        """ Insert any number of documents in chunks, several at once, see
+        `bulk_insert_to()`.
+        """
+        srv = cls.assure_class_has_server()
+        return cls.bulk_insert_to(documents, srv, cls.use_bucket, chunk_size, max_workers, on_chunk)
+    
+    @classmethod
+    def bulk_insert_to(cls, documents, server, bucket=None, chunk_size=1000, max_workers=4, on_chunk=None):
+        """ Insert documents from a list or generator in chunks of
+        `chunk_size`, writing up to `max_workers` chunks at once. Instances
+        get their ids as soon as their chunk is in.
         
-        :todo: This does NOT YET update each document's document id!!
+        :param documents: An iterable of documents/dictionaries
+        :param server:    The server to insert to
+        :returns: A list with a `bulkinsert.ChunkReport` per chunk
         """
-        doc_ids = server.add_documents(bucket, documents)
+        return bulkinsert.bulk_insert(server, bucket, documents, chunk_size, max_workers, on_chunk)
     
     def store(self):
         """ Store the document.
+        
+        :returns: A Future resolving to the document id if the class uses a
+            write-behind queue, None otherwise
         """
         srv = self.assure_has_server()
+        if self.__class__.write_behind is not None:
+            return self.store_behind(self.__class__.write_behind, self.__class__.use_bucket)
         self.store_to(srv, self.__class__.use_bucket)
     
+    def store_behind(self, queue, bucket=None):
+        """ Queues storing the complete document on the given
+        `WriteBehindQueue`. The receiver counts as stored right away.
+        
+        :returns: A Future resolving to the document id
+        """
+        if self.is_partial:
+            raise Exception("Can't queue storing the partially loaded document \"{}\", it would lose the fields that were not loaded".format(self._id))
+        future = queue.store(bucket, self.as_json())
+        self.forget_rendered()
+        self.mark_clean()
+        return future
+    
+    @instrumentation.document_operation
     def store_to(self, server, bucket=None):
         """ Store the document to the given server. Ensures that the document's
         `id` or `_id` does not change.
         
+        Documents that have been loaded from or stored to a server before
+        only send their changes, using the server's `update_document()`, and
+        don't talk to the server at all if nothing changed. This includes
+        partially loaded documents, so their missing fields are kept. If the
+        server doesn't find the document to update, it's stored completely.
+        
         :param server: The server to insert to
         """
+        state = self._docstate
+        if state is not None and state.persisted:
+            values, unset = self.changed_values()
+            if len(values) == 0 and len(unset) == 0:
+                self.mark_clean()
+                return
+            if server.update_document(bucket, self._id, values, unset) is not False:
+                self.forget_rendered()
+                self.mark_clean()
+                return
         doc_id = server.store_document(bucket, self.as_json())
+        self.did_store(doc_id)
+    
+    def did_store(self, doc_id):
+        """ Called with the document id the server returned after storing the
+        document, raises if it doesn't match the receiver's id.
+        """
         if self._id is not None and str(doc_id) != str(self._id):
             raise Exception("Failed to save document, `id` doesn't match, is \"{}\", should be \"{}\"".format(doc_id, self._id))
         self._id = doc_id
+        self.forget_rendered()
+        self.mark_clean()
     
     def remove(self):
         """ Deletes the document.
+        
+        :returns: A Future if the class uses a write-behind queue, None
+            otherwise
         """
         srv = self.assure_has_server()
+        if self.__class__.write_behind is not None:
+            self.forget_rendered()
+            return self.__class__.write_behind.remove(self.__class__.use_bucket, self._id)
         self.remove_from(srv, self.__class__.use_bucket)
     
+    @instrumentation.document_operation
     def remove_from(self, server, bucket=None):
         """ Deletes the document from the given server.
         """
         server.remove_document(bucket, self._id)
+        self.forget_rendered()
     
     @classmethod
-    def find(cls, dic):
+    def find(cls, dic, fields=None):
         """ Finds the documents identified by the supplied dictionary and
         instantiates documents of the receiver class, returning a list.
         
         :param dict dic: A dictionary containing the query
+        :param list fields: The key paths to load, see `find_on()`
         :returns: A list of instances of the receiver class with documents
             matching the search criteria
         """
         srv = cls.assure_class_has_server()
-        cls.find_on(dic, srv, cls.use_bucket)
+        return cls.find_on(dic, srv, cls.use_bucket, fields=fields)
     
     @classmethod
-    def find_on(cls, dic, server, bucket=None, skip=0, limit=50, sort=None, descending=False):
+    @instrumentation.document_operation
+    def find_on(cls, dic, server, bucket=None, skip=0, limit=50, sort=None, descending=False, fields=None):
         """ Finds the documents identified by the supplied dictionary and
         instantiates documents of the receiver class, returning a list.
         
         :param dict dic: A dictionary containing the query
         :param JSONServer server: The server to use
         :param str bucket: The bucket/collection to search in
+        :param list fields: The key paths to load, in addition to `_id`;
+            None to load whole documents. Instances are flagged as partial
         :returns: A list of instances of the receiver class with documents
             matching the search criteria
         """
         found = []
-        docs_found = server.find(bucket, dic, skip, limit, sort, descending)
+        if fields is None:
+            docs_found = server.find(bucket, dic, skip, limit, sort, descending)
+        else:
+            fields = query.projection_fields(fields)
+            docs_found = server.find(bucket, dic, skip, limit, sort, descending, fields)
         if docs_found is not None:
+            start = None
+            if instrumentation.enabled:
+                # read lazy results first so only instantiation is timed
+                docs_found = list(docs_found)
+                start = time.perf_counter()
             for doc in docs_found:
-                found.append(cls(None, json=doc))
+                found.append(cls.from_found(doc, fields))
+            if start is not None:
+                instrumentation.record_hydration(cls, len(found), time.perf_counter() - start)
         
         return found
+    
+    @classmethod
+    def from_found(cls, doc, fields=None):
+        """ Instantiates a document the server returned from a query, which
+        contains only the given fields if those are not None.
+        """
+        instance = cls.adopt(doc) if cls.adopt_documents else cls(None, json=doc)
+        instance.mark_clean()
+        if fields is not None:
+            instance.mark_partial(fields)
+        return instance
+    
+    @classmethod
+    def find_page(cls, dic, limit=50, sort=None, descending=False, after=None, fields=None):
+        """ Finds one page of the documents identified by the supplied
+        dictionary, see `find_page_on()`.
+        """
+        srv = cls.assure_class_has_server()
+        return cls.find_page_on(dic, srv, cls.use_bucket, limit, sort, descending, after, fields)
+    
+    @classmethod
+    def find_page_on(cls, dic, server, bucket=None, limit=50, sort=None, descending=False, after=None, fields=None):
+        """ Finds one page of the documents identified by the supplied
+        dictionary, using keyset pagination instead of skipping.
+        
+        Results are ordered by `sort`, with `_id` breaking ties. The returned
+        token encodes the position of the last document; passing it back as
+        `after`, with the same query and sort, turns it into a range
+        condition on the sort keys so the server doesn't have to walk past
+        all previous pages.
+        
+        :param dict dic: A dictionary containing the query
+        :param JSONServer server: The server to use
+        :param str bucket: The bucket/collection to search in
+        :param int limit: The number of documents per page
+        :param str after: The token returned with the previous page, None
+            for the first page
+        :param list fields: The key paths to load, see `find_on()`; the sort
+            key paths are always loaded
+        :returns: A tuple of a list of instances of the receiver class and
+            the token for the next page, which is None on the last page
+        """
+        spec = query.page_sort_spec(sort, descending)
+        if after is not None:
+            dic = query.page_query(dic, spec, after, server.native_id)
+        if fields is not None:
+            fields = query.projection_fields(fields)
+            fields = fields + [keypath for keypath, desc in spec if keypath not in fields and '_id' != keypath]
+        sort = [(keypath, -1 if desc else 1) for keypath, desc in spec]
+        found = cls.find_on(dic, server, bucket, 0, limit + 1, sort, False, fields)
+        if len(found) <= limit:
+            return found, None
+        found = found[:limit]
+        return found, query.page_token(found[-1].as_json(), spec)
+    
+    @classmethod
+    def find_iter(cls, dic, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Finds the documents identified by the supplied dictionary and
+        returns a generator over instances of the receiver class, see
+        `find_iter_on()`.
+        """
+        srv = cls.assure_class_has_server()
+        return cls.find_iter_on(dic, srv, cls.use_bucket, batch_size, sort, descending, skip, limit, fields)
+    
+    @classmethod
+    def find_iter_on(cls, dic, server, bucket=None, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Finds the documents identified by the supplied dictionary and
+        returns a generator over instances of the receiver class.
+        
+        Results are pulled from the server in batches and each instance is
+        only created once the consumer gets to it, so memory use is bound by
+        the batch size rather than by the number of results.
+        
+        :param dict dic: A dictionary containing the query
+        :param JSONServer server: The server to use
+        :param str bucket: The bucket/collection to search in
+        :param int batch_size: The number of documents to fetch at once
+        :param int limit: The maximum number of documents, None for all
+        :param list fields: The key paths to load, see `find_on()`
+        :returns: A generator over instances of the receiver class
+        """
+        if fields is None:
+            batches = server.find_batches(bucket, dic, batch_size, sort, descending, skip, limit)
+        else:
+            fields = query.projection_fields(fields)
+            batches = server.find_batches(bucket, dic, batch_size, sort, descending, skip, limit, fields)
+        for batch in batches:
+            for doc in batch:
+                yield cls.from_found(doc, fields)
+    
+    @classmethod
+    def count(cls, dic):
+        """ Counts the documents matching the supplied dictionary without
+        loading them.
+        
+        :param dict dic: A dictionary containing the query
+        :returns: The number of matching documents
+        """
+        srv = cls.assure_class_has_server()
+        return cls.count_on(dic, srv, cls.use_bucket)
+    
+    @classmethod
+    @instrumentation.document_operation
+    def count_on(cls, dic, server, bucket=None):
+        """ Counts the documents matching the supplied dictionary on the given
+        server/database.
+        """
+        return server.count(bucket, dic)
+    
+    
+    # MARK: - Async CRUD Operations
+    
+    async def async_load(self):
+        """ Loads the receiver's contents from database without blocking the
+        event loop, see `load()`.
+        """
+        srv = self.__class__.assure_class_has_async_server()
+        await self.async_load_from(srv, self.__class__.use_bucket)
+    
+    async def async_load_from(self, server, bucket=None):
+        """ Loads the receiver's contents from the given AsyncJSONServer.
+        """
+        assert server
+        if self.id is None:
+            raise Exception('Need to have an id to load contents')
+        
+        if not self.take_cached_from(server, bucket):
+            self.did_load(await server.load_document(bucket, self.id), server, bucket)
+    
+    @classmethod
+    async def async_load_many(cls, doc_ids):
+        """ Loads the documents with the given ids, see `load_many()`.
+        """
+        srv = cls.assure_class_has_async_server()
+        return await cls.async_load_many_from(doc_ids, srv, cls.use_bucket)
+    
+    @classmethod
+    async def async_load_many_from(cls, doc_ids, server, bucket=None):
+        """ Loads the documents with the given ids from the given
+        AsyncJSONServer, see `load_many_from()`.
+        """
+        assert server
+        doc_ids = list(doc_ids)
+        found = []
+        missing = []
+        for doc_id, doc in zip(doc_ids, await server.load_documents(bucket, doc_ids)):
+            if doc is None:
+                missing.append(doc_id)
+            else:
+                instance = cls.adopt(doc) if cls.adopt_documents else cls(doc_id, json=doc)
+                instance.mark_clean()
+                found.append(instance)
+        return found, missing
+    
+    @classmethod
+    async def async_insert(cls, documents):
+        """ Insert one or more documents, see `insert()`.
+        """
+        srv = cls.assure_class_has_async_server()
+        return await cls.async_insert_to(documents, srv, cls.use_bucket)
+    
+    @classmethod
+    async def async_insert_to(cls, documents, server, bucket=None):
+        """ Insert one or more documents into the given AsyncJSONServer, see
+        `insert_to()`.
+        
+        :returns: The list of document ids
+        """
+        if not isinstance(documents, (list, tuple)):
+            documents = [documents]
+        doc_ids = await server.add_documents(bucket, [doc if isinstance(doc, dict) else doc.as_json() for doc in documents])
+        bulkinsert.assign_ids(documents, doc_ids)
+        return doc_ids
+    
+    async def async_store(self):
+        """ Store the document without blocking the event loop, see
+        `store()`.
+        """
+        srv = self.__class__.assure_class_has_async_server()
+        await self.async_store_to(srv, self.__class__.use_bucket)
+    
+    async def async_store_to(self, server, bucket=None):
+        """ Store the document to the given AsyncJSONServer, sending only
+        changes if possible, see `store_to()`.
+        """
+        state = self._docstate
+        if state is not None and state.persisted:
+            values, unset = self.changed_values()
+            if len(values) == 0 and len(unset) == 0:
+                self.mark_clean()
+                return
+            if await server.update_document(bucket, self._id, values, unset) is not False:
+                self.forget_rendered()
+                self.mark_clean()
+                return
+        doc_id = await server.store_document(bucket, self.as_json())
+        self.did_store(doc_id)
+    
+    async def async_remove(self):
+        """ Deletes the document without blocking the event loop.
+        """
+        srv = self.__class__.assure_class_has_async_server()
+        await self.async_remove_from(srv, self.__class__.use_bucket)
+    
+    async def async_remove_from(self, server, bucket=None):
+        """ Deletes the document from the given AsyncJSONServer.
+        """
+        await server.remove_document(bucket, self._id)
+        self.forget_rendered()
+    
+    @classmethod
+    async def async_find(cls, dic, fields=None):
+        """ Finds the documents identified by the supplied dictionary without
+        blocking the event loop, see `find()`.
+        """
+        srv = cls.assure_class_has_async_server()
+        return await cls.async_find_on(dic, srv, cls.use_bucket, fields=fields)
+    
+    @classmethod
+    async def async_find_on(cls, dic, server, bucket=None, skip=0, limit=50, sort=None, descending=False, fields=None):
+        """ Finds the documents identified by the supplied dictionary on the
+        given AsyncJSONServer, see `find_on()`.
+        """
+        found = []
+        if fields is None:
+            docs_found = server.find(bucket, dic, skip, limit, sort, descending)
+        else:
+            fields = query.projection_fields(fields)
+            docs_found = server.find(bucket, dic, skip, limit, sort, descending, fields)
+        async for doc in docs_found:
+            found.append(cls.from_found(doc, fields))
+        
+        return found
+    
+    @classmethod
+    async def async_count(cls, dic):
+        """ Counts the documents matching the supplied dictionary without
+        blocking the event loop, see `count()`.
+        """
+        srv = cls.assure_class_has_async_server()
+        return await srv.count(cls.use_bucket, dic)
 
 
-def updateDictionaryByKeyPath(dictionary, keypath, value):
-    """ Update value at ``keypath``, making sure the dictionary has all the
-    entries needed. If :param:`dictionary` is not a dict it creates a dict
-    with :param:`dictionary` as key and ``1`` as value.
+class JSONDocument(BaseDocument):
+    """ A document keeping its contents in the instance dictionary, so it
+    takes any attributes. See `BaseDocument`.
     """
-    if dictionary is None:
-        dictionary = {}
-    elif type(dictionary) != dict:
-        dictionary = {dictionary: 1}
-    
-    paths = keypath.split('.')
-    if len(paths) > 0:
-        dd = dictionary
-        last = paths.pop()
-        for key in paths:
-            if key not in dd or type(dd[key]) != dict:
-                dd[key] = {}
-            dd = dd[key]
-        
-        dd[last] = value
-    
-    return dictionary
+    __slots__ = ('__dict__', '__weakref__')
+
+
+_plain_types = frozenset((str, int, float, bool, type(None)))
+
+def _snapshot(fields, lazy):
+    """ Copies of the JSON of the values in `fields` that can be changed in
+    place. Values not hydrated yet, in `lazy`, can't be. """
+    loaded = None
+    for key, val in fields.items():
+        if type(val) not in _plain_types and (not lazy or key not in lazy):
+            if loaded is None:
+                loaded = {}
+            loaded[key] = query.copy_json(serializer.to_json(val))
+    return loaded
+
+def _is_raw(spec, value):
+    """ Whether `value` is what a document of the `embedded` spec is loaded
+    from, rather than already hydrated or not hydratable at all. """
+    if isinstance(spec, list):
+        return list is type(value)
+    return dict is type(value)
+
+def _hydrate(spec, value):
+    """ Turns a raw value into the documents the `embedded` spec names. """
+    if isinstance(spec, list):
+        if 1 != len(spec):
+            raise Exception('Need a list with one JSONDocument subclass but got {}'.format(spec))
+        cls = spec[0]
+        return [cls.from_embedded(val) if dict is type(val) else val for val in value]
+    if isinstance(spec, dict):
+        if 1 != len(spec):
+            raise Exception('Need a dictionary with one JSONDocument subclass but got {}'.format(spec))
+        cls = next(iter(spec.values()))
+        return {key: cls.from_embedded(val) if dict is type(val) else val for key, val in value.items()}
+    return spec.from_embedded(value)
+
+_base_set_value = BaseDocument.set_value
+
+def _descriptors(cls):
+    """ Returns the names of the data descriptors, like properties, of a
+    class whose instances keep their attributes in `__dict__`, so
+    `update_with()` can set all other attributes of documents not tracking
+    changes at once. None if setting attributes has to go through
+    `__setattr__()`. Cached on the class. """
+    try:
+        return cls.__dict__['_descriptor_names']
+    except KeyError:
+        pass
+    names = None
+    if cls.__setattr__ is BaseDocument.__setattr__ and cls.set_value is _base_set_value and '__dict__' in dir(cls):
+        names = frozenset(name for name in dir(cls) if hasattr(getattr(cls, name, None), '__set__'))
+    type.__setattr__(cls, '_descriptor_names', names)
+    return names
 
+def _watch(parent, key, value):
+    """ Registers `parent` with the documents embedded in `value`, under the
+    key `value` is found at, and those documents with the ones they embed. """
+    if isinstance(value, BaseDocument):
+        state = value.document_state()
+        if state.parents is None:
+            state.parents = weakref.WeakKeyDictionary()
+        state.parents[parent] = key
+        value.watch_embedded()
+    elif isinstance(value, dict):
+        for val in value.values():
+            _watch(parent, key, val)
+    elif isinstance(value, (list, tuple)):
+        for val in value:
+            _watch(parent, key, val)
@@ -4,13 +4,29 @@
 #  Run with:
 #      python3 -m unittest jsondocument_test.py
 
+import gc
+import json
+import asyncio
+import datetime
 import unittest
 if __package__:
     from .jsondocument import JSONDocument
     from .jsonserver import JSONServer
+    from .asyncserver import AsyncJSONServer
+    from . import asyncserver
+    from .memoryserver import MemoryServer
+    from .cachingserver import CachingServer
+    from .serializer import RenderCache
+    from . import query
 else:
     from jsondocument import JSONDocument
     from jsonserver import JSONServer
+    from asyncserver import AsyncJSONServer
+    import asyncserver
+    from memoryserver import MemoryServer
+    from cachingserver import CachingServer
+    from serializer import RenderCache
+    import query
 
 
 class TestJSONDocument(unittest.TestCase):
@@ -47,6 +63,63 @@ class TestJSONDocument(unittest.TestCase):
         self.assertEqual('test-document', doc.type, 'Must accept document type')
         doc = JSONDocument(None, 'test-document', {})
         self.assertEqual('test-document', doc.type, 'Must accept document type')
+        self.assertIsNone(object.__getattribute__(doc, '_docstate'), 'Must initialize the document state slot')
+        
+        class Guarded(JSONDocument):
+            @property
+            def locked(self):
+                return True
+        
+        doc = Guarded(None, json={'a': 1})
+        doc.update_with({'b': 2})
+        self.assertEqual({'a': 1, 'b': 2}, {k: v for k, v in doc.as_json().items() if '_id' != k})
+        with self.assertRaises(Exception, msg='Must not bypass properties when updating'):
+            doc.update_with({'locked': False})
+    
+    def test_serialize(self):
+        """ Test serializing nested documents to dictionaries and bytes. """
+        class Secretive(JSONDocument):
+            api_omit = {'secret'}
+        class Custom(JSONDocument):
+            def for_api(self, omit=None):
+                return {'custom': True}
+        
+        inner = JSONDocument.from_embedded({'a': 1})
+        doc = Secretive('abc', None, {
+            'list': [inner, [inner], (1, 2)],
+            'dict': {'b': {'c': inner}, 'd': Custom(None)},
+            'secret': 'x',
+            'name': 'Zoë',
+        })
+        js = doc.as_json()
+        self.assertEqual({'a': 1}, js['list'][0])
+        self.assertEqual([{'a': 1}], js['list'][1])
+        self.assertEqual({'a': 1}, js['dict']['b']['c'])
+        self.assertEqual('x', js['secret'])
+        api = doc.for_api(omit={'name'})
+        self.assertNotIn('secret', api)
+        self.assertNotIn('name', api)
+        self.assertEqual({'custom': True}, api['dict']['d'])
+        
+        self.assertEqual(json.loads(doc.to_json_bytes().decode('utf-8')), json.loads(json.dumps(doc.as_json())))
+        self.assertEqual(json.loads(doc.for_api_bytes().decode('utf-8')), doc.for_api())
+        self.assertIn('"name":"Zoë"'.encode('utf-8'), doc.for_api_bytes())
+        self.assertNotIn(b'"name"', doc.for_api_bytes(omit=['name']))
+        self.assertIs(Secretive.json_serializer(), Secretive.json_serializer())
+        self.assertIsNot(Secretive.json_serializer(), JSONDocument.json_serializer())
+        
+        doc.other = object()
+        with self.assertRaises(TypeError):
+            doc.to_json_bytes()
+        
+        class Renamed(JSONDocument):
+            def json_fields(self):
+                return {'renamed': self.__dict__['name']}
+        
+        doc = JSONDocument('abc', json={'name': 'x', 'sub': Renamed(None, json={'name': 'y'})})
+        self.assertEqual({'_id': 'abc', 'name': 'x', 'sub': {'renamed': 'y'}}, doc.as_json(), 'Must use overridden json_fields()')
+        self.assertEqual({'_id': 'abc', 'sub': {'renamed': 'y'}}, doc.for_api(omit=['name']))
+        self.assertEqual(b'{"_id":"abc","name":"x","sub":{"renamed":"y"}}', doc.for_api_bytes())
     
     def test_store_new(self):
         """ Test storing a new document without id. """
@@ -63,10 +136,415 @@ class TestJSONDocument(unittest.TestCase):
         doc.__class__.hookup(MockServer(), 'foo')
         doc.store()
     
+    def test_load_many(self):
+        """ Test loading several documents at once. """
+        server = MemoryServer()
+        server.add_documents('b', [{'_id': 'a', 'n': 1}, {'_id': 'b', 'n': 2}])
+        found, missing = JSONDocument.load_many_from(['b', 'x', 'a'], server, 'b')
+        self.assertEqual(['b', 'a'], [doc.id for doc in found], 'Must return documents in the requested order')
+        self.assertEqual([2, 1], [doc.n for doc in found])
+        self.assertEqual(['x'], missing, 'Must report missing ids')
+        found, missing = JSONDocument.load_many_from(['b', 'x'], MockServer(), 'b')
+        self.assertEqual([], found, 'Must fall back to loading one by one')
+        self.assertEqual(['b', 'x'], missing)
+    
+    def test_async(self):
+        """ Test the async CRUD methods on top of a synchronous server. """
+        class AsyncDocument(JSONDocument):
+            pass
+        
+        server = MemoryServer()
+        AsyncDocument.hookup(server, 'b')
+        
+        async def run():
+            docs = [AsyncDocument(str(i), None, {'n': i}) for i in range(20)]
+            await asyncio.gather(*[doc.async_store() for doc in docs])
+            doc = AsyncDocument('3')
+            await doc.async_load()
+            self.assertEqual(3, doc.n)
+            found = await AsyncDocument.async_find({'n': {'$lt': 5}})
+            self.assertEqual(['0', '1', '2', '3', '4'], sorted(d.id for d in found))
+            await doc.async_remove()
+            found, missing = await AsyncDocument.async_load_many(['2', '3'])
+            self.assertEqual(['3'], missing)
+            embedded = AsyncDocument.from_embedded({'n': 30})
+            ids = await AsyncDocument.async_insert([AsyncDocument('31', None, {'n': 31}), embedded, {'_id': '32'}])
+            self.assertEqual(['31', embedded.id, '32'], ids)
+            self.assertIsNotNone(embedded.id, 'Must write assigned ids back onto instances')
+            single = AsyncDocument.from_embedded({'n': 33})
+            ids = await AsyncDocument.async_insert(single)
+            self.assertEqual([single.id], ids)
+        
+        asyncio.run(run())
+        self.assertEqual(23, len(server.bucket('b')))
+        
+        class SubDocument(AsyncDocument):
+            pass
+        
+        self.assertIs(asyncserver.adapter_for(server), SubDocument.assure_class_has_async_server())
+        other = MemoryServer()
+        AsyncDocument.hookup(other)
+        self.assertIs(asyncserver.adapter_for(other), SubDocument.assure_class_has_async_server(), 'Must follow the server of the superclass')
+        AsyncDocument.hookup(server)
+        del other
+        gc.collect()
+        self.assertEqual(1, len([srv for srv in asyncserver._adapters.keys() if isinstance(srv, MemoryServer)]), 'Must not keep servers alive')
+        
+        caching = CachingServer(server)
+        AsyncDocument.hookup(caching)
+        async def run_scoped():
+            partial = (await AsyncDocument.async_find_on({'n': 2}, asyncserver.adapter_for(caching), 'b', fields=['_id']))[0]
+            self.assertTrue(partial.is_partial)
+            await partial.async_load()
+            self.assertFalse(partial.is_partial, 'Must mark loaded documents complete')
+            self.assertEqual(2, partial.n)
+            server.update_document('b', '2', {'n': 20})
+            doc = AsyncDocument('2')
+            await doc.async_load()
+            self.assertEqual(2, doc.n, 'Must take contents from the identity map')
+            self.assertFalse(doc.is_partial)
+            return partial
+        
+        with caching.identity_scope():
+            partial = asyncio.run(run_scoped())
+            self.assertIs(partial, AsyncDocument.get('2'), 'Must remember async loaded documents in the identity map')
+    
+    def test_caching_server(self):
+        """ Test the caching server's cache and identity map. """
+        backend = MemoryServer()
+        server = CachingServer(backend, max_size=2)
+        server.add_documents('b', [{'_id': 'a', 'n': 1}, {'_id': 'b', 'n': 2}, {'_id': 'c', 'n': 3}])
+        JSONDocument('a').load_from(server, 'b')
+        doc = JSONDocument('a')
+        doc.load_from(server, 'b')
+        self.assertEqual(1, doc.n)
+        self.assertEqual({'hits': 1, 'misses': 1}, {k: v for k, v in server.stats().items() if k in ('hits', 'misses')})
+        
+        doc.n = 5
+        doc.store_to(server, 'b')
+        self.assertEqual(5, JSONDocument.get_from('a', server, 'b').n, 'Must invalidate stored documents')
+        self.assertEqual(2, server.stats()['misses'])
+        
+        server.find('b', {})
+        self.assertEqual(2, server.stats()['size'], 'Must fill the cache from find results up to its size')
+        self.assertEqual(1, server.stats()['evictions'])
+        
+        with server.identity_scope():
+            first = JSONDocument.get_from('b', server, 'b')
+            self.assertIs(first, JSONDocument.get_from('b', server, 'b'), 'Must reuse instances within a scope')
+        self.assertIsNot(first, JSONDocument.get_from('b', server, 'b'))
+        
+        class RacingServer(MemoryServer):
+            def load_document(self, bucket, doc_id):
+                doc = super().load_document(bucket, doc_id)
+                server.update_document(bucket, doc_id, {'n': doc['n'] + 1})
+                return doc
+            
+            def load_documents(self, bucket, doc_ids):
+                return [self.load_document(bucket, doc_id) for doc_id in doc_ids]
+        
+        server = CachingServer(RacingServer())
+        server.add_documents('b', [{'_id': 'a', 'n': 1}])
+        self.assertEqual(1, server.load_document('b', 'a')['n'])
+        self.assertEqual(2, server.load_document('b', 'a')['n'], 'Must not cache documents written to while loading')
+        self.assertEqual([3], [doc['n'] for doc in server.load_documents('b', ['a'])])
+        self.assertEqual(0, server.stats()['size'])
+        self.assertEqual({}, server.loading)
+        
+        server = CachingServer(MemoryServer())
+        server.add_documents('b', [{'_id': 'a', 'n': 1}, {'_id': 'b', 'n': 2}, {'_id': 'c', 'n': 3}])
+        for batch in server.find_batches('b', {}, batch_size=1, sort='n'):
+            if 'a' == batch[0]['_id']:
+                server.update_document('b', 'c', {'n': 4})
+        self.assertEqual([('b', 'a'), ('b', 'b')], list(server.cache.keys()), 'Must only skip caching documents written while finding')
+        server.find('b', {})
+        self.assertEqual(3, server.stats()['size'])
+    
+    def test_partial_store(self):
+        """ Test that stored and loaded documents only send their changes. """
+        server = RecordingServer()
+        doc = JSONDocument('a', None, {'title': 'A', 'meta': {'x': 1}, 'old': True})
+        doc.store_to(server, 'b')
+        self.assertEqual(['store'], [call[0] for call in server.calls], 'Must store new documents completely')
+        
+        doc.store_to(server, 'b')
+        self.assertEqual(1, len(server.calls), 'Must not store unchanged documents')
+        
+        doc.title = 'B'
+        doc.set_keypath('meta.y.z', 2)
+        del doc.old
+        self.assertEqual(['meta.y.z', 'old', 'title'], doc.changes)
+        doc.store_to(server, 'b')
+        self.assertEqual(('update', 'a', {'title': 'B', 'meta.y.z': 2}, ['old']), server.calls[-1])
+        self.assertEqual({'_id': 'a', 'title': 'B', 'meta': {'x': 1, 'y': {'z': 2}}}, server.backend.load_document('b', 'a'))
+        
+        doc.set_keypath('meta.x', 3)
+        doc.meta = {'w': 4}
+        self.assertEqual({'meta': {'w': 4}}, doc.changed_values()[0], 'Must not send changes inside changed paths')
+        doc.set_keypath('meta.q', 5)
+        setattr(doc, 'meta-data', 1)
+        self.assertEqual(['meta', 'meta-data'], doc.changes, 'Must leave out paths inside changed paths sorting apart')
+        
+        loaded = JSONDocument('a')
+        loaded.load_from(server, 'b')
+        self.assertEqual([], loaded.changes, 'Must not consider loaded contents as changed')
+        loaded.unset_keypath('meta.y')
+        loaded.store_to(server, 'b')
+        self.assertEqual(('update', 'a', {}, ['meta.y']), server.calls[-1])
+    
+    def test_store_in_place_changes(self):
+        """ Test that values changed in place are stored. """
+        server = MemoryServer()
+        server.store_document('b', {'_id': 'a', 'meta': {'n': 1}, 'tags': ['a'], 'n': 1})
+        doc = JSONDocument('a')
+        doc.load_from(server, 'b')
+        doc.meta['n'] = 2
+        doc.tags.append('b')
+        self.assertEqual(['meta', 'tags'], doc.changes)
+        doc.store_to(server, 'b')
+        self.assertEqual({'_id': 'a', 'meta': {'n': 2}, 'tags': ['a', 'b'], 'n': 1}, server.load_document('b', 'a'))
+        self.assertEqual([], doc.changes)
+        doc.tags.append('c')
+        doc.store_to(server, 'b')
+        self.assertEqual(['a', 'b', 'c'], server.load_document('b', 'a')['tags'], 'Must compare against the last stored values')
+    
+    def test_store_without_update(self):
+        """ Test storing completely when the server can't find the document
+        to update. """
+        server = UpsertOnlyServer()
+        doc = JSONDocument('a', None, {'n': 1})
+        doc.store_to(server, 'b')
+        doc.n = 2
+        doc.store_to(server, 'b')
+        self.assertEqual({'_id': 'a', 'n': 2}, server.stored['a'])
+        
+        class AsyncUpsertOnlyServer(AsyncJSONServer):
+            def __init__(self):
+                self.stored = {}
+            
+            async def store_document(self, bucket, document):
+                self.stored[document['_id']] = dict(document)
+                return document['_id']
+        
+        async_server = AsyncUpsertOnlyServer()
+        async def run():
+            await doc.async_store_to(async_server, 'b')
+            doc.n = 3
+            await doc.async_store_to(async_server, 'b')
+        asyncio.run(run())
+        self.assertEqual({'_id': 'a', 'n': 3}, async_server.stored['a'])
+    
+    def test_projection(self):
+        """ Test finding partial documents and counting. """
+        server = RecordingServer()
+        server.backend.add_documents('b', [{'_id': str(i), 'title': 'T{}'.format(i), 'body': 'x' * 100, 'meta': {'n': i, 'm': 0}} for i in range(10)])
+        found = JSONDocument.find_on({'meta.n': {'$lt': 3}}, server, 'b', sort='meta.n', fields=['title', 'meta.n'])
+        self.assertEqual(3, len(found))
+        self.assertEqual({'_id': '0', 'title': 'T0', 'meta': {'n': 0}}, found[0].as_json())
+        self.assertTrue(found[0].is_partial)
+        self.assertEqual(10, JSONDocument.count_on({}, server, 'b'))
+        self.assertEqual(3, JSONDocument.count_on({'meta.n': {'$gte': 7}}, server, 'b'))
+        
+        doc = found[0]
+        doc.title = 'New'
+        doc.store_to(server, 'b')
+        self.assertEqual(('update', '0', {'title': 'New'}, []), server.calls[-1], 'Must only send changes of partial documents')
+        self.assertEqual('x' * 100, server.backend.load_document('b', '0')['body'], 'Must not lose fields that were not loaded')
+        doc.load_from(server, 'b')
+        self.assertFalse(doc.is_partial)
+        self.assertEqual(['1', '2'], [d.id for d in JSONDocument.find_iter_on({'meta.n': {'$in': [1, 2]}}, server, 'b', fields={'title': 1})])
+        
+        caching = CachingServer(server.backend)
+        JSONDocument.find_on({}, caching, 'b', fields=['title'])
+        self.assertEqual(0, caching.stats()['size'], 'Must not cache partial documents')
+        self.assertEqual('x' * 100, caching.load_document('b', '1')['body'])
+    
+    def test_adopt(self):
+        """ Test adopting dictionaries as storage, with copy-on-write. """
+        class Adopting(JSONDocument):
+            adopt_documents = True
+        
+        original = {'_id': 'a', 'title': 'T', 'meta': {'n': 1}}
+        doc = Adopting.adopt(original)
+        self.assertEqual('T', doc.title)
+        self.assertIs(original, doc.as_json(), 'Must return the adopted dictionary while unchanged')
+        doc.set_keypath('meta.n', 2)
+        self.assertEqual({'_id': 'a', 'title': 'T', 'meta': {'n': 1}}, original, 'Must copy before changing')
+        self.assertEqual({'_id': 'a', 'title': 'T', 'meta': {'n': 2}}, doc.as_json())
+        
+        original = {'id': 5, 'x': 1}
+        self.assertEqual('5', Adopting.adopt(original).id)
+        self.assertEqual({'id': 5, 'x': 1}, original)
+        JSONDocument(None, json=original)
+        self.assertEqual({'id': 5, 'x': 1}, original, 'Must not remove ids from the dictionary')
+        
+        server = RecordingServer()
+        server.backend.add_documents('b', [{'_id': str(i), 'n': i, 'tags': ['x']} for i in range(3)])
+        found = Adopting.find_on({}, server, 'b', sort='n')
+        self.assertEqual([0, 1, 2], [d.n for d in found])
+        found[1].n = 10
+        del found[1].tags
+        found[1].store_to(server, 'b')
+        self.assertEqual(('update', '1', {'n': 10}, ['tags']), server.calls[-1])
+        self.assertEqual({'_id': '1', 'n': 10}, server.backend.load_document('b', '1'))
+        found, missing = Adopting.load_many_from(['2', 'x'], server, 'b')
+        self.assertEqual(['2'], [d.id for d in found])
+        self.assertIs(found[0].as_json(), found[0].__dict__)
+    
+    def test_render_cache(self):
+        """ Test caching serialized output until documents change. """
+        class Cached(JSONDocument):
+            render_cache = True
+        
+        inner = Cached.from_embedded({'a': 1})
+        deep = Cached.from_embedded({'b': 1})
+        inner.deep = [deep]
+        doc = Cached('x', None, {'list': [inner], 'n': 1})
+        api = doc.for_api()
+        self.assertIs(api, doc.for_api())
+        self.assertIsNot(api, doc.for_api(omit=['n']))
+        doc.n = 2
+        self.assertEqual(2, doc.for_api()['n'])
+        api = doc.for_api()
+        deep.b = 2
+        self.assertIsNot(api, doc.for_api(), 'Must notice changes to embedded documents')
+        self.assertEqual({'_id': 'x', 'list': [{'a': 1, 'deep': [{'b': 2}]}], 'n': 2}, doc.for_api())
+        doc.list = []
+        self.assertEqual([], doc.as_json()['list'])
+        
+        class Shared(JSONDocument):
+            render_cache = RenderCache(max_size=2)
+        
+        server = MemoryServer()
+        server.add_documents('b', [{'_id': str(i), 'n': i} for i in range(3)])
+        def load(doc_id):
+            return Shared.load_many_from([doc_id], server, 'b')[0][0]
+        first = load('1')
+        second = load('1')
+        self.assertIs(first.for_api(), second.for_api(), 'Must share output across instances')
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1}, Shared.render_cache.stats())
+        second.n = 10
+        self.assertEqual(1, first.for_api()['n'])
+        self.assertEqual(10, second.for_api()['n'])
+        second.store_to(server, 'b')
+        self.assertEqual(10, load('1').for_api()['n'], 'Must evict stored documents')
+        server.update_document('b', '1', {'n': 11})
+        self.assertEqual(1, first.for_api()['n'])
+        self.assertEqual(11, load('1').for_api()['n'], 'Must not hand out output of other content')
+        for doc_id in ['0', '2']:
+            load(doc_id).for_api()
+        self.assertEqual(2, Shared.render_cache.stats()['size'])
+    
+    def test_embedded(self):
+        """ Test hydrating embedded documents on first access only. """
+        class Line(JSONDocument):
+            api_omit = {'cost'}
+        
+        class Order(JSONDocument):
+            embedded = {'billing': Line, 'lines': [Line], 'by_sku': {str: Line}}
+        
+        lines = [{'sku': 'a', 'cost': 1}, {'sku': 'b', 'cost': 2}]
+        doc = Order('o', None, {'billing': {'sku': 'x'}, 'lines': lines, 'by_sku': {'a': {'n': 1}}, 'note': 'n'})
+        self.assertNotIn('lines', doc.__dict__, 'Must not hydrate before access')
+        self.assertIs(lines, doc.as_json()['lines'], 'Must pass untouched raw values through')
+        self.assertEqual(b'{"_id":"o","note":"n","billing":{"sku":"x"},"lines":[{"sku":"a","cost":1},{"sku":"b","cost":2}],"by_sku":{"a":{"n":1}}}', doc.to_json_bytes())
+        self.assertIsInstance(doc.billing, Line)
+        self.assertEqual(['a', 'b'], [line.sku for line in doc.lines])
+        self.assertIsInstance(doc.by_sku['a'], Line)
+        self.assertIs(doc.lines, doc.lines, 'Must hydrate only once')
+        self.assertIsNone(doc.lines[0].id)
+        self.assertEqual({'_id': 'o', 'billing': {'sku': 'x'}, 'lines': lines, 'by_sku': {'a': {'n': 1}}, 'note': 'n'}, doc.as_json())
+        self.assertEqual([{'sku': 'a'}, {'sku': 'b'}], Order('p', None, {'lines': lines}).for_api()['lines'], 'Must honor api_omit of embedded classes')
+        
+        server = RecordingServer()
+        Order('q', None, {'lines': lines, 'billing': None, 'by_sku': {}}).store_to(server, 'b')
+        doc = Order.load_many_from(['q'], server, 'b')[0][0]
+        self.assertIsNone(doc.billing)
+        doc.set_keypath('lines', [{'sku': 'c'}])
+        del doc.by_sku
+        doc.store_to(server, 'b')
+        self.assertEqual(('update', 'q', {'lines': [{'sku': 'c'}]}, ['by_sku']), server.calls[-1])
+        self.assertEqual('c', doc.lines[0].sku)
+        
+        doc = Order.load_many_from(['q'], server, 'b')[0][0]
+        doc.lines[0].sku = 'd'
+        self.assertEqual(['lines'], doc.changes, 'Must notice changes to hydrated documents')
+        doc.lines.append(Line.from_embedded({'sku': 'e'}))
+        doc.store_to(server, 'b')
+        self.assertEqual([{'sku': 'd'}, {'sku': 'e'}], server.backend.load_document('b', 'q')['lines'])
+        doc.lines.pop()
+        doc.store_to(server, 'b')
+        self.assertEqual([{'sku': 'd'}], server.backend.load_document('b', 'q')['lines'])
+        
+        class Adopting(Order):
+            adopt_documents = True
+        
+        original = {'_id': 'r', 'lines': lines}
+        doc = Adopting.adopt(original)
+        self.assertEqual({'_id': 'r', 'lines': lines}, doc.as_json())
+        self.assertEqual('b', doc.get_value('lines')[1].sku)
+        doc.lines[1].sku = 'z'
+        self.assertEqual('b', lines[1]['sku'], 'Must not modify adopted dictionaries')
+        self.assertEqual({'_id': 'r', 'lines': [{'sku': 'a', 'cost': 1}, {'sku': 'z', 'cost': 2}]}, doc.as_json())
+    
+    def test_find_page(self):
+        """ Test keyset pagination. """
+        server = MemoryServer()
+        server.add_documents('b', [{'_id': '{:02d}'.format(i), 'n': i % 4 if i % 5 else None, 'm': {'k': i % 3}} for i in range(30)])
+        for sort, descending in [('n', False), ('n', True), ([('n', 1), ('m.k', -1)], False), (None, False), (None, True)]:
+            expected = [d['_id'] for d in server.find('b', {'m.k': {'$ne': 1}}, 0, None, [(k, -1 if d else 1) for k, d in query.page_sort_spec(sort, descending)])]
+            pages = []
+            token = None
+            while True:
+                found, token = JSONDocument.find_page_on({'m.k': {'$ne': 1}}, server, 'b', 7, sort, descending, token, ['m.k'])
+                pages.append([doc.id for doc in found])
+                if token is None:
+                    break
+            self.assertEqual(expected, [doc_id for page in pages for doc_id in page], 'Must walk all pages for sort {} {}'.format(sort, descending))
+            self.assertTrue(all(7 == len(page) for page in pages[:-1]))
+        
+        found, token = JSONDocument.find_page_on({}, server, 'b', 5, 'n')
+        self.assertTrue(found[0].is_partial is False and 'n' in found[0].as_json())
+        with self.assertRaises(Exception, msg='Must reject a token for another sort order'):
+            JSONDocument.find_page_on({}, server, 'b', 5, ['n', 'm.k'], after=token)
+        with self.assertRaises(Exception):
+            JSONDocument.find_page_on({}, server, 'b', 5, 'n', after='not a token')
+        
+        server.add_documents('d', [{'_id': '{:02d}'.format(i), 'at': datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=i)} for i in range(5)])
+        pages = []
+        token = None
+        while True:
+            found, token = JSONDocument.find_page_on({}, server, 'd', 3, 'at', after=token)
+            pages.append([doc.id for doc in found])
+            if token is None:
+                break
+        self.assertEqual([['00', '01', '02'], ['03', '04']], pages, 'Must keep the type of sort values in tokens')
+    
     def test_find_documents(self):
         """ Test finding documents. """
-        # TODO
-        pass
+        class FindDocument(JSONDocument):
+            pass
+        
+        server = MemoryServer()
+        server.add_documents('b', [{'_id': str(i), 'n': i} for i in range(25)])
+        FindDocument.hookup(server, 'b')
+        found = FindDocument.find({'n': {'$lt': 3}})
+        self.assertEqual(['0', '1', '2'], sorted(doc.id for doc in found))
+        
+        batches = []
+        class BatchServer(JSONServer):
+            def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False):
+                batches.append((skip, limit))
+                return server.find(bucket, dictionary, skip, limit, sort, descending)
+        
+        it = FindDocument.find_iter_on({'n': {'$gte': 5}}, BatchServer(), 'b', batch_size=8, sort='n')
+        self.assertEqual([], batches, 'Must not fetch before iterating')
+        first = next(it)
+        self.assertEqual(5, first.n)
+        self.assertEqual([(0, 8)], batches)
+        self.assertEqual(list(range(6, 25)), [doc.n for doc in it])
+        self.assertEqual([(0, 8), (8, 8), (16, 8)], batches)
+        self.assertEqual([20, 21], [doc.n for doc in FindDocument.find_iter({}, batch_size=3, sort='n', skip=20, limit=2)])
 
 
 class MockServer(JSONServer):
@@ -81,4 +559,34 @@ class MockUselessServer(JSONServer):
 
 class WrongMockServer(object):
     pass
+
+class UpsertOnlyServer(JSONServer):
+    def __init__(self):
+        self.stored = {}
+    
+    def store_document(self, bucket, document):
+        self.stored[document['_id']] = dict(document)
+        return document['_id']
+
+class RecordingServer(JSONServer):
+    def __init__(self):
+        self.backend = MemoryServer()
+        self.calls = []
+    
+    def load_document(self, bucket, doc_id):
+        return self.backend.load_document(bucket, doc_id)
+    
+    def store_document(self, bucket, document):
+        self.calls.append(('store', document['_id']))
+        return self.backend.store_document(bucket, document)
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        self.calls.append(('update', doc_id, values, unset))
+        return self.backend.update_document(bucket, doc_id, values, unset)
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        return self.backend.find(bucket, dictionary, skip, limit, sort, descending, fields)
+    
+    def count(self, bucket, dictionary):
+        return self.backend.count(bucket, dictionary)
     
@@ -5,11 +5,27 @@
 #
 #   2014-03-25  Created by Pascal Pfiffner
 
+if __package__:
+    from .query import apply_update
+    from . import idgen
+else:
+    from query import apply_update
+    import idgen
+
 
 class JSONServer(object):
     """ Abstract superclass for NoSQL-style servers.
     """
     
+    id_generator = None
+    """ The `idgen.IdGenerator` making the ids the server keeps best, used
+    for documents of classes hooked up to it that don't name their own, and
+    for documents it stores without id. `idgen.uuid4` if None. """
+    
+    def new_id(self):
+        """ Returns a new document id from `id_generator`. """
+        return (self.id_generator or idgen.uuid4).new_id()
+    
     def load_document(self, bucket, doc_id):
         """ Load an individual document.
         
@@ -19,6 +35,18 @@ class JSONServer(object):
         """
         return None
     
+    def load_documents(self, bucket, doc_ids):
+        """ Load several documents at once. The default implementation loads
+        them one by one, subclasses should fetch them in as few round trips
+        as possible.
+        
+        :param str bucket: The bucket/collection name
+        :param list doc_ids: The document ids
+        :returns: A list with the document for each id, in the order of
+            `doc_ids`, with None for documents that were not found
+        """
+        return [self.load_document(bucket, doc_id) for doc_id in doc_ids]
+    
     def add_documents(self, bucket, documents):
         """ Store one or more documents in the database.
         
@@ -37,6 +65,35 @@ class JSONServer(object):
         """
         return None
     
+    def store_documents(self, bucket, documents):
+        """ Store several complete documents, replacing existing ones with
+        the same id. The default implementation stores them one by one,
+        subclasses should do it in as few round trips as possible.
+        
+        :param str bucket: The bucket/collection name
+        :param list documents: Complete JSON documents
+        :returns: A list with the document id of each document
+        """
+        return [self.store_document(bucket, document) for document in documents]
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        """ Apply a partial update to a document. The default implementation
+        loads the document, applies the changes and stores it again, subclasses
+        should send just the changes.
+        
+        :param str bucket: The bucket/collection name
+        :param str doc_id: The document id
+        :param dict values: New values by dotted key path, like ``$set``
+        :param list unset: Dotted key paths to remove, like ``$unset``
+        :returns: False if the document was not found, in which case
+            `JSONDocument.store_to()` stores it completely
+        """
+        doc = self.load_document(bucket, doc_id)
+        if doc is None:
+            return False
+        self.store_document(bucket, apply_update(doc, values, unset))
+        return True
+    
     def remove_document(self, bucket, doc_id):
         """ Deletes a given document.
         
@@ -45,12 +102,98 @@ class JSONServer(object):
         """
         pass
     
-    def find(self, bucket, dictionary):
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
         """ Find documents.
         
         :param str bucket: The bucket/collection name
         :param dict dictionary: The NoSQL query dictionary
+        :param int skip: The number of matching documents to skip
+        :param int limit: The maximum number of documents to return, None or
+            0 for all
+        :param sort: The key path, or list of key paths, to sort by
+        :param bool descending: Whether to sort in descending order
+        :param list fields: The key paths to return, in addition to `_id`;
+            None for whole documents
         :returns: An iterable over matching results
         """
         return None
+    
+    def count(self, bucket, dictionary):
+        """ Count matching documents. The default implementation walks
+        the results of `find_batches()`, without asking for `fields` since
+        servers that don't count themselves may not know it; subclasses
+        should let the database count.
+        
+        :param str bucket: The bucket/collection name
+        :param dict dictionary: The NoSQL query dictionary
+        :returns: The number of matching documents
+        """
+        return sum(len(batch) for batch in self.find_batches(bucket, dictionary, 1000))
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Find documents and return them in batches, so callers can walk
+        large result sets without holding all of them in memory. The default
+        implementation runs `find()` once per batch, subclasses should keep
+        one cursor open instead.
+        
+        :param int batch_size: The number of documents per batch
+        :returns: An iterator over lists of at most `batch_size` documents
+        """
+        fetched = 0
+        while limit is None or fetched < limit:
+            size = batch_size if limit is None else min(batch_size, limit - fetched)
+            if fields is None:
+                batch = list(self.find(bucket, dictionary, skip + fetched, size, sort, descending) or [])
+            else:
+                batch = list(self.find(bucket, dictionary, skip + fetched, size, sort, descending, fields) or [])
+            if len(batch) > 0:
+                yield batch
+            if len(batch) < size:
+                break
+            fetched += len(batch)
+    
+    def changes(self, since=0, bucket=None, limit=None):
+        """ Returns the writes made after the given sequence number, for
+        servers that keep a change feed, see `changefeed.ChangeFeedServer`.
+        
+        :param int since: The sequence number of the last change seen, 0 for
+            all
+        :param str bucket: The bucket to return changes of, None for all
+        :param int limit: The maximum number of changes to return
+        :returns: A list of `changefeed.ChangeEvent`, oldest first
+        """
+        raise Exception('{} keeps no change feed, wrap it in a ChangeFeedServer'.format(self.__class__.__name__))
+    
+    def last_sequence(self):
+        """ Returns the sequence number of the latest change in the feed. """
+        raise Exception('{} keeps no change feed, wrap it in a ChangeFeedServer'.format(self.__class__.__name__))
+    
+    def native_id(self, doc_id):
+        """ Converts a document id that went through JSON, e.g. in a page
+        token, back to the type the server keeps ids in.
+        
+        :param doc_id: The id as a JSON value
+        :returns: The id the way the server stores it
+        """
+        return doc_id
+    
+    def cached_instance(self, cls, bucket, doc_id):
+        """ Servers keeping an identity map return the instance of `cls` that
+        was already loaded for the given document id.
+        
+        :param type cls: The JSONDocument subclass
+        :param str bucket: The bucket/collection name
+        :param str doc_id: The document id
+        :returns: The JSONDocument instance, or None
+        """
+        return None
+    
+    def cache_instance(self, instance, bucket):
+        """ Servers keeping an identity map remember the given, loaded
+        JSONDocument instance.
+        
+        :param JSONDocument instance: The document instance
+        :param str bucket: The bucket/collection name
+        """
+        pass
 
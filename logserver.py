@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   An append-only, log-structured file server to be used with JSONDocument
+#   subclasses
+
+import os
+import re
+import json
+import logging
+import threading
+
+if __package__:
+    from .jsonserver import JSONServer
+    from . import query
+else:
+    from jsonserver import JSONServer
+    import query
+
+
+class LogBucket(object):
+    """ One bucket of a `LogServer`: a JSONL segment file that only ever gets
+    appended to, and an in-memory index of the offset and length of each
+    document's latest record.
+    """
+    
+    def __init__(self, directory, name):
+        if not name or os.sep in name or name.startswith('.'):
+            raise Exception('Invalid bucket name "{}"'.format(name))
+        self.directory = directory
+        self.name = name
+        self.lock = threading.RLock()
+        self.compact_lock = threading.Lock()
+        self.offsets = {}
+        self.dead = 0
+        self.size = 0
+        self.segment = 0
+        self.writer = None
+        self.reader = None
+        self.compacting = False
+        self.open()
+    
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '{}.{:06d}.jsonl'.format(self.name, segment))
+    
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, '{}.idx'.format(self.name))
+    
+    def open(self):
+        """ Opens the newest segment and restores the offset index, from the
+        sidecar index file if there is one for this segment, and by scanning
+        whatever was appended to the segment after the index was written.
+        """
+        pattern = re.compile(r'^{}\.(\d+)\.jsonl$'.format(re.escape(self.name)))
+        segments = sorted(int(m.group(1)) for m in (pattern.match(f) for f in os.listdir(self.directory)) if m)
+        self.segment = segments[-1] if len(segments) > 0 else 0
+        for old in segments[:-1]:
+            os.remove(self.segment_path(old))
+        for segment in segments:
+            if os.path.exists(self.segment_path(segment + 1) + '.tmp'):
+                os.remove(self.segment_path(segment + 1) + '.tmp')
+        
+        path = self.segment_path(self.segment)
+        self.writer = open(path, 'ab')
+        self.reader = open(path, 'rb')
+        self.offsets = {}
+        self.dead = 0
+        self.size = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as handle:
+                sidecar = json.load(handle)
+            if sidecar.get('segment') == self.segment and sidecar.get('size', 0) <= os.path.getsize(path) and isinstance(sidecar.get('offsets'), list):
+                self.offsets = {doc_id: (offset, length) for doc_id, offset, length in sidecar['offsets']}
+                self.dead = sidecar.get('dead', 0)
+                self.size = sidecar['size']
+        self.scan(self.size)
+    
+    def scan(self, start):
+        """ Index all records from `start` to the end of the segment. A
+        truncated last record, as left behind by a crash, is cut off.
+        """
+        self.reader.seek(start)
+        offset = start
+        for line in self.reader:
+            if not line.endswith(b'\n'):
+                self.writer.truncate(offset)
+                break
+            self.apply(json.loads(line.decode('utf-8')), offset, len(line))
+            offset += len(line)
+        self.size = offset
+    
+    def apply(self, record, offset, length):
+        doc_id = record['_id']
+        previous = self.offsets.pop(doc_id, None)
+        if previous is not None:
+            self.dead += previous[1]
+        if 'put' == record['op']:
+            self.offsets[doc_id] = (offset, length)
+        else:
+            self.dead += length
+    
+    def append(self, records, sync=False):
+        """ Appends the records to the segment and indexes them.
+        """
+        with self.lock:
+            lines = [(json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8') for record in records]
+            self.writer.write(b''.join(lines))
+            self.writer.flush()
+            if sync:
+                os.fsync(self.writer.fileno())
+            for record, line in zip(records, lines):
+                self.apply(record, self.size, len(line))
+                self.size += len(line)
+    
+    def read(self, doc_id):
+        """ Returns the document's latest version with one seek and read.
+        """
+        with self.lock:
+            entry = self.offsets.get(doc_id)
+            if entry is None:
+                return None
+            self.reader.seek(entry[0])
+            return json.loads(self.reader.read(entry[1]).decode('utf-8'))['doc']
+    
+    def write_index(self):
+        """ Writes the sidecar index file so the next `open()` doesn't have to
+        scan the whole segment.
+        """
+        with self.lock:
+            sidecar = {
+                'segment': self.segment,
+                'size': self.size,
+                'dead': self.dead,
+                'offsets': [[doc_id, offset, length] for doc_id, (offset, length) in self.offsets.items()],
+            }
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as handle:
+                json.dump(sidecar, handle, separators=(',', ':'))
+            os.replace(tmp, self.index_path)
+    
+    def compact(self):
+        """ Rewrites all live records into a fresh segment, then drops the
+        old one. The live records are copied without holding the lock, so
+        reads and writes go on meanwhile; the lock is only taken to copy
+        what was appended in the meantime and to switch segments.
+        """
+        with self.compact_lock:
+            with self.lock:
+                entries = list(self.offsets.items())
+                end = self.size
+                old = self.segment_path(self.segment)
+            segment = self.segment + 1
+            path = self.segment_path(segment)
+            tmp = path + '.tmp'
+            offsets = {}
+            offset = 0
+            with open(old, 'rb') as source, open(tmp, 'wb') as handle:
+                for doc_id, entry in entries:
+                    source.seek(entry[0])
+                    line = source.read(entry[1])
+                    handle.write(line)
+                    offsets[doc_id] = (offset, len(line))
+                    offset += len(line)
+                handle.flush()
+                
+                with self.lock:
+                    source.seek(end)
+                    handle.write(source.read(self.size - end))
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                    os.replace(tmp, path)
+                    
+                    self.close()
+                    self.segment = segment
+                    self.writer = open(path, 'ab')
+                    self.reader = open(path, 'rb')
+                    self.offsets = offsets
+                    self.dead = 0
+                    self.scan(offset)
+                    self.write_index()
+            os.remove(old)
+    
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+
+class LogServer(JSONServer):
+    """ A server persisting documents to append-only JSONL segment files, one
+    per bucket, in the given directory.
+    
+    Every write appends a record, so write throughput is bound by sequential
+    I/O. An in-memory index of record offsets makes loading a document a single
+    seek and read. Superseded and removed records are dropped by `compact()`,
+    which runs in a background thread once dead records take up more than
+    `compact_ratio` of a segment larger than `compact_min_size` bytes.
+    
+    Call `close()` when done, which writes sidecar index files from which the
+    offset index is restored on the next start without rescanning the log.
+    """
+    
+    def __init__(self, directory, compact_ratio=0.5, compact_min_size=4*1024*1024, sync=False):
+        """
+        :param str directory: The directory to keep segment files in
+        :param float compact_ratio: Compact when this fraction of a segment is
+            dead records; None to only compact when asked to
+        :param int compact_min_size: Don't compact segments smaller than this
+        :param bool sync: Whether to fsync after every write
+        """
+        super().__init__()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.sync = sync
+        self.buckets = {}
+        self.lock = threading.Lock()
+    
+    def bucket(self, bucket=None):
+        """ Returns the `LogBucket` for the given bucket name.
+        """
+        if not bucket:
+            bucket = 'default'
+        with self.lock:
+            if bucket not in self.buckets:
+                self.buckets[bucket] = LogBucket(self.directory, bucket)
+            return self.buckets[bucket]
+    
+    def compact(self, bucket=None):
+        """ Compacts the given bucket, or all open buckets if None.
+        """
+        buckets = [self.bucket(bucket)] if bucket else list(self.buckets.values())
+        for log in buckets:
+            log.compact()
+    
+    def close(self):
+        """ Writes sidecar index files and closes all segment files.
+        """
+        with self.lock:
+            for log in self.buckets.values():
+                with log.lock:
+                    log.write_index()
+                    log.close()
+            self.buckets = {}
+    
+    
+    # MARK: - Overrides
+    
+    def load_document(self, bucket, doc_id):
+        if not doc_id:
+            raise Exception('Need a doc_id to load a document')
+        return self.bucket(bucket).read(doc_id)
+    
+    def add_documents(self, bucket, documents):
+        if isinstance(documents, dict):
+            documents = [documents]
+        log = self.bucket(bucket)
+        with log.lock:
+            for doc in documents:
+                if '_id' in doc and doc['_id'] in log.offsets:
+                    raise Exception('A document with id "{}" already exists'.format(doc['_id']))
+            for doc in documents:
+                if doc.get('_id') is None:
+                    doc['_id'] = self.new_id()
+            self._append(log, [{'op': 'put', '_id': doc['_id'], 'doc': doc} for doc in documents])
+        return [doc['_id'] for doc in documents]
+    
+    def store_document(self, bucket, document):
+        if document.get('_id') is None:
+            document = dict(document)
+            document['_id'] = self.new_id()
+        self._append(self.bucket(bucket), [{'op': 'put', '_id': document['_id'], 'doc': document}])
+        return document['_id']
+    
+    def store_documents(self, bucket, documents):
+        """ Appends all documents with a single write. """
+        records = []
+        for document in documents:
+            if document.get('_id') is None:
+                document = dict(document)
+                document['_id'] = self.new_id()
+            records.append({'op': 'put', '_id': document['_id'], 'doc': document})
+        if len(records) > 0:
+            self._append(self.bucket(bucket), records)
+        return [record['_id'] for record in records]
+    
+    def remove_document(self, bucket, doc_id):
+        if not doc_id:
+            raise Exception('Need a doc_id to remove a document')
+        log = self.bucket(bucket)
+        with log.lock:
+            if doc_id in log.offsets:
+                self._append(log, [{'op': 'del', '_id': doc_id}])
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        """ Finds documents by reading every live record of the bucket.
+        """
+        log = self.bucket(bucket)
+        with log.lock:
+            doc_ids = list(log.offsets.keys())
+        spec = query.sort_spec(sort, descending)
+        skip = skip or 0
+        end = skip + limit if limit else None
+        found = []
+        for doc_id in doc_ids:
+            doc = log.read(doc_id)
+            if doc is not None and query.matches(doc, dictionary):
+                found.append(doc)
+                if 0 == len(spec) and end is not None and len(found) >= end:
+                    break
+        query.sort_documents(found, spec)
+        found = found[skip:end]
+        if fields is not None:
+            fields = query.projection_fields(fields)
+            found = [query.project(doc, fields) for doc in found]
+        return found
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Reads the bucket once. Unsorted results are streamed, sorted ones
+        need all matching documents in memory.
+        """
+        if sort is not None:
+            found = self.find(bucket, dictionary, skip, limit, sort, descending, fields)
+            for i in range(0, len(found), batch_size):
+                yield found[i:i + batch_size]
+            return
+        
+        log = self.bucket(bucket)
+        with log.lock:
+            doc_ids = list(log.offsets.keys())
+        skip = skip or 0
+        remaining = limit or None
+        fields = query.projection_fields(fields)
+        batch = []
+        for doc_id in doc_ids:
+            doc = log.read(doc_id)
+            if doc is None or not query.matches(doc, dictionary):
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            batch.append(doc if fields is None else query.project(doc, fields))
+            if remaining is not None:
+                remaining -= 1
+            if len(batch) >= batch_size or 0 == remaining:
+                yield batch
+                batch = []
+                if 0 == remaining:
+                    return
+        if len(batch) > 0:
+            yield batch
+    
+    def count(self, bucket, dictionary):
+        log = self.bucket(bucket)
+        if not dictionary:
+            return len(log.offsets)
+        with log.lock:
+            doc_ids = list(log.offsets.keys())
+        found = 0
+        for doc_id in doc_ids:
+            doc = log.read(doc_id)
+            if doc is not None and query.matches(doc, dictionary):
+                found += 1
+        return found
+    
+    
+    # MARK: - Internals
+    
+    def _append(self, log, records):
+        log.append(records, self.sync)
+        if self.compact_ratio is not None and not log.compacting \
+            and log.size >= self.compact_min_size and log.dead > self.compact_ratio * log.size:
+            log.compacting = True
+            threading.Thread(target=self._compact_in_background, args=(log,), daemon=True).start()
+    
+    def _compact_in_background(self, log):
+        try:
+            log.compact()
+        except Exception as e:
+            logging.error("Failed to compact bucket \"{}\": {}".format(log.name, e))
+        finally:
+            log.compacting = False
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest logserver_test.py
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+if __package__:
+    from .logserver import LogServer
+    from . import logserver
+else:
+    from logserver import LogServer
+    import logserver
+
+
+class TestLogServer(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_crud(self):
+        """ Test storing, loading and removing documents. """
+        server = LogServer(self.directory, compact_ratio=None)
+        self.assertEqual(['1', '2'], server.add_documents('b', [{'_id': '1', 'a': 1}, {'_id': '2', 'a': 2}]))
+        with self.assertRaises(Exception, msg="Must not add a document with an existing id"):
+            server.add_documents('b', [{'_id': '1'}])
+        server.store_document('b', {'_id': '1', 'a': 3})
+        server.remove_document('b', '2')
+        self.assertEqual({'_id': '1', 'a': 3}, server.load_document('b', '1'))
+        self.assertIsNone(server.load_document('b', '2'))
+        self.assertEqual(['1'], [d['_id'] for d in server.find('b', {'a': {'$gt': 1}})])
+    
+    def test_reopen(self):
+        """ Test restoring the index, with and without sidecar file. """
+        server = LogServer(self.directory, compact_ratio=None)
+        server.store_document('b', {'_id': '1', 'a': 1})
+        server.store_document('b', {'_id': '2', 'a': 2})
+        server.close()
+        
+        server = LogServer(self.directory, compact_ratio=None)
+        self.assertEqual(2, len(server.bucket('b').offsets), 'Must restore the index from the sidecar file')
+        server.store_document('b', {'_id': '3', 'a': 3})
+        server.remove_document('b', '1')
+        server.bucket('b').writer.close()       # crash: sidecar file is stale
+        
+        server = LogServer(self.directory, compact_ratio=None)
+        self.assertIsNone(server.load_document('b', '1'))
+        self.assertEqual(3, server.load_document('b', '3')['a'], 'Must scan records appended after the sidecar was written')
+        server.close()
+        
+        os.remove(os.path.join(self.directory, 'b.idx'))
+        server = LogServer(self.directory, compact_ratio=None)
+        self.assertEqual(['2', '3'], sorted(server.bucket('b').offsets.keys()), 'Must rebuild the index by scanning')
+        server.store_document('n', {'_id': 7, 'a': 7})
+        server.close()
+        
+        server = LogServer(self.directory, compact_ratio=None)
+        self.assertEqual(1, len(server.bucket('n').offsets))
+        self.assertEqual({'_id': 7, 'a': 7}, server.load_document('n', 7), 'Must keep id types in the sidecar file')
+        server.close()
+    
+    def test_compact(self):
+        """ Test that compaction drops dead records but keeps live ones. """
+        server = LogServer(self.directory, compact_ratio=None)
+        for i in range(10):
+            server.store_document('b', {'_id': 'x', 'i': i})
+        server.store_document('b', {'_id': 'y'})
+        server.remove_document('b', 'y')
+        log = server.bucket('b')
+        size = log.size
+        server.compact('b')
+        self.assertLess(log.size, size)
+        self.assertEqual(0, log.dead)
+        self.assertEqual(9, server.load_document('b', 'x')['i'])
+        self.assertEqual(['b.000001.jsonl', 'b.idx'], sorted(os.listdir(self.directory)))
+        server.close()
+        server = LogServer(self.directory, compact_ratio=None)
+        self.assertEqual(9, server.load_document('b', 'x')['i'])
+        self.assertIsNone(server.load_document('b', 'y'))
+    
+    def test_compact_while_writing(self):
+        """ Test that writes made while compaction copies records survive. """
+        server = LogServer(self.directory, compact_ratio=None)
+        for i in range(1, 11):
+            server.store_document('b', {'_id': i, 'i': i})
+        server.remove_document('b', 1)
+        real_open = open
+        def opening(path, mode='r', *args, **kwargs):
+            if 'rb' == mode and path.endswith('.000000.jsonl'):
+                server.store_document('b', {'_id': 2, 'i': 100})
+                server.remove_document('b', 3)
+                server.store_document('b', {'_id': 11, 'i': 11})
+            return real_open(path, mode, *args, **kwargs)
+        with mock.patch.object(logserver, 'open', opening, create=True):
+            server.compact('b')
+        for reopen in (False, True):
+            if reopen:
+                server.close()
+                server = LogServer(self.directory, compact_ratio=None)
+            self.assertEqual([2, 4, 5, 6, 7, 8, 9, 10, 11], sorted(server.bucket('b').offsets.keys()))
+            self.assertEqual(100, server.load_document('b', 2)['i'], 'Must keep writes made while compacting')
+            self.assertIsNone(server.load_document('b', 3))
+            self.assertEqual(11, server.load_document('b', 11)['i'])
+        server.close()
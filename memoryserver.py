@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   An in-memory server with secondary indexes, to be used with JSONDocument
+#   subclasses
+
+import bisect
+import threading
+
+if __package__:
+    from .jsonserver import JSONServer
+    from . import query
+else:
+    from jsonserver import JSONServer
+    import query
+
+
+class HashIndex(object):
+    """ Maps the values found at a keypath to the ids of the documents holding
+    them. Answers equality and ``$in`` queries.
+    
+    Index lookups return candidates only, documents are always matched against
+    the full query afterwards.
+    """
+    
+    def __init__(self, keypath):
+        self.keypath = keypath
+        self.entries = {}
+        self.unindexed = set()
+    
+    def keys_for(self, document):
+        val = query.value_at_keypath(document, self.keypath)
+        if isinstance(val, list):
+            return [query.sort_key(v) for v in val] + [query.sort_key(val)]
+        return [query.sort_key(val)]
+    
+    def add(self, doc_id, document):
+        try:
+            for key in self.keys_for(document):
+                self.entries.setdefault(key, set()).add(doc_id)
+        except TypeError:
+            self.unindexed.add(doc_id)
+    
+    def remove(self, doc_id, document):
+        if doc_id in self.unindexed:
+            self.unindexed.discard(doc_id)
+        try:
+            for key in self.keys_for(document):
+                ids = self.entries.get(key)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if 0 == len(ids):
+                        del self.entries[key]
+        except TypeError:
+            pass
+    
+    def lookup(self, values):
+        """ Return the set of ids of documents that may hold any of the given
+        values, None if the index can't tell.
+        """
+        found = set(self.unindexed)
+        try:
+            for val in values:
+                found.update(self.entries.get(query.sort_key(val), ()))
+        except TypeError:
+            return None
+        return found
+    
+    def lookup_range(self, ops):
+        return None
+
+
+class SortedIndex(object):
+    """ Keeps the ids of all documents ordered by the value at a keypath.
+    Answers equality and range queries and can produce documents in sort order.
+    
+    Arrays are indexed once per element, missing values and empty arrays are
+    indexed as null. Entries live in a list of short sorted runs so inserts
+    and removals don't have to move the whole index around. `arrays` counts
+    the documents indexed under more than one key.
+    """
+    
+    run_length = 1000
+    
+    def __init__(self, keypath):
+        self.keypath = keypath
+        self.keys = []
+        self.ids = []
+        self.maxes = []
+        self.arrays = 0
+    
+    def keys_for(self, document):
+        val = query.value_at_keypath(document, self.keypath)
+        if isinstance(val, list):
+            if len(val) > 0:
+                return set(query.sort_key(v) for v in val)
+            val = None
+        return [query.sort_key(val)]
+    
+    def build(self, documents):
+        """ Index all documents from scratch, faster than adding one by one.
+        
+        :param documents: An iterable of ``(doc_id, document)`` tuples
+        """
+        pairs = []
+        arrays = 0
+        for doc_id, document in documents:
+            keys = self.keys_for(document)
+            if len(keys) > 1:
+                arrays += 1
+            for key in keys:
+                pairs.append((key, doc_id))
+        pairs.sort(key=lambda pair: pair[0])
+        self.keys = []
+        self.ids = []
+        self.maxes = []
+        self.arrays = arrays
+        for i in range(0, len(pairs), self.run_length):
+            run = pairs[i:i + self.run_length]
+            self.keys.append([pair[0] for pair in run])
+            self.ids.append([pair[1] for pair in run])
+            self.maxes.append(run[-1][0])
+    
+    def add(self, doc_id, document):
+        keys = self.keys_for(document)
+        if len(keys) > 1:
+            self.arrays += 1
+        for key in keys:
+            if 0 == len(self.maxes):
+                self.keys.append([key])
+                self.ids.append([doc_id])
+                self.maxes.append(key)
+                continue
+            
+            i = min(bisect.bisect_right(self.maxes, key), len(self.maxes) - 1)
+            keys = self.keys[i]
+            pos = bisect.bisect_right(keys, key)
+            keys.insert(pos, key)
+            self.ids[i].insert(pos, doc_id)
+            self.maxes[i] = keys[-1]
+            if len(keys) > 2 * self.run_length:
+                half = self.run_length
+                self.keys[i:i + 1] = [keys[:half], keys[half:]]
+                ids = self.ids[i]
+                self.ids[i:i + 1] = [ids[:half], ids[half:]]
+                self.maxes[i:i + 1] = [keys[half - 1], keys[-1]]
+    
+    def remove(self, doc_id, document):
+        keys = self.keys_for(document)
+        if len(keys) > 1:
+            self.arrays -= 1
+        for key in keys:
+            i, pos = self.position(key)
+            while i < len(self.keys):
+                keys = self.keys[i]
+                if pos >= len(keys):
+                    i += 1
+                    pos = 0
+                    continue
+                if keys[pos] != key:
+                    break
+                if self.ids[i][pos] == doc_id:
+                    del keys[pos]
+                    del self.ids[i][pos]
+                    if 0 == len(keys):
+                        del self.keys[i]
+                        del self.ids[i]
+                        del self.maxes[i]
+                    else:
+                        self.maxes[i] = keys[-1]
+                    break
+                pos += 1
+    
+    def position(self, key, after=False):
+        """ The ``(run, offset)`` position of the first entry not smaller than
+        `key`, or the first entry larger than `key` if `after` is true.
+        """
+        find = bisect.bisect_right if after else bisect.bisect_left
+        i = find(self.maxes, key)
+        if i >= len(self.maxes):
+            return (len(self.maxes), 0)
+        return (i, find(self.keys[i], key))
+    
+    def ids_between(self, start, stop, descending=False):
+        """ Iterate over the ids between the two positions, in index order.
+        """
+        if start >= stop:
+            return
+        if descending:
+            i, pos = stop
+            while (i, pos) > start:
+                if 0 == pos:
+                    i -= 1
+                    pos = len(self.ids[i])
+                    continue
+                pos -= 1
+                if (i, pos) < start:
+                    break
+                yield self.ids[i][pos]
+        else:
+            i, pos = start
+            while (i, pos) < stop:
+                ids = self.ids[i]
+                if pos >= len(ids):
+                    i += 1
+                    pos = 0
+                    continue
+                yield ids[pos]
+                pos += 1
+    
+    def bounds(self, cond):
+        """ Return the start and stop positions of entries satisfying an
+        equality or range condition, None if the condition can't be answered
+        by the index. Ranges only cover values of their own type bracket, like
+        MongoDB does.
+        """
+        if not query.is_operator_condition(cond):
+            cond = {'$eq': cond}
+        
+        start = stop = None
+        rank = None
+        for op, arg in cond.items():
+            if op not in ('$eq', '$gt', '$gte', '$lt', '$lte'):
+                continue
+            if isinstance(arg, (list, dict)):
+                return None
+            key = query.sort_key(arg)
+            if rank is not None and rank != key[0]:
+                return ((0, 0), (0, 0))
+            rank = key[0]
+            if op in ('$eq', '$gt', '$gte'):
+                pos = self.position(key, '$gt' == op)
+                start = pos if start is None else max(start, pos)
+            if op in ('$eq', '$lt', '$lte'):
+                pos = self.position(key, '$lt' != op)
+                stop = pos if stop is None else min(stop, pos)
+        if rank is None:
+            return None
+        if start is None:
+            start = self.position((rank,))
+        if stop is None:
+            stop = self.position((rank + 1,))
+        return (start, stop)
+    
+    def lookup(self, values):
+        found = set()
+        for val in values:
+            bounds = self.bounds({'$eq': val})
+            if bounds is None:
+                return None
+            found.update(self.ids_between(*bounds))
+        return found
+    
+    def lookup_range(self, ops):
+        bounds = self.bounds(ops)
+        if bounds is None:
+            return None
+        return set(self.ids_between(*bounds))
+    
+    def ordered_ids(self, descending=False, bounds=None):
+        """ Iterate over document ids in index order, each id only once. For
+        arrays the first occurrence is the smallest element when ascending and
+        the largest when descending.
+        """
+        if bounds is None:
+            bounds = ((0, 0), (len(self.maxes), 0))
+        seen = set()
+        for doc_id in self.ids_between(bounds[0], bounds[1], descending):
+            if doc_id not in seen:
+                seen.add(doc_id)
+                yield doc_id
+
+
+class MemoryServer(JSONServer):
+    """ A server keeping all documents in memory.
+    
+    Buckets are dictionaries keyed by document id. Declare secondary indexes
+    with `create_index()` to avoid scanning a whole bucket in `find()`: hash
+    indexes answer equality and ``$in`` queries, sorted indexes additionally
+    answer range queries and sorting.
+    
+    Documents are copied when going in and out so callers can't alter stored
+    contents by accident.
+    """
+    
+    index_kinds = {
+        'hash': HashIndex,
+        'sorted': SortedIndex,
+    }
+    
+    def __init__(self):
+        super().__init__()
+        self.buckets = {}
+        self.indexes = {}
+        self.lock = threading.RLock()
+    
+    def bucket(self, bucket=None):
+        """ Returns the dictionary holding the given bucket's documents.
+        """
+        if not bucket:
+            bucket = 'default'
+        if bucket not in self.buckets:
+            self.buckets[bucket] = {}
+            self.indexes[bucket] = {}
+        return self.buckets[bucket]
+    
+    def create_index(self, bucket, keypath, kind='hash'):
+        """ Declare a secondary index on the given keypath.
+        
+        :param str bucket: The bucket/collection name
+        :param str keypath: The dotted path to the indexed value
+        :param str kind: "hash" for equality lookups or "sorted" for equality,
+            range lookups and sorting
+        """
+        if kind not in self.index_kinds:
+            raise Exception('Unknown index kind "{}", use one of {}'.format(kind, ', '.join(sorted(self.index_kinds.keys()))))
+        with self.lock:
+            docs = self.bucket(bucket)
+            index = self.index_kinds[kind](keypath)
+            if isinstance(index, SortedIndex):
+                index.build(docs.items())
+            else:
+                for doc_id, doc in docs.items():
+                    index.add(doc_id, doc)
+            self.indexes[bucket or 'default'][keypath] = index
+    
+    
+    # MARK: - Overrides
+    
+    def load_document(self, bucket, doc_id):
+        if not doc_id:
+            raise Exception('Need a doc_id to load a document')
+        with self.lock:
+            doc = self.bucket(bucket).get(doc_id)
+            return query.copy_json(doc) if doc is not None else None
+    
+    def load_documents(self, bucket, doc_ids):
+        with self.lock:
+            docs = self.bucket(bucket)
+            return [query.copy_json(docs[doc_id]) if doc_id in docs else None for doc_id in doc_ids]
+    
+    def add_documents(self, bucket, documents):
+        if isinstance(documents, dict):
+            documents = [documents]
+        with self.lock:
+            docs = self.bucket(bucket)
+            for doc in documents:
+                if '_id' in doc and doc['_id'] in docs:
+                    raise Exception('A document with id "{}" already exists'.format(doc['_id']))
+            doc_ids = []
+            for doc in documents:
+                if doc.get('_id') is None:
+                    doc['_id'] = self.new_id()
+                self._put(bucket, doc['_id'], query.copy_json(doc))
+                doc_ids.append(doc['_id'])
+            return doc_ids
+    
+    def store_document(self, bucket, document):
+        doc = query.copy_json(document)
+        if doc.get('_id') is None:
+            doc['_id'] = self.new_id()
+        with self.lock:
+            self._put(bucket, doc['_id'], doc)
+        return doc['_id']
+    
+    def store_documents(self, bucket, documents):
+        docs = [query.copy_json(document) for document in documents]
+        for doc in docs:
+            if doc.get('_id') is None:
+                doc['_id'] = self.new_id()
+        with self.lock:
+            for doc in docs:
+                self._put(bucket, doc['_id'], doc)
+        return [doc['_id'] for doc in docs]
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        with self.lock:
+            doc = self.bucket(bucket).get(doc_id)
+            if doc is None:
+                return False
+            self._put(bucket, doc_id, query.apply_update(query.copy_json(doc), query.copy_json(values), unset))
+            return True
+    
+    def remove_document(self, bucket, doc_id):
+        if not doc_id:
+            raise Exception('Need a doc_id to remove a document')
+        with self.lock:
+            docs = self.bucket(bucket)
+            doc = docs.pop(doc_id, None)
+            if doc is not None:
+                for index in self.indexes[bucket or 'default'].values():
+                    index.remove(doc_id, doc)
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        copy = _copier(fields)
+        with self.lock:
+            return [copy(doc) for doc in self._find(bucket, dictionary, skip, limit, sort, descending)]
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Runs the query once and copies documents one batch at a time. """
+        copy = _copier(fields)
+        with self.lock:
+            found = self._find(bucket, dictionary, skip, limit, sort, descending)
+        for i in range(0, len(found), batch_size):
+            with self.lock:
+                batch = [copy(doc) for doc in found[i:i + batch_size]]
+            yield batch
+    
+    def count(self, bucket, dictionary):
+        with self.lock:
+            if not dictionary:
+                return len(self.bucket(bucket))
+            return len(self._find(bucket, dictionary, 0, None, None, False))
+    
+    
+    # MARK: - Internals
+    
+    def _put(self, bucket, doc_id, doc):
+        docs = self.bucket(bucket)
+        indexes = self.indexes[bucket or 'default'].values()
+        old = docs.get(doc_id)
+        if old is not None:
+            for index in indexes:
+                index.remove(doc_id, old)
+        docs[doc_id] = doc
+        for index in indexes:
+            index.add(doc_id, doc)
+    
+    def _candidates(self, bucket, dictionary, ignore=None):
+        """ Use the bucket's indexes to narrow down the ids of documents that
+        can match the query. Returns None if no index applies.
+        
+        :param str ignore: A keypath whose condition should not be looked up
+        """
+        indexes = self.indexes[bucket or 'default']
+        candidates = None
+        for key, cond in (dictionary or {}).items():
+            index = indexes.get(key)
+            if index is None or key == ignore:
+                continue
+            
+            found = None
+            if not query.is_operator_condition(cond):
+                found = index.lookup([cond])
+            elif '$eq' in cond:
+                found = index.lookup([cond['$eq']])
+            elif '$in' in cond:
+                found = index.lookup(cond['$in'])
+            else:
+                ranges = {op: arg for op, arg in cond.items() if op in ('$gt', '$gte', '$lt', '$lte')}
+                if len(ranges) > 0:
+                    found = index.lookup_range(ranges)
+            
+            if found is not None:
+                candidates = found if candidates is None else candidates & found
+                if 0 == len(candidates):
+                    break
+        return candidates
+    
+    def _find(self, bucket, dictionary, skip, limit, sort, descending):
+        """ Returns the matching stored documents, not copied.
+        """
+        docs = self.bucket(bucket)
+        dictionary = dictionary or {}
+        spec = query.sort_spec(sort, descending)
+        skip = skip or 0
+        end = skip + limit if limit else None
+        
+        # walk a sorted index on the sort key, restricted to the range the
+        # query asks for on that key, unless other indexes leave few candidates.
+        # Within a range an array shows up at its matching element rather than
+        # its smallest or largest one, so arrays in the index need a full sort
+        if 1 == len(spec):
+            keypath, desc = spec[0]
+            index = self.indexes[bucket or 'default'].get(keypath)
+            if isinstance(index, SortedIndex):
+                bounds = index.bounds(dictionary[keypath]) if keypath in dictionary else None
+                if bounds is not None and index.arrays > 0:
+                    index = None
+            if isinstance(index, SortedIndex):
+                candidates = self._candidates(bucket, dictionary, ignore=keypath)
+                if candidates is None or (end is not None and len(candidates) > 8 * end):
+                    found = []
+                    for doc_id in index.ordered_ids(desc, bounds):
+                        if candidates is not None and doc_id not in candidates:
+                            continue
+                        doc = docs[doc_id]
+                        if query.matches(doc, dictionary):
+                            found.append(doc)
+                            if end is not None and len(found) >= end:
+                                break
+                    return found[skip:]
+        
+        candidates = self._candidates(bucket, dictionary)
+        if candidates is None:
+            source = docs.values()
+        else:
+            source = (docs[doc_id] for doc_id in candidates if doc_id in docs)
+        
+        # without sorting we can stop as soon as we have enough
+        if 0 == len(spec):
+            found = []
+            for doc in source:
+                if query.matches(doc, dictionary):
+                    found.append(doc)
+                    if end is not None and len(found) >= end:
+                        break
+            return found[skip:]
+        
+        found = [doc for doc in source if query.matches(doc, dictionary)]
+        query.sort_documents(found, spec)
+        return found[skip:end]
+
+
+def _copier(fields):
+    """ Returns the function copying found documents out of the server. """
+    if fields is None:
+        return query.copy_json
+    fields = query.projection_fields(fields)
+    return lambda doc: query.project(doc, fields)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest memoryserver_test.py
+
+import unittest
+import random
+if __package__:
+    from .memoryserver import MemoryServer, SortedIndex
+else:
+    from memoryserver import MemoryServer, SortedIndex
+
+
+class TestMemoryServer(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = MemoryServer()
+        self.server.add_documents('b', [
+            {'_id': '1', 'name': 'alice', 'age': 31, 'tags': ['a', 'b'], 'address': {'city': 'Bern'}},
+            {'_id': '2', 'name': 'bob', 'age': 25, 'tags': ['b']},
+            {'_id': '3', 'name': 'carol', 'age': 42, 'address': {'city': 'Basel'}},
+            {'_id': '4', 'name': 'dave', 'age': '42'},
+        ])
+    
+    def find_ids(self, dictionary, **kwargs):
+        return [doc['_id'] for doc in self.server.find('b', dictionary, **kwargs)]
+    
+    def test_crud(self):
+        """ Test storing, loading and removing documents. """
+        self.assertEqual('alice', self.server.load_document('b', '1')['name'])
+        self.assertIsNone(self.server.load_document('b', 'x'))
+        doc = self.server.load_document('b', '1')
+        doc['name'] = 'changed'
+        self.assertEqual('alice', self.server.load_document('b', '1')['name'], 'Must not hand out stored documents')
+        self.assertEqual('1', self.server.store_document('b', doc))
+        self.assertEqual('changed', self.server.load_document('b', '1')['name'])
+        with self.assertRaises(Exception, msg="Must not add a document with an existing id"):
+            self.server.add_documents('b', [{'_id': '1'}])
+        self.server.remove_document('b', '1')
+        self.assertIsNone(self.server.load_document('b', '1'))
+    
+    def check_queries(self):
+        self.assertEqual(['1'], self.find_ids({'name': 'alice'}))
+        self.assertEqual(['1', '2'], sorted(self.find_ids({'tags': 'b'})))
+        self.assertEqual(['1', '3'], sorted(self.find_ids({'age': {'$gt': 30}})))
+        self.assertEqual(['2'], self.find_ids({'age': {'$gte': 25, '$lt': 31}}))
+        self.assertEqual(['4'], self.find_ids({'age': '42'}))
+        self.assertEqual(['2', '3'], sorted(self.find_ids({'name': {'$in': ['bob', 'carol']}})))
+        self.assertEqual(['3'], self.find_ids({'address.city': 'Basel'}))
+        self.assertEqual(['2', '4'], sorted(self.find_ids({'address': None})))
+        self.assertEqual(['2', '1', '3', '4'], self.find_ids({}, sort='age'))
+        self.assertEqual(['4', '3', '1', '2'], self.find_ids({}, sort='age', descending=True))
+        self.assertEqual(['1', '3'], self.find_ids({}, sort='age', skip=1, limit=2))
+        self.assertEqual(['3', '1'], self.find_ids({'age': {'$gt': 30}}, sort='age', descending=True))
+    
+    def test_find(self):
+        """ Test finding documents without indexes. """
+        self.check_queries()
+    
+    def test_projection(self):
+        """ Test finding only some fields and counting matches. """
+        found = self.server.find('b', {'age': {'$gt': 30}}, sort='age', fields=['name', 'address.city'])
+        self.assertEqual([{'_id': '1', 'name': 'alice', 'address': {'city': 'Bern'}}, {'_id': '3', 'name': 'carol', 'address': {'city': 'Basel'}}], found)
+        found[0]['name'] = 'changed'
+        self.assertEqual('alice', self.server.load_document('b', '1')['name'], 'Must not hand out stored documents')
+        self.assertEqual(4, self.server.count('b', {}))
+        self.assertEqual(2, self.server.count('b', {'tags': 'b'}))
+    
+    def test_find_indexed(self):
+        """ Test finding documents using indexes, which must not change results. """
+        self.server.create_index('b', 'name')
+        self.server.create_index('b', 'tags')
+        self.server.create_index('b', 'age', 'sorted')
+        self.server.create_index('b', 'address.city', 'sorted')
+        self.check_queries()
+        self.server.store_document('b', {'_id': '2', 'name': 'bob', 'age': 50})
+        self.assertEqual(['1', '3', '2', '4'], self.find_ids({}, sort='age'))
+        self.assertEqual(['1'], self.find_ids({'tags': 'b'}))
+        self.server.remove_document('b', '3')
+        self.assertEqual(['1', '2'], sorted(self.find_ids({'age': {'$gt': 30}})))
+    
+    def test_sorted_index_runs(self):
+        """ Test that a sorted index spanning many runs agrees with a scan. """
+        run_length = SortedIndex.run_length
+        SortedIndex.run_length = 3
+        try:
+            rnd = random.Random(7)
+            plain = MemoryServer()
+            indexed = MemoryServer()
+            indexed.create_index('r', 'n', 'sorted')
+            for i in range(200):
+                doc = {'_id': str(i), 'n': rnd.randint(0, 30)}
+                plain.store_document('r', doc)
+                indexed.store_document('r', doc)
+            for i in range(0, 200, 3):
+                plain.remove_document('r', str(i))
+                indexed.remove_document('r', str(i))
+            for dictionary in [{}, {'n': 7}, {'n': {'$gte': 5, '$lt': 20}}, {'n': {'$in': [1, 2, 3]}}]:
+                for desc in [False, True]:
+                    expected = [d['n'] for d in plain.find('r', dictionary, 0, None, 'n', desc)]
+                    found = [d['n'] for d in indexed.find('r', dictionary, 0, None, 'n', desc)]
+                    self.assertEqual(expected, found)
+                    self.assertEqual(expected[5:15], [d['n'] for d in indexed.find('r', dictionary, 5, 10, 'n', desc)])
+        finally:
+            SortedIndex.run_length = run_length
+    
+    def test_sorted_index_arrays(self):
+        """ Test that arrays sort by their smallest or largest element when a
+        range on the sort key is queried. """
+        plain = MemoryServer()
+        indexed = MemoryServer()
+        indexed.create_index('a', 'n', 'sorted')
+        for doc in [{'_id': '1', 'n': [1, 2, 3]}, {'_id': '2', 'n': [2, 5, 1.5]}, {'_id': '3', 'n': 2}, {'_id': '4', 'n': [0, 4]}]:
+            plain.store_document('a', doc)
+            indexed.store_document('a', doc)
+        for dictionary in [{}, {'n': 2}, {'n': {'$gte': 2}}]:
+            for desc in [False, True]:
+                expected = [d['_id'] for d in plain.find('a', dictionary, 0, None, 'n', desc)]
+                self.assertEqual(expected, [d['_id'] for d in indexed.find('a', dictionary, 0, None, 'n', desc)])
+        self.assertEqual(['2', '1', '3'], [d['_id'] for d in indexed.find('a', {'n': 2}, 0, None, 'n', True)])
+        
+        indexed.store_document('a', {'_id': '1', 'n': 1})
+        indexed.store_document('a', {'_id': '2', 'n': 5})
+        indexed.remove_document('a', '4')
+        self.assertEqual(0, indexed.indexes['a']['n'].arrays)
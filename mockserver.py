@@ -1,57 +1,415 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
-#   A Mock server intended for unit testing JSONDocument subclasses
+#   A Mock server intended for unit and load testing JSONDocument subclasses
 #
 #   2017-01-17  Created by Pascal Pfiffner
 
-import os
+import json
+import math
+import time
+import random
+import threading
+import concurrent.futures
 
 if __package__:
     from .jsonserver import JSONServer
+    from .memoryserver import MemoryServer
+    from . import query
 else:
     from jsonserver import JSONServer
+    from memoryserver import MemoryServer
+    import query
+
+
+OPERATIONS = ('load_document', 'load_documents', 'add_documents', 'store_document', 'store_documents',
+    'update_document', 'remove_document', 'find', 'find_batches', 'count')
+""" The server operations MockServer simulates, records and replays. """
 
 
 class MockServer(JSONServer):
     """ A mock server.
     
     This class overrides the standard JSONServer methods and will pass or fail
-    according to its `can_xy` and `found_documents` properties.
+    according to its `can_xy` and `found_documents` properties. Documents are
+    kept in a MemoryServer, or the server passed as `store`, so they can be
+    loaded after storing them; `found_documents`, if set, is what `find()`
+    returns instead of querying the store.
+    
+    For load testing, every operation can be given a latency, see
+    `constant()`, `uniform()`, `exponential()` and `lognormal()`, and a
+    probability to fail. With `max_connections` at most that many operations
+    run at once, like with a connection pool; the others wait for one.
+    
+    While `trace` is a list, each operation appends a dictionary with its
+    name (`op`), `bucket`, arguments (`args`), its `start` in seconds since
+    recording started, how long it waited for a connection (`wait`), its
+    `duration` including the wait and its `error`, if any. Traces can be
+    written to file, replayed against any JSONServer with `replay()` and
+    summarized with `summarize()`:
+        
+        srv = MockServer(latency={'find': lognormal(0.004, 0.6)}, failure_rate=0.001, max_connections=10)
+        srv.start_recording()
+        run_load(srv)
+        print(summarize(srv.stop_recording()))
     """
     
-    def __init__(self, host=None, port=None, database=None, bucket=None, user=None, pw=None):
+    def __init__(self, host=None, port=None, database=None, bucket=None, user=None, pw=None,
+                 store=None, latency=None, failure_rate=None, max_connections=None, seed=None):
+        """
+        :param JSONServer store: Where to keep documents, a new MemoryServer
+            if None
+        :param latency: Seconds or a distribution, applied to all operations,
+            or a dictionary of those by operation name
+        :param failure_rate: The probability an operation raises, or a
+            dictionary of those by operation name
+        :param int max_connections: The number of operations that can run at
+            once, unlimited if None
+        :param seed: Seeds latencies and failures, for repeatable runs
+        """
         super().__init__()
+        self.can_add = True
         self.can_store = True
         self.can_update = True
         self.can_load = True
         self.can_remove = True
         self.found_documents = None
+        
+        if store is not None and not isinstance(store, JSONServer):
+            raise Exception('Need a JSONServer instance as store but got {}'.format(store))
+        self.store = store if store is not None else MemoryServer()
+        self.id_generator = self.store.id_generator
+        self.latency = _per_operation(latency, 'latency')
+        self.failure_rate = _per_operation(failure_rate, 'failure rate')
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.connections = threading.BoundedSemaphore(max_connections) if max_connections else None
+        self.trace = None
+        self.trace_lock = threading.Lock()
+        self.trace_start = None
+    
+    
+    # MARK: - Traces
+    
+    def start_recording(self):
+        """ Starts recording a new trace into `trace`. """
+        with self.trace_lock:
+            self.trace = []
+            self.trace_start = time.perf_counter()
+    
+    def stop_recording(self):
+        """ Stops recording and returns the trace recorded. """
+        with self.trace_lock:
+            trace = self.trace
+            self.trace = None
+        return trace or []
+    
+    def _record(self, op, bucket, args, start, wait, duration, error):
+        with self.trace_lock:
+            if self.trace is not None:
+                self.trace.append({
+                    'op': op,
+                    'bucket': bucket,
+                    'args': args,
+                    'start': max(0.0, start - self.trace_start),
+                    'wait': wait,
+                    'duration': duration,
+                    'error': None if error is None else str(error),
+                })
+    
+    
+    # MARK: - Simulation
+    
+    def _call(self, op, allowed, bucket, args, func, *func_args):
+        """ Runs `func` like a real server would, see `_perform()`, and
+        records it if recording.
+        """
+        recording = self.trace is not None
+        if recording:
+            args = query.copy_json(args)
+        start = time.perf_counter()
+        wait = 0.0
+        error = None
+        try:
+            result, wait = self._perform(op, allowed, func, *func_args)
+            if recording:
+                _add_ids(op, args, result)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if recording:
+                self._record(op, bucket, args, start, wait, time.perf_counter() - start, error)
+    
+    def _perform(self, op, allowed, func, *func_args):
+        """ Runs `func` after waiting for a connection and the simulated
+        latency, failing at the configured rate.
+        
+        :returns: A tuple of the result and the seconds waited for a
+            connection
+        """
+        if not allowed:
+            raise Exception('Cannot {}'.format(op.replace('_', ' ')))
+        start = time.perf_counter()
+        if self.connections is not None:
+            self.connections.acquire()
+        wait = time.perf_counter() - start
+        try:
+            delay, fail = self._draw(op)
+            if delay > 0:
+                time.sleep(delay)
+            if fail:
+                raise Exception('Simulated failure of {}'.format(op))
+            return func(*func_args), wait
+        finally:
+            if self.connections is not None:
+                self.connections.release()
+    
+    def _draw(self, op):
+        latency = self.latency.get(op)
+        rate = self.failure_rate.get(op)
+        with self.random_lock:
+            if latency is None:
+                delay = 0.0
+            elif callable(latency):
+                delay = max(0.0, latency(self.random))
+            else:
+                delay = latency
+            fail = rate is not None and self.random.random() < rate
+        return delay, fail
     
     
     # MARK: - Overrides
     
     def load_document(self, bucket, doc_id):
-        if not self.can_load:
-            raise Exception('Cannot load document')
+        return self._call('load_document', self.can_load, bucket, [doc_id], self.store.load_document, bucket, doc_id)
+    
+    def load_documents(self, bucket, doc_ids):
+        doc_ids = list(doc_ids)
+        return self._call('load_documents', self.can_load, bucket, [doc_ids], self.store.load_documents, bucket, doc_ids)
     
     def add_documents(self, bucket, documents):
-        if not self.can_add:
-            raise Exception('Cannot add documents')
-        doc_ids = []
-        for doc in documents:
-            if '_id' in doc:
-                doc_ids.append(doc['_id'])
-        return doc_ids
+        documents = list(documents)
+        return self._call('add_documents', self.can_add, bucket, [documents], self.store.add_documents, bucket, documents)
     
     def store_document(self, bucket, document):
-        if not self.can_store:
-            raise Exception('Cannot store documents')
-        return document.get('_id')
+        return self._call('store_document', self.can_store, bucket, [document], self.store.store_document, bucket, document)
+    
+    def store_documents(self, bucket, documents):
+        documents = list(documents)
+        return self._call('store_documents', self.can_store, bucket, [documents], self.store.store_documents, bucket, documents)
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        return self._call('update_document', self.can_update, bucket, [doc_id, values, unset], self.store.update_document, bucket, doc_id, values, unset)
     
     def remove_document(self, bucket, doc_id):
-        pass
+        return self._call('remove_document', self.can_remove, bucket, [doc_id], self.store.remove_document, bucket, doc_id)
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        args = [dictionary, skip, limit, sort, descending, fields]
+        if self.found_documents is not None:
+            return self._call('find', self.can_load, bucket, args, lambda: self.found_documents)
+        if fields is None:
+            return self._call('find', self.can_load, bucket, args, self.store.find, bucket, dictionary, skip, limit, sort, descending)
+        return self._call('find', self.can_load, bucket, args, self.store.find, bucket, dictionary, skip, limit, sort, descending, fields)
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Simulates latency and failures per batch, but records the
+        iteration as one operation. """
+        if self.found_documents is not None:
+            if self.found_documents:
+                yield list(self.found_documents)
+            return
+        if fields is None:
+            batches = self.store.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit)
+        else:
+            batches = self.store.find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit, fields)
+        recording = self.trace is not None
+        args = query.copy_json([dictionary, batch_size, sort, descending, skip, limit, fields]) if recording else None
+        start = time.perf_counter()
+        wait = 0.0
+        error = None
+        try:
+            while True:
+                batch, waited = self._perform('find_batches', self.can_load, next, batches, None)
+                wait += waited
+                if batch is None:
+                    return
+                yield batch
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if recording:
+                self._record('find_batches', bucket, args, start, wait, time.perf_counter() - start, error)
+    
+    def count(self, bucket, dictionary):
+        if self.found_documents is not None:
+            return self._call('count', self.can_load, bucket, [dictionary], len, self.found_documents)
+        return self._call('count', self.can_load, bucket, [dictionary], self.store.count, bucket, dictionary)
+    
+    def native_id(self, doc_id):
+        return self.store.native_id(doc_id)
+
+
+def _add_ids(op, args, result):
+    """ Adds the ids the store assigned to the recorded documents, so
+    replaying later operations on them finds them. """
+    if 'store_document' == op:
+        documents, doc_ids = args[:1], [result]
+    elif op in ('add_documents', 'store_documents'):
+        documents, doc_ids = args[0], result or []
+    else:
+        return
+    for doc, doc_id in zip(documents, doc_ids):
+        if isinstance(doc, dict) and doc.get('_id') is None and doc_id is not None:
+            doc['_id'] = doc_id
+
+def _per_operation(value, what):
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        unknown = set(value) - set(OPERATIONS)
+        if unknown:
+            raise Exception('Unknown operations for {}: {}'.format(what, ', '.join(sorted(unknown))))
+        return dict(value)
+    return {op: value for op in OPERATIONS}
+
+
+# MARK: - Latency Distributions
+
+def constant(seconds):
+    """ Always the given number of seconds. """
+    return lambda rng: seconds
+
+def uniform(low, high):
+    """ Evenly distributed between `low` and `high` seconds. """
+    return lambda rng: rng.uniform(low, high)
+
+def exponential(mean):
+    """ Exponentially distributed with the given mean, like the time
+    between independent events. """
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+def lognormal(median, sigma=0.5):
+    """ Log-normally distributed around the given median; larger `sigma`
+    makes for a longer tail, which is how real database latencies look. """
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+# MARK: - Replay
+
+def replay(trace, server, timed=False, speed=1.0, max_workers=32, ignore_errors=True):
+    """ Runs the operations of a recorded trace against the given server.
+    Results of `find()` and `find_batches()` are iterated to the end.
+    
+    Operations either run one after another as fast as possible, or, if
+    `timed`, on a pool of threads, each at the time it started when
+    recorded, which reproduces the recorded concurrency as far as the pool
+    allows.
+    
+    :param list trace: Dictionaries as MockServer records them
+    :param JSONServer server: The server to replay against
+    :param bool timed: Whether to start operations at their recorded times
+    :param float speed: How much faster than recorded to run when timed
+    :param int max_workers: The number of threads running timed operations
+    :param bool ignore_errors: Whether to keep going after an operation
+        raises, which is recorded in the result
+    :returns: A trace of the replayed operations, with their durations and
+        errors on the given server
+    """
+    if not isinstance(server, JSONServer):
+        raise Exception('Need a JSONServer instance but got {}'.format(server))
+    for entry in trace:
+        if entry['op'] not in OPERATIONS:
+            raise Exception('Unknown operation "{}" in trace'.format(entry['op']))
+    began = time.perf_counter()
+    
+    def run(entry):
+        op = entry['op']
+        args = query.copy_json(entry['args'])
+        start = time.perf_counter()
+        error = None
+        try:
+            if 'find_batches' == op:
+                for batch in server.find_batches(entry['bucket'], *args):
+                    pass
+            else:
+                found = getattr(server, op)(entry['bucket'], *args)
+                if 'find' == op and found is not None:
+                    for doc in found:
+                        pass
+        except Exception as e:
+            if not ignore_errors:
+                raise
+            error = e
+        return {
+            'op': op,
+            'bucket': entry['bucket'],
+            'args': entry['args'],
+            'start': start - began,
+            'wait': 0.0,
+            'duration': time.perf_counter() - start,
+            'error': None if error is None else str(error),
+        }
+    
+    if not timed:
+        return [run(entry) for entry in trace]
+    
+    futures = [None] * len(trace)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='replay') as executor:
+        for i, entry in sorted(enumerate(trace), key=lambda item: item[1]['start']):
+            delay = began + entry['start'] / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures[i] = executor.submit(run, entry)
+    return [future.result() for future in futures]
+
+def write_trace(trace, path):
+    """ Writes a trace to a JSON Lines file. Non-JSON values such as
+    ObjectIds are written as strings. """
+    with open(path, 'w', encoding='utf-8') as handle:
+        for entry in trace:
+            handle.write(json.dumps(entry, default=str))
+            handle.write('\n')
+
+def read_trace(path):
+    """ Reads a trace from a JSON Lines file written by `write_trace()`. """
+    with open(path, 'r', encoding='utf-8') as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+def summarize(trace):
+    """ Summarizes a trace by operation: the number of calls and errors,
+    calls per second over the span of the trace, and the mean, median, 90th,
+    99th percentile and maximum duration in seconds.
+    
+    :returns: A dictionary of dictionaries by operation name, with the key
+        `all` for all operations together
+    """
+    by_op = {}
+    for entry in trace:
+        by_op.setdefault(entry['op'], []).append(entry)
+    if len(trace) > 0:
+        by_op['all'] = list(trace)
     
-    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False):
-        return self.found_documents
+    summary = {}
+    for op, entries in by_op.items():
+        durations = sorted(entry['duration'] for entry in entries)
+        span = max(entry['start'] + entry['duration'] for entry in entries) - min(entry['start'] for entry in entries)
+        summary[op] = {
+            'count': len(entries),
+            'errors': sum(1 for entry in entries if entry['error'] is not None),
+            'throughput': len(entries) / span if span > 0 else None,
+            'mean': sum(durations) / len(durations),
+            'p50': _percentile(durations, 0.5),
+            'p90': _percentile(durations, 0.9),
+            'p99': _percentile(durations, 0.99),
+            'max': durations[-1],
+        }
+    return summary
 
+def _percentile(ordered, fraction):
+    """ The nearest-rank percentile of an ordered list. """
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
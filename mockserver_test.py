@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest mockserver_test.py
+
+import os
+import time
+import tempfile
+import unittest
+import concurrent.futures
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from . import mockserver
+    from .mockserver import MockServer
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    import mockserver
+    from mockserver import MockServer
+
+
+class Note(JSONDocument):
+    pass
+
+
+class TestMockServer(unittest.TestCase):
+    
+    def test_store(self):
+        """ Test that documents are kept and `can_xy` flags fail operations. """
+        server = MockServer()
+        note = Note(None, json={'text': 'hi'})
+        note.store_to(server, 'b')
+        self.assertEqual('hi', server.load_document('b', note.id)['text'])
+        self.assertEqual(1, len(Note.find_on({'text': 'hi'}, server, 'b')))
+        server.can_add = False
+        with self.assertRaises(Exception):
+            Note.insert_to({'text': 'no'}, server, 'b')
+        server.found_documents = [{'_id': 'x'}]
+        self.assertEqual(['x'], [d.id for d in Note.find_on({}, server, 'b')])
+        self.assertEqual([[{'_id': 'x'}]], list(server.find_batches('b', {})))
+    
+    def test_simulation(self):
+        """ Test latencies, failure rates and the connection limit. """
+        server = MockServer(latency={'load_document': mockserver.constant(0.02)}, failure_rate={'count': 1.0}, max_connections=2, seed=1)
+        server.store_document('b', {'_id': 'a'})
+        with self.assertRaises(Exception):
+            server.count('b', {})
+        server.start_recording()
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(lambda i: server.load_document('b', 'a'), range(6)))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.06, 'Must run at most two operations at once')
+        trace = server.stop_recording()
+        self.assertEqual(6, len(trace))
+        self.assertGreater(max(entry['wait'] for entry in trace), 0.01)
+        self.assertTrue(all(entry['duration'] >= 0.02 for entry in trace))
+        
+        rng = MockServer(seed=3).random
+        samples = [mockserver.lognormal(0.01, 0.5)(rng) for i in range(1000)]
+        self.assertAlmostEqual(0.01, sorted(samples)[500], delta=0.002)
+        with self.assertRaises(Exception):
+            MockServer(latency={'lod_document': 0.1})
+    
+    def test_replay(self):
+        """ Test that replaying a trace reproduces the recorded state. """
+        server = MockServer(failure_rate={'remove_document': 0.5}, seed=7)
+        server.start_recording()
+        doc_ids = Note.insert_to([{'n': i} for i in range(20)], server, 'b')
+        for doc_id in doc_ids[:10]:
+            server.update_document('b', doc_id, {'n': -1})
+        for doc_id in doc_ids:
+            try:
+                server.remove_document('b', doc_id)
+            except Exception:
+                pass
+        server.find('b', {'n': {'$lt': 0}}, sort=[('n', 1)])
+        list(server.find_batches('b', {}, 3))
+        trace = server.stop_recording()
+        self.assertEqual(['add_documents'] + ['update_document'] * 10 + ['remove_document'] * 20 + ['find', 'find_batches'], [e['op'] for e in trace])
+        failed = sum(1 for e in trace if e['error'] is not None)
+        self.assertTrue(0 < failed < 20)
+        
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'trace.jsonl')
+        try:
+            mockserver.write_trace(trace, path)
+            trace = mockserver.read_trace(path)
+        finally:
+            os.remove(path)
+            os.rmdir(directory)
+        
+        for timed in (False, True):
+            target = MemoryServer()
+            replayed = mockserver.replay([e for e in trace if e['error'] is None], target, timed=timed, speed=100)
+            self.assertEqual(sorted(d['_id'] for d in server.find('b', {}, limit=None)), sorted(d['_id'] for d in target.find('b', {}, limit=None)))
+            self.assertEqual(server.count('b', {'n': -1}), target.count('b', {'n': -1}))
+            self.assertTrue(all(e['error'] is None for e in replayed))
+        
+        summary = mockserver.summarize(trace)
+        self.assertEqual(33, summary['all']['count'])
+        self.assertEqual(failed, summary['remove_document']['errors'])
+        self.assertLessEqual(summary['update_document']['p50'], summary['update_document']['max'])
@@ -8,11 +8,15 @@
 import os
 
 import pymongo
-from bson.objectid import ObjectId 
+from bson.objectid import ObjectId
 if __package__:
     from .jsonserver import JSONServer
+    from . import query
+    from . import idgen
 else:
     from jsonserver import JSONServer
+    import query
+    import idgen
 
 
 class MongoServer(JSONServer):
@@ -21,11 +25,22 @@ class MongoServer(JSONServer):
     This class will make sure that a document's **_id** is an ``ObjectId`` if
     the document does not yet have one or if it has one that but it's
     represented as a string.
+    
+    Classes hooked up to it get ObjectId-compatible ids, see
+    `idgen.objectid`. If all ids are kept as strings, pass
+    ``convert_ids=False`` to skip checking and converting them on every
+    call.
     """
     
-    def __init__(self, host=None, port=None, database=None, bucket=None, user=None, pw=None):
+    load_chunk_size = 1000
+    """ The number of ids to query at once in `load_documents()`. """
+    
+    id_generator = idgen.objectid
+    
+    def __init__(self, host=None, port=None, database=None, bucket=None, user=None, pw=None, convert_ids=True):
         super().__init__()
         self.handles = {}
+        self.convert_ids = convert_ids
         if host is None:
             host = os.environ.get('MONGO_HOST') or 'localhost'
         if port is None:
@@ -63,43 +78,129 @@ class MongoServer(JSONServer):
     def load_document(self, bucket, doc_id):
         if not doc_id:
             raise Exception('Need a doc_id to load a document')
-        if ObjectId.is_valid(doc_id):
-            doc_id = ObjectId(doc_id)
+        doc_id = self.native_id(doc_id)
         handle = self.handle(bucket)
         return handle.find_one(doc_id)
     
+    def load_documents(self, bucket, doc_ids):
+        """ Loads the documents with one ``$in`` query per `load_chunk_size`
+        ids.
+        """
+        handle = self.handle(bucket)
+        found = {}
+        for i in range(0, len(doc_ids), self.load_chunk_size):
+            chunk = [self.native_id(doc_id) for doc_id in doc_ids[i:i + self.load_chunk_size]]
+            for doc in handle.find({'_id': {'$in': chunk}}):
+                found[str(doc['_id'])] = doc
+        return [found.get(str(doc_id)) for doc_id in doc_ids]
+    
     def add_documents(self, bucket, documents):
+        """ Inserts all documents with one unordered `insert_many()`.
+        """
+        if isinstance(documents, dict):
+            documents = [documents]
         for doc in documents:
-            if '_id' in doc and ObjectId.is_valid(doc['_id']):
-                doc['_id'] = ObjectId(doc['_id'])
+            if '_id' in doc:
+                doc['_id'] = self.native_id(doc['_id'])
+            elif not self.convert_ids:
+                doc['_id'] = self.new_id()
         
         handle = self.handle(bucket)
-        doc_ids = handle.insert(documents)
-        if doc_ids is not None and list != type(doc_ids):
-            doc_ids = [doc_ids]
-        return doc_ids
+        return list(handle.insert_many(documents, ordered=False).inserted_ids)
     
     def store_document(self, bucket, document):
         handle = self.handle(bucket)
-        if '_id' in document and ObjectId.is_valid(document['_id']):
-            document['_id'] = ObjectId(document['_id'])
+        if '_id' in document:
+            document['_id'] = self.native_id(document['_id'])
+        elif not self.convert_ids:
+            document['_id'] = self.new_id()
         return handle.save(document, manipulate=True)
     
+    def store_documents(self, bucket, documents):
+        """ Upserts all documents with one unordered bulk write.
+        """
+        requests = []
+        for document in documents:
+            if document.get('_id') is None:
+                document['_id'] = ObjectId() if self.convert_ids else self.new_id()
+            else:
+                document['_id'] = self.native_id(document['_id'])
+            requests.append(pymongo.ReplaceOne({'_id': document['_id']}, document, upsert=True))
+        if len(requests) > 0:
+            handle = self.handle(bucket)
+            handle.bulk_write(requests, ordered=False)
+        return [str(document['_id']) for document in documents]
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        if not doc_id:
+            raise Exception('Need a doc_id to update a document')
+        doc_id = self.native_id(doc_id)
+        spec = {}
+        if values:
+            spec['$set'] = values
+        if unset:
+            spec['$unset'] = {keypath: '' for keypath in unset}
+        if len(spec) > 0:
+            handle = self.handle(bucket)
+            return handle.update_one({'_id': doc_id}, spec).matched_count > 0
+    
     def remove_document(self, bucket, doc_id):
         """ pymongo's `remove` connection method would allow to specify ``None``
         as parameter, resulting in **all documents** in the collection to be
         deleted. We're not allowing this use for now. """
         if not doc_id:
             raise Exception('Need a doc_id to remove a document')
-        if ObjectId.is_valid(doc_id):
-            doc_id = ObjectId(doc_id)
+        doc_id = self.native_id(doc_id)
         handle = self.handle(bucket)
         handle.remove(spec_or_id=doc_id)
     
-    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False):
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
         handle = self.handle(bucket)
+        cursor = handle.find(dictionary, _projection(fields))
         if sort is not None:
-            order = pymongo.DESCENDING if descending else pymongo.ASCENDING
-            return handle.find(dictionary).sort(sort, order).skip(skip).limit(limit)
-        return handle.find(dictionary).skip(skip).limit(limit)
+            cursor = cursor.sort(_sort(sort, descending))
+        cursor = cursor.skip(skip or 0)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Walks one cursor that fetches `batch_size` documents per round
+        trip. """
+        handle = self.handle(bucket)
+        cursor = handle.find(dictionary, _projection(fields)).batch_size(batch_size)
+        if sort is not None:
+            cursor = cursor.sort(_sort(sort, descending))
+        cursor = cursor.skip(skip).limit(limit or 0)
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+    
+    def count(self, bucket, dictionary):
+        handle = self.handle(bucket)
+        return handle.count_documents(dictionary or {})
+    
+    def native_id(self, doc_id):
+        """ Converts ids that are ObjectIds in string form, unless
+        `convert_ids` is off. Other ids are checked by length only. """
+        if self.convert_ids and str is type(doc_id) and 24 == len(doc_id) and ObjectId.is_valid(doc_id):
+            return ObjectId(doc_id)
+        return doc_id
+
+
+def _sort(sort, descending):
+    """ The pymongo sort list for a sort argument, see `query.sort_spec()`. """
+    return [(keypath, pymongo.DESCENDING if desc else pymongo.ASCENDING) for keypath, desc in query.sort_spec(sort, descending)]
 
+def _projection(fields):
+    """ The pymongo projection for the given key paths, None for all. """
+    if fields is None:
+        return None
+    if isinstance(fields, dict):
+        return fields
+    return {keypath: 1 for keypath in ([fields] if isinstance(fields, str) else fields)}
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Evaluating Mongo-style query dictionaries against plain documents, used by
+#   the servers that don't have a database engine doing it for them
+
+import json
+import base64
+import datetime
+
+try:
+    from bson.objectid import ObjectId
+except ImportError:
+    ObjectId = None
+
+
+def value_at_keypath(document, keypath, default=None):
+    """ Return the value found at the dotted ``keypath`` in the document, or
+    ``default`` if any part of the path is missing.
+    """
+    val = document
+    for key in keypath.split('.'):
+        if isinstance(val, dict):
+            if key not in val:
+                return default
+            val = val[key]
+        elif isinstance(val, list) and key.isdigit() and int(key) < len(val):
+            val = val[int(key)]
+        else:
+            return default
+    return val
+
+
+def sort_key(value):
+    """ Return a key that orders values of mixed types the way MongoDB does:
+    null first, then numbers, strings, objects, arrays and booleans. Values of
+    other types sort last, grouped by their type name.
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (5, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, dict):
+        return (3, str(value))
+    if isinstance(value, (list, tuple)):
+        return (4, str(value))
+    return (6, (type(value).__name__, value))
+
+
+def document_sort_key(document, keypath, descending=False):
+    """ The sort key of the document for the given keypath. Arrays sort by
+    their smallest element when ascending and by their largest when
+    descending, missing values and empty arrays sort like null.
+    """
+    val = value_at_keypath(document, keypath)
+    if isinstance(val, list):
+        if 0 == len(val):
+            return sort_key(None)
+        keys = [sort_key(v) for v in val]
+        return max(keys) if descending else min(keys)
+    return sort_key(val)
+
+
+def sort_spec(sort, descending=False):
+    """ Normalize a sort argument to a list of ``(keypath, descending)``
+    tuples.
+    
+    :param sort: A keypath, or a list of keypaths or of pymongo-style
+        ``(keypath, direction)`` tuples
+    :param bool descending: The order used for plain keypaths
+    """
+    if sort is None:
+        return []
+    if isinstance(sort, str):
+        return [(sort, descending)]
+    spec = []
+    for item in sort:
+        if isinstance(item, (list, tuple)):
+            spec.append((item[0], item[1] < 0))
+        else:
+            spec.append((item, descending))
+    return spec
+
+
+def sort_documents(documents, spec):
+    """ Sort the documents in place according to a normalized sort spec.
+    """
+    for keypath, desc in reversed(spec):
+        documents.sort(key=lambda doc: document_sort_key(doc, keypath, desc), reverse=desc)
+    return documents
+
+
+def page_sort_spec(sort, descending=False):
+    """ The normalized sort spec for keyset pagination, which is the given
+    one with `_id` appended as the tiebreaker, in the direction of the last
+    key, so every document has a unique position.
+    """
+    spec = [(keypath, desc) for keypath, desc in sort_spec(sort, descending) if '_id' != keypath]
+    spec.append(('_id', spec[-1][1] if len(spec) > 0 else descending))
+    return spec
+
+
+def page_token(document, spec):
+    """ An opaque token for the position of the document in the given page
+    sort spec, to be handed to `page_query()` for the next page.
+    """
+    values = [value_at_keypath(document, keypath) for keypath, desc in spec]
+    data = json.dumps(values, separators=(',', ':'), default=typed_json_default).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def page_query(dictionary, spec, token, convert_id=None):
+    """ Extend the query dictionary to match only documents after the
+    position encoded in the token, given the same page sort spec.
+    
+    For keys k1, k2 and values v1, v2 that is ``{k1: {$gt: v1}}`` or
+    ``{k1: v1, k2: {$gt: v2}}``, with ``$lt`` for descending keys, which
+    servers answer with a range scan instead of skipping all documents of
+    the previous pages. Missing and null values are handled, but like range
+    queries in general this expects the other values of a sort key to be of
+    one type.
+    
+    :param convert_id: Called with the `_id` from the token, to convert it
+        back to the type the server uses
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(data.decode('utf-8'), object_hook=typed_json_object)
+    except Exception as e:
+        raise Exception('Invalid page token "{}": {}'.format(token, e))
+    if not isinstance(values, list) or len(values) != len(spec):
+        raise Exception('The page token "{}" does not match the sort order'.format(token))
+    if convert_id is not None:
+        values[-1] = convert_id(values[-1])
+    
+    branches = []
+    for i, ((keypath, desc), value) in enumerate(zip(spec, values)):
+        equal = {k: v for (k, d), v in zip(spec[:i], values[:i])}
+        if value is None:
+            if not desc:
+                branches.append(dict(equal, **{keypath: {'$ne': None}}))
+        else:
+            branches.append(dict(equal, **{keypath: {'$lt' if desc else '$gt': value}}))
+            if desc:
+                branches.append(dict(equal, **{keypath: None}))     # null sorts last and isn't in the range
+    if 0 == len(branches):
+        predicate = {'_id': {'$in': []}}
+    elif 1 == len(branches):
+        predicate = branches[0]
+    else:
+        predicate = {'$or': branches}
+    if not dictionary:
+        return predicate
+    return {'$and': [dictionary, predicate]}
+
+
+def typed_json_default(value):
+    """ The `default` for `json.dumps()` that writes datetimes and
+    ObjectIds in MongoDB Extended JSON, as ``{"$date": ISO 8601}`` and
+    ``{"$oid": hex}``, so `typed_json_object()` can read them back. Raises
+    a TypeError for other values JSON can't represent. """
+    if isinstance(value, datetime.datetime):
+        return {'$date': value.isoformat()}
+    if ObjectId is not None and isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    raise TypeError('Object of type {} is not JSON serializable'.format(value.__class__.__name__))
+
+def typed_json_object(obj):
+    """ The `object_hook` for `json.loads()` that reads back what
+    `typed_json_default()` wrote. ObjectIds stay hex strings if `bson`
+    isn't installed. """
+    if 1 == len(obj):
+        if '$date' in obj and isinstance(obj['$date'], str):
+            return datetime.datetime.fromisoformat(obj['$date'])
+        if '$oid' in obj and isinstance(obj['$oid'], str):
+            return ObjectId(obj['$oid']) if ObjectId is not None else obj['$oid']
+    return obj
+
+
+def matches(document, query):
+    """ Whether the document satisfies the query dictionary.
+    
+    Supports equality (including nested key paths and matching array
+    elements), ``$eq``, ``$ne``, ``$gt``, ``$gte``, ``$lt``, ``$lte``,
+    ``$in``, ``$nin`` and ``$exists`` as well as ``$and``, ``$or`` and
+    ``$nor``.
+    """
+    if not query:
+        return True
+    for key, cond in query.items():
+        if '$and' == key:
+            if not all(matches(document, sub) for sub in cond):
+                return False
+        elif '$or' == key:
+            if not any(matches(document, sub) for sub in cond):
+                return False
+        elif '$nor' == key:
+            if any(matches(document, sub) for sub in cond):
+                return False
+        elif key.startswith('$'):
+            raise Exception('Unsupported query operator "{}"'.format(key))
+        else:
+            val = value_at_keypath(document, key, _missing)
+            if not _matches_condition(val, cond):
+                return False
+    return True
+
+
+def is_operator_condition(cond):
+    """ Whether the condition is a dictionary of query operators rather than
+    a value to test for equality.
+    """
+    return isinstance(cond, dict) and len(cond) > 0 and all(k.startswith('$') for k in cond.keys())
+
+
+class _Missing(object):
+    def __repr__(self):
+        return '<missing>'
+
+_missing = _Missing()
+
+
+def _matches_condition(val, cond):
+    if not is_operator_condition(cond):
+        return _equals(val, cond)
+    
+    for op, arg in cond.items():
+        if '$eq' == op:
+            ok = _equals(val, arg)
+        elif '$ne' == op:
+            ok = not _equals(val, arg)
+        elif '$in' == op:
+            ok = any(_equals(val, a) for a in arg)
+        elif '$nin' == op:
+            ok = not any(_equals(val, a) for a in arg)
+        elif '$exists' == op:
+            ok = (val is not _missing) == bool(arg)
+        elif op in _comparisons:
+            ok = _compares(val, arg, _comparisons[op])
+        else:
+            raise Exception('Unsupported query operator "{}"'.format(op))
+        if not ok:
+            return False
+    return True
+
+
+def _equals(val, target):
+    if val is _missing:
+        return target is None
+    if isinstance(val, list) and not isinstance(target, list):
+        return any(_equals(v, target) for v in val)
+    if val is None or target is None:
+        return val is target
+    return sort_key(val) == sort_key(target)
+
+
+_comparisons = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+}
+
+
+def _compares(val, target, compare):
+    """ Range comparisons only match values of the same type bracket. """
+    if val is _missing:
+        return False
+    if isinstance(val, list):
+        return any(_compares(v, target, compare) for v in val)
+    a = sort_key(val)
+    b = sort_key(target)
+    if a[0] != b[0]:
+        return False
+    return compare(a, b)
+
+
+def copy_json(obj):
+    """ Copy a JSON-like structure of dicts and lists, leaving all other
+    values as they are. Considerably faster than `copy.deepcopy`.
+    """
+    if isinstance(obj, dict):
+        return {k: copy_json(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [copy_json(v) for v in obj]
+    return obj
+
+
+def projection_fields(fields):
+    """ Normalize a projection to a list of keypaths.
+    
+    :param fields: A list of keypaths, or a dictionary with keypaths as keys
+        and truthy values for those to include
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, dict):
+        return [key for key, val in fields.items() if val]
+    if isinstance(fields, str):
+        return [fields]
+    return list(fields)
+
+
+def project(document, fields):
+    """ Return a copy of the document with only `_id` and the values at the
+    given keypaths, like a MongoDB inclusion projection. Keypaths into arrays
+    of dictionaries keep the given key of each dictionary.
+    """
+    projected = {}
+    if '_id' in document:
+        projected['_id'] = document['_id']
+    for keypath in projection_fields(fields):
+        if '_id' == keypath:
+            continue
+        val = _projected(document, keypath.split('.'))
+        if val is not _missing:
+            _merge_projected(projected, val)
+    return projected
+
+
+def _projected(val, keys):
+    if 0 == len(keys):
+        return copy_json(val)
+    if isinstance(val, dict):
+        if keys[0] not in val:
+            return _missing
+        sub = _projected(val[keys[0]], keys[1:])
+        return _missing if sub is _missing else {keys[0]: sub}
+    if isinstance(val, list):
+        found = [_projected(v, keys) for v in val if isinstance(v, (dict, list))]
+        return [{} if v is _missing else v for v in found]
+    return _missing
+
+def _merge_projected(target, projected):
+    for key, val in projected.items():
+        existing = target.get(key)
+        if isinstance(existing, dict) and isinstance(val, dict):
+            _merge_projected(existing, val)
+        elif isinstance(existing, list) and isinstance(val, list) and len(existing) == len(val):
+            for i, (old, new) in enumerate(zip(existing, val)):
+                if isinstance(old, dict) and isinstance(new, dict):
+                    _merge_projected(old, new)
+                else:
+                    existing[i] = new
+        else:
+            target[key] = val
+
+
+def updateDictionaryByKeyPath(dictionary, keypath, value):
+    """ Update value at ``keypath``, making sure the dictionary has all the
+    entries needed. If :param:`dictionary` is not a dict it creates a dict
+    with :param:`dictionary` as key and ``1`` as value.
+    """
+    if dictionary is None:
+        dictionary = {}
+    elif type(dictionary) != dict:
+        dictionary = {dictionary: 1}
+    
+    paths = keypath.split('.')
+    if len(paths) > 0:
+        dd = dictionary
+        last = paths.pop()
+        for key in paths:
+            if key not in dd or type(dd[key]) != dict:
+                dd[key] = {}
+            dd = dd[key]
+        
+        dd[last] = value
+    
+    return dictionary
+
+
+def unset_keypath(dictionary, keypath):
+    """ Remove the value at ``keypath`` from the dictionary, if it's there.
+    """
+    paths = keypath.split('.')
+    last = paths.pop()
+    dd = dictionary
+    for key in paths:
+        if not isinstance(dd, dict) or key not in dd:
+            return dictionary
+        dd = dd[key]
+    if isinstance(dd, dict) and last in dd:
+        del dd[last]
+    return dictionary
+
+
+def apply_update(document, values=None, unset=None):
+    """ Apply a partial update to the document, like MongoDB's ``$set`` and
+    ``$unset`` do.
+    
+    :param dict values: New values by keypath
+    :param unset: Keypaths to remove
+    """
+    for keypath, value in (values or {}).items():
+        updateDictionaryByKeyPath(document, keypath, value)
+    for keypath in unset or []:
+        unset_keypath(document, keypath)
+    return document
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Compact JSON documents whose subclasses declare their fields
+
+import time
+
+if __package__:
+    from .jsondocument import BaseDocument
+    from .query import copy_json
+    from . import serializer
+    from . import instrumentation
+else:
+    from jsondocument import BaseDocument
+    from query import copy_json
+    import serializer
+    import instrumentation
+
+
+class Field(object):
+    """ A field declared by a `SchemaDocument` subclass.
+    """
+    __slots__ = ('name', 'default', 'doctype')
+    
+    def __init__(self, name, default=None, doctype=None):
+        """
+        :param str name: The field name
+        :param default: The value used if a document doesn't have the field;
+            callables are called and lists and dicts copied for each instance
+        :param type doctype: A JSONDocument subclass to instantiate from
+            embedded dictionaries, or lists thereof, found in this field
+        """
+        if not name.isidentifier() or name.startswith('__'):
+            raise Exception('Invalid field name "{}"'.format(name))
+        if hasattr(SchemaDocument, name):
+            raise Exception('Field "{}" would hide the document attribute of the same name'.format(name))
+        self.name = name
+        self.default = default
+        self.doctype = doctype
+    
+    @property
+    def default_is_constant(self):
+        return isinstance(self.default, (str, int, float, bool, tuple, frozenset, type(None)))
+    
+    def make_default(self):
+        if callable(self.default):
+            return self.default()
+        return copy_json(self.default)
+    
+    def convert(self, value):
+        """ Instantiates `doctype` from embedded dictionaries. """
+        if self.doctype is None:
+            return value
+        if isinstance(value, dict):
+            return self.doctype.from_embedded(value)
+        if isinstance(value, list):
+            return [self.doctype.from_embedded(v) if isinstance(v, dict) else v for v in value]
+        return value
+
+
+def _compile(cls, fields):
+    """ Generates `__init__`, `update_with`, `json_fields`, `as_json` and
+    `for_api` for the given fields, returned in a dictionary.
+    """
+    env = {
+        '_setattr': object.__setattr__,
+        '_plain': frozenset((str, int, float, bool, type(None))),
+        '_as_json': serializer.to_json,
+        '_for_api': serializer.for_api,
+        '_fieldnames': frozenset(f.name for f in fields),
+        '_instrumentation': instrumentation,
+        '_perf_counter': time.perf_counter,
+    }
+    def default(i, field):
+        if field.default_is_constant:
+            env['_default_{}'.format(i)] = field.default
+            return '_default_{}'.format(i)
+        env['_make_default_{}'.format(i)] = field.make_default
+        return '_make_default_{}()'.format(i)
+    def value(i, field, source):
+        if field.doctype is None:
+            return source
+        env['_convert_{}'.format(i)] = field.convert
+        return '_convert_{}({})'.format(i, source)
+    
+    lines = [
+        'def __init__(self, ident, doctype=None, json=None):',
+        '    if ident is None:',
+        '        if json is not None:',
+        '            if "_id" in json:',
+        '                ident = json["_id"]',
+        '            elif "id" in json:',
+        '                ident = json["id"]',
+        '        if ident is None:',
+        '            ident = self.new_id()',
+        '    _setattr(self, "_id", str(ident))',
+        '    _setattr(self, "_overflow", None)',
+        '    _setattr(self, "_docstate", None)',
+        '    if json is None:',
+    ]
+    for i, field in enumerate(fields):
+        lines.append('        _setattr(self, {!r}, {})'.format(field.name, default(i, field)))
+    if 0 == len(fields):
+        lines.append('        pass')
+    lines += [
+        '    else:',
+        '        found = ("_id" in json) + ("id" in json)',
+    ]
+    for i, field in enumerate(fields):
+        lines += [
+            '        if {!r} in json:'.format(field.name),
+            '            _setattr(self, {!r}, {})'.format(field.name, value(i, field, 'json[{!r}]'.format(field.name))),
+            '            found += 1',
+            '        else:',
+            '            _setattr(self, {!r}, {})'.format(field.name, default(i, field)),
+        ]
+    lines += [
+        '        if found < len(json):',
+        '            for key, val in json.items():',
+        '                if key not in _fieldnames and "_id" != key and "id" != key:',
+        '                    self.set_value(key, val)',
+        '    if doctype is not None:',
+        '        self.type = doctype',
+        '',
+        'def update_with(self, doc):',
+        '    if doc is None:',
+        '        return',
+        '    state = self._docstate',
+        '    changes = None',
+        '    if state is not None and state.persisted:',
+        '        if state.changes is None:',
+        '            state.changes = set()',
+        '        changes = state.changes',
+        '    found = 0',
+    ]
+    for i, field in enumerate(fields):
+        lines += [
+            '    if {!r} in doc:'.format(field.name),
+            '        _setattr(self, {!r}, {})'.format(field.name, value(i, field, 'doc[{!r}]'.format(field.name))),
+            '        if changes is not None:',
+            '            changes.add({!r})'.format(field.name),
+            '        found += 1',
+        ]
+    lines += [
+        '    if found > 0 and state is not None:',
+        '        state.version += 1',
+        '        state.rendered = None',
+        '        if state.parents is not None:',
+        '            self.notify_parents()',
+        '    if found < len(doc):',
+        '        for key, val in doc.items():',
+        '            if key not in _fieldnames:',
+        '                try:',
+        '                    setattr(self, key, val)',
+        '                except Exception as e:',
+        '                    raise Exception("Failed to set attribute \\"{}\\": {}".format(key, e))',
+        '',
+    ]
+    lines += [
+        'def json_fields(self):',
+        '    js = {}',
+        '    val = self._id',
+        '    if val is not None:',
+        '        js["_id"] = val',
+    ]
+    for field in fields:
+        lines.append('    js[{0!r}] = self.{0}'.format(field.name))
+    lines += [
+        '    overflow = self._overflow',
+        '    if overflow:',
+        '        js.update(overflow)',
+        '    return js',
+        '',
+    ]
+    for method, convert in (('as_json', '_as_json'), ('for_api', '_for_api')):
+        body = [
+            '    js = {}',
+            '    val = self._id',
+            '    if val is not None:',
+            '        js["_id"] = val',
+        ]
+        for field in fields:
+            body += [
+                '    val = self.{}'.format(field.name),
+                '    js[{!r}] = val if type(val) in _plain else {}(val)'.format(field.name, convert),
+            ]
+        body += [
+            '    overflow = self._overflow',
+            '    if overflow:',
+            '        for key, val in overflow.items():',
+            '            js[key] = val if type(val) in _plain else {}(val)'.format(convert),
+        ]
+        if 'for_api' == method:
+            body += [
+                '    skip = self.json_serializer().api_omit',
+                '    if omit:',
+                '        skip = skip.union(omit)',
+                '    for key in skip:',
+                '        js.pop(key, None)',
+            ]
+        signature = '(self{})'.format(', omit=None' if 'for_api' == method else '')
+        lines.append('def _render_{}{}:'.format(method, signature))
+        lines += body
+        lines += [
+            '    return js',
+            '',
+            'def {}{}:'.format(method, signature),
+            '    if self.__class__.render_cache:',
+            '        return self.cached_render({!r}, {}, _render_{}, self{})'.format(method, 'omit' if 'for_api' == method else 'None', method, ', omit' if 'for_api' == method else ''),
+            '    start = _perf_counter() if _instrumentation.enabled else None',
+        ]
+        lines += body
+        lines += [
+            '    if start is not None:',
+            '        _instrumentation.record_serialization(self.__class__, _perf_counter() - start)',
+            '    return js',
+            '',
+        ]
+    
+    source = '\n'.join(lines)
+    exec(compile(source, '<schema of {}>'.format(cls.__qualname__), 'exec'), env)
+    env['as_json'].stock_serializer = True
+    env['for_api'].stock_serializer = True
+    return {name: env[name] for name in ('__init__', 'update_with', 'json_fields', 'as_json', 'for_api')}
+
+
+class SchemaMeta(type):
+    """ Metaclass of `SchemaDocument`: turns the `fields` a class declares
+    into slots and generates methods specialized for them.
+    """
+    
+    def __new__(mcs, name, bases, namespace):
+        declared = namespace.get('fields')
+        inherited = []
+        for base in bases:
+            for field in getattr(base, 'schema_fields', ()):
+                if field.name not in [f.name for f in inherited]:
+                    inherited.append(field)
+        if declared is not None:
+            declared = [f if isinstance(f, Field) else Field(f) for f in declared]
+        else:
+            declared = []
+        if '__slots__' not in namespace:
+            namespace['__slots__'] = tuple(f.name for f in declared if f.name not in [i.name for i in inherited])
+        
+        fields = list(inherited)
+        for field in declared:
+            names = [f.name for f in fields]
+            if field.name in names:
+                fields[names.index(field.name)] = field
+            else:
+                fields.append(field)
+        
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls.schema_fields = tuple(fields)
+        cls.schema_field_map = {f.name: f for f in fields}
+        if 'fields' in namespace:
+            for method_name, method in _compile(cls, fields).items():
+                if method_name not in namespace:
+                    method.__qualname__ = '{}.{}'.format(cls.__qualname__, method_name)
+                    setattr(cls, method_name, method)
+        return cls
+
+
+class SchemaDocument(BaseDocument, metaclass=SchemaMeta):
+    """ A document whose subclasses declare their fields, as names or
+    `Field` instances:
+        
+        class Person(SchemaDocument):
+            fields = ('name', Field('tags', default=list), Field('address', doctype=Address))
+    
+    Declared fields live in slots instead of a per-instance dictionary, which
+    takes considerably less memory and makes attribute access faster.
+    Instance methods are generated for the declared fields. Keys that aren't
+    declared go to an overflow dictionary that is only created when needed.
+    
+    Unlike with JSONDocument, reading an attribute that is neither declared
+    nor in the overflow dictionary raises an `AttributeError`, so misspelled
+    field names don't go unnoticed. Deleting a declared field resets it to
+    its default.
+    """
+    __slots__ = ('__weakref__', '_id', '_overflow')
+    
+    fields = ()
+    
+    def __getattr__(self, name):
+        if '_docstate' == name or '_overflow' == name:
+            return None
+        overflow = self._overflow
+        if overflow is not None and name in overflow:
+            return overflow[name]
+        raise AttributeError('"{}" has no field "{}"'.format(self.__class__.__name__, name))
+    
+    def __delattr__(self, name):
+        field = self.schema_field_map.get(name)
+        if field is not None:
+            object.__setattr__(self, name, field.make_default())
+        else:
+            overflow = self._overflow
+            if not overflow or name not in overflow:
+                raise AttributeError('"{}" has no field "{}"'.format(self.__class__.__name__, name))
+            del overflow[name]
+        self.mark_changed(name)
+    
+    def get_value(self, name, default=None):
+        if name in self.schema_field_map or '_id' == name:
+            return getattr(self, name)
+        overflow = self._overflow
+        if overflow is None:
+            return default
+        return overflow.get(name, default)
+    
+    def set_value(self, name, value):
+        field = self.schema_field_map.get(name)
+        if field is not None:
+            object.__setattr__(self, name, field.convert(value))
+        elif name in ('_id', '_overflow', '_docstate') or isinstance(getattr(self.__class__, name, None), property):
+            object.__setattr__(self, name, value)
+        else:
+            overflow = self._overflow
+            if overflow is None:
+                overflow = {}
+                object.__setattr__(self, '_overflow', overflow)
+            overflow[name] = value
+    
+    @classmethod
+    def adopt(cls, json):
+        """ Declared fields live in slots, so there is no dictionary to
+        adopt; instantiates the document the usual way. """
+        return cls(None, json=json)
+    
+    def take_contents_from(self, other):
+        object.__setattr__(self, '_id', other._id)
+        for field in self.schema_fields:
+            object.__setattr__(self, field.name, getattr(other, field.name))
+        object.__setattr__(self, '_overflow', dict(other._overflow) if other._overflow else None)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest schemadocument_test.py
+
+import gc
+import sys
+import json
+import unittest
+import tracemalloc
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from .schemadocument import SchemaDocument, Field
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    from schemadocument import SchemaDocument, Field
+
+
+class Address(JSONDocument):
+    pass
+
+class Person(SchemaDocument):
+    fields = ('name', Field('tags', default=list), Field('address', doctype=Address))
+
+class Employee(Person):
+    fields = (Field('salary', default=0),)
+
+
+class Point(SchemaDocument):
+    fields = ('a', 'b', 'c', 'd', 'e')
+
+class FreePoint(JSONDocument):
+    pass
+
+
+class TestSchemaDocument(unittest.TestCase):
+    
+    def test_init(self):
+        """ Test initialization of declared and undeclared fields. """
+        doc = Person(None, 'person', {'_id': 'p', 'name': 'Ann', 'address': {'city': 'Bern'}, 'nick': 'A'})
+        self.assertEqual('p', doc.id)
+        self.assertEqual('Ann', doc.name)
+        self.assertEqual([], doc.tags, 'Must use defaults for missing fields')
+        self.assertIsNot(doc.tags, Person(None).tags, 'Must not share mutable defaults')
+        self.assertIsInstance(doc.address, Address)
+        self.assertIsNone(doc.address.id, 'Must not assign ids to embedded documents')
+        self.assertEqual('A', doc.nick, 'Must keep undeclared keys')
+        self.assertEqual('person', doc.type)
+        with self.assertRaises(AttributeError, msg="Must not silently return None for unknown fields"):
+            doc.naem
+        self.assertIn('name', Person.__slots__)
+    
+    def test_serialization(self):
+        """ Test that generated methods serialize like JSONDocument does. """
+        js = {'_id': 'e', 'name': 'Bob', 'tags': ['x'], 'address': {'city': 'Basel'}, 'salary': 10, 'nick': 'B'}
+        doc = Employee(None, json=js)
+        self.assertEqual('e', js['_id'], 'Must not remove the id from the dictionary')
+        self.assertEqual(js, doc.as_json())
+        self.assertEqual(js, Employee.adopt(js).as_json())
+        plain = JSONDocument(None, json=dict(js))
+        self.assertEqual(plain.for_api(omit=['salary']), doc.for_api(omit=['salary']))
+        doc.update_with({'salary': 20, 'mood': 'good'})
+        self.assertEqual(20, doc.as_json()['salary'])
+        self.assertEqual('good', doc.as_json()['mood'])
+        self.assertEqual(doc.as_json(), json.loads(doc.to_json_bytes().decode('utf-8')))
+        self.assertEqual(doc.for_api(omit=['name']), json.loads(doc.for_api_bytes(omit=['name']).decode('utf-8')))
+        
+        class Cached(Employee):
+            render_cache = True
+        doc = Cached(None, json=js)
+        api = doc.for_api()
+        self.assertIs(api, doc.for_api())
+        doc.update_with({'salary': 30})
+        self.assertEqual(30, doc.for_api()['salary'], 'Must render again after updates')
+        doc.address.city = 'Bern'
+        self.assertEqual('Bern', doc.as_json()['address']['city'])
+        api = doc.for_api()
+        doc.address.city = 'Thun'
+        self.assertEqual('Thun', doc.for_api()['address']['city'], 'Must notice changes to embedded documents')
+    
+    def test_store(self):
+        """ Test that changes to declared fields are tracked. """
+        server = MemoryServer()
+        doc = Employee('e', json={'name': 'Eve'})
+        doc.store_to(server, 'b')
+        loaded = Employee('e')
+        loaded.load_from(server, 'b')
+        self.assertEqual('Eve', loaded.name)
+        loaded.salary = 5
+        loaded.nick = 'E'
+        del loaded.name
+        self.assertEqual(['name', 'nick', 'salary'], loaded.changes)
+        loaded.store_to(server, 'b')
+        self.assertEqual({'_id': 'e', 'name': None, 'tags': [], 'address': None, 'salary': 5, 'nick': 'E'}, server.load_document('b', 'e'))
+    
+    def test_memory(self):
+        """ Test that instances don't have a dictionary and take less memory
+        than JSONDocument instances. """
+        self.assertFalse(hasattr(Point(None), '__dict__'), 'Must not have an instance dictionary')
+        def bytes_per_instance(cls):
+            sources = [{'_id': str(i), 'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5} for i in range(2000)]
+            gc.collect()
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                docs = [cls(None, json=source) for source in sources]
+                return (tracemalloc.get_traced_memory()[0] - before) / len(docs)
+            finally:
+                tracemalloc.stop()
+        schema = bytes_per_instance(Point)
+        self.assertLess(schema, 16 + 16 + 8 * 9 + 16, 'Must take no more than the object header and its slots')
+        
+        source = {'_id': 'p', 'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5}
+        slots = [name for cls in Point.__mro__ for name in cls.__dict__.get('__slots__', ())]
+        self.assertEqual(9, len(slots))
+        Slotted = type('Slotted', (), {'__slots__': tuple(name.strip('_') for name in slots)})
+        point = Point(None, json=source)
+        self.assertEqual(sys.getsizeof(Slotted()), sys.getsizeof(point), 'Must be as large as a plain instance with the same slots')
+        free = FreePoint(None, json=source)
+        self.assertLessEqual(sys.getsizeof(point) + 128, sys.getsizeof(free) + sys.getsizeof(free.__dict__))
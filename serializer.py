@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Turning JSON documents into JSON-ready dictionaries and JSON bytes
+
+import json
+import threading
+import collections
+
+
+def stock(method):
+    """ Marks `as_json` and `for_api` implementations that just serialize
+    `json_fields()`, so serializers can skip calling them for nested
+    documents.
+    """
+    method.stock_serializer = True
+    return method
+
+
+def instance_fields(method):
+    """ Marks `json_fields` implementations that return the instance
+    dictionary unless the document has values not hydrated yet, so
+    serializers can read the dictionary directly.
+    """
+    method.instance_fields = True
+    return method
+
+
+_plain_types = frozenset((str, int, float, bool, type(None)))
+
+_serializers = {}
+""" The `Serializer` of each JSONDocument subclass serialized so far, None
+for other classes found in documents. """
+
+
+def to_json(value):
+    """ Returns the value with all JSONDocuments, however deeply nested in
+    lists, tuples and dictionaries, replaced by their `as_json()`.
+    """
+    typ = type(value)
+    if typ in _plain_types:
+        return value
+    if typ is list or typ is tuple:
+        return [v if type(v) in _plain_types else to_json(v) for v in value]
+    if typ is dict:
+        return _converted(value, to_json)
+    ser = _serializers[typ] if typ in _serializers else _serializer_of(value)
+    if ser is not None:
+        return ser.as_json(value)
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {k: to_json(v) for k, v in value.items()}
+    return value
+
+
+def document_to_json(doc):
+    """ `to_json()` of the document's fields. Values of `embedded`
+    attributes that haven't been hydrated yet are returned as they are. """
+    lazy = doc._lazy
+    if not lazy:
+        return to_json(doc.json_fields())
+    js = to_json({k: v for k, v in doc.json_fields().items() if k not in lazy})
+    js.update(lazy)
+    return js
+
+
+def for_api(value):
+    """ Returns the value with all JSONDocuments, however deeply nested in
+    lists, tuples and dictionaries, replaced by their `for_api()`.
+    """
+    typ = type(value)
+    if typ in _plain_types:
+        return value
+    if typ is list or typ is tuple:
+        return [v if type(v) in _plain_types else for_api(v) for v in value]
+    if typ is dict:
+        return _converted(value, for_api)
+    ser = _serializers[typ] if typ in _serializers else _serializer_of(value)
+    if ser is not None:
+        return ser.for_api(value)
+    if isinstance(value, (list, tuple)):
+        return [for_api(v) for v in value]
+    if isinstance(value, dict):
+        return {k: for_api(v) for k, v in value.items()}
+    return value
+
+
+def _converted(dictionary, convert):
+    """ A copy of the dictionary with `convert` applied to values that
+    aren't plain; copying first is faster than building a new one. """
+    js = dictionary.copy()
+    for key, val in js.items():
+        if type(val) not in _plain_types:
+            js[key] = convert(val)
+    return js
+
+
+def _serializer_of(value):
+    cls = value.__class__
+    ser = _serializers.get(cls)
+    if ser is None:
+        get = getattr(cls, 'json_serializer', None)
+        ser = get() if get is not None else None
+        _serializers[cls] = ser
+    return ser
+
+
+class Serializer(object):
+    """ Serializes instances of one JSONDocument subclass. Created once per
+    class by `JSONDocument.json_serializer()`, which is when it decides how
+    to serialize them: by calling their own `as_json()` or `for_api()` if
+    they override it, from their instance dictionary if their fields are
+    kept there, or from `json_fields()` otherwise. Nested documents are
+    looked up by class in a dictionary of the serializers made so far.
+    
+    For JSON bytes, each document only contributes a shallow mapping of its
+    fields; nested lists, dictionaries and values are written by the
+    C-accelerated encoder of the `json` module, which comes back for every
+    nested document it encounters.
+    """
+    
+    def __init__(self, cls):
+        self.cls = cls
+        self.custom_as_json = not getattr(cls.as_json, 'stock_serializer', False)
+        self.custom_for_api = not getattr(cls.for_api, 'stock_serializer', False)
+        self.api_omit = frozenset(getattr(cls, 'api_omit', None) or ())
+        direct = getattr(cls.json_fields, 'instance_fields', False)
+        
+        self.render_json = _dict_to_json if direct else document_to_json
+        if direct and 0 == len(self.api_omit):
+            self.render_api = self._render_api_direct
+            self.api_fields = self._api_fields_direct
+        else:
+            self.render_api = self._render_api
+            self.api_fields = self.fields
+        self.as_json = _call_as_json if self.custom_as_json else self.render_json
+        self.for_api = _call_for_api if self.custom_for_api else self.render_api
+        _serializers[cls] = self
+    
+    def fields(self, doc, omit=None):
+        """ The document's fields for the API, without those in `omit` and
+        in the class' `api_omit`. Embedded documents not yet hydrated are, so
+        their classes can leave out fields too.
+        """
+        if doc._lazy:
+            doc.hydrate()
+        fields = doc.json_fields()
+        omit = self.api_omit.union(omit) if omit else self.api_omit
+        if omit:
+            fields = {k: v for k, v in fields.items() if k not in omit}
+        return fields
+    
+    def _render_api(self, doc, omit=None):
+        return for_api(self.fields(doc, omit))
+    
+    def _render_api_direct(self, doc, omit=None):
+        state = doc._docstate
+        if omit or (state is not None and state.lazy):
+            return for_api(self.fields(doc, omit))
+        js = _converted(doc.__dict__, for_api)
+        if js.get('_id', 0) is None:
+            del js['_id']
+        return js
+    
+    def _api_fields_direct(self, doc, omit=None):
+        state = doc._docstate
+        if omit or (state is not None and state.lazy):
+            return self.fields(doc, omit)
+        js = doc.__dict__
+        if js.get('_id', 0) is None:
+            return {k: v for k, v in js.items() if '_id' != k}
+        return js
+    
+    def shallow(self, doc, api, omit=None):
+        """ A mapping of the document's fields for the JSON encoder, nested
+        documents left in place.
+        """
+        if api:
+            if self.custom_for_api:
+                return doc.for_api(omit) if omit else doc.for_api()
+            return self.api_fields(doc, omit)
+        if self.custom_as_json:
+            return doc.as_json()
+        return doc.json_fields()
+    
+    def to_json_bytes(self, doc):
+        return _json_encoder.encode(self.shallow(doc, False)).encode('utf-8')
+    
+    def for_api_bytes(self, doc, omit=None):
+        return _api_encoder.encode(self.shallow(doc, True, omit)).encode('utf-8')
+
+
+def _dict_to_json(doc):
+    """ `document_to_json()` for documents keeping their fields in their
+    instance dictionary. """
+    state = doc._docstate
+    if state is not None and state.lazy:
+        return document_to_json(doc)
+    js = _converted(doc.__dict__, to_json)
+    if js.get('_id', 0) is None:
+        del js['_id']
+    return js
+
+def _call_as_json(doc):
+    return doc.as_json()
+
+def _call_for_api(doc, omit=None):
+    return doc.for_api(omit) if omit else doc.for_api()
+
+def _default_json(value):
+    typ = type(value)
+    ser = _serializers[typ] if typ in _serializers else _serializer_of(value)
+    if ser is not None:
+        return ser.shallow(value, False)
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError('Object of type {} is not JSON serializable'.format(value.__class__.__name__))
+
+def _default_api(value):
+    typ = type(value)
+    ser = _serializers[typ] if typ in _serializers else _serializer_of(value)
+    if ser is not None:
+        return ser.shallow(value, True)
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError('Object of type {} is not JSON serializable'.format(value.__class__.__name__))
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default_json)
+_api_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_default_api)
+
+
+class RenderCache(object):
+    """ A process-wide, bounded cache of the serialized output of documents
+    as they are stored on the server. Assign one to the `render_cache` of
+    JSONDocument subclasses, several classes can share one.
+    
+    Only documents that have been loaded from or stored to a server and not
+    changed since are looked up, by class and id, and output is only handed
+    to instances whose content as loaded equals the content it was rendered
+    from, so an instance loaded after another process changed the document
+    doesn't get the old output. Storing or removing a document through
+    JSONDocument evicts it.
+    """
+    
+    def __init__(self, max_size=10000):
+        """
+        :param int max_size: The number of documents to keep output of, the
+            least recently used ones are evicted first
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.documents = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, cls, doc_id, key, source):
+        """ Returns the output cached for the given document and key, which
+        tells the kind of output and the omitted keys, or None.
+        
+        :param dict source: The document's fields as loaded, which must
+            equal those the output was rendered from
+        """
+        with self.lock:
+            entry = self.documents.get((cls, doc_id))
+            found = entry[1].get(key) if entry is not None and entry[0] == source else None
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.documents.move_to_end((cls, doc_id))
+            return found
+    
+    def put(self, cls, doc_id, key, output, source):
+        """ Caches output rendered from `source`, replacing the output of
+        other content of the same document. """
+        with self.lock:
+            entry = self.documents.get((cls, doc_id))
+            if entry is None or entry[0] != source:
+                entry = (source, {})
+                self.documents[(cls, doc_id)] = entry
+                self.documents.move_to_end((cls, doc_id))
+                while len(self.documents) > self.max_size:
+                    self.documents.popitem(last=False)
+            else:
+                self.documents.move_to_end((cls, doc_id))
+            entry[1][key] = output
+    
+    def invalidate(self, cls, doc_id):
+        """ Forgets all output of the given document. """
+        with self.lock:
+            self.documents.pop((cls, doc_id), None)
+    
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+    
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.documents), 'hits': self.hits, 'misses': self.misses}
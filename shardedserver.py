@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Spreading buckets and documents across several JSONServer instances
+
+import heapq
+import bisect
+import hashlib
+import itertools
+import threading
+import collections
+import concurrent.futures
+
+if __package__:
+    from .jsonserver import JSONServer
+    from . import query
+else:
+    from jsonserver import JSONServer
+    import query
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """ A consistent hash ring: every shard gets `virtual_nodes` points on the
+    ring and a key belongs to the shard owning the next point. Adding a shard
+    only moves the keys that land on its points.
+    """
+    
+    def __init__(self, names, virtual_nodes=100):
+        points = []
+        for name in names:
+            for i in range(virtual_nodes):
+                points.append((_hash('{}#{}'.format(name, i)), name))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.names = [point[1] for point in points]
+    
+    def owner(self, key):
+        """ Returns the name of the shard owning the given key.
+        """
+        if 0 == len(self.hashes):
+            raise Exception('No shards to pick from')
+        i = bisect.bisect(self.hashes, _hash(key))
+        return self.names[i % len(self.names)]
+
+
+class _Descending(object):
+    """ Wraps a sort key to invert its order. """
+    __slots__ = ('key',)
+    
+    def __init__(self, key):
+        self.key = key
+    
+    def __lt__(self, other):
+        return other.key < self.key
+    
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class ShardedServer(JSONServer):
+    """ Spreads documents across several servers, the shards.
+    
+    Documents are routed by consistent hashing of their `_id`, unless their
+    bucket is listed in `bucket_routes`, in which case the whole bucket lives
+    on one shard. Loading, storing, updating and removing a document talks to
+    its shard only. `find()` on hashed buckets asks all shards in parallel
+    and merges their results in sort order before applying skip and limit.
+    
+    After `add_shard()`, call `rebalance()` for every hashed bucket to move
+    documents to their new shards. Until then, documents not found on their
+    new shard are looked for, updated and removed on the ones they used to
+    live on, under every ring since the last `finish_rebalancing()`.
+    """
+    
+    def __init__(self, shards, bucket_routes=None, virtual_nodes=100, max_workers=16):
+        """
+        :param shards: A dictionary of servers by shard name, or a list of
+            servers that are named by their position
+        :param dict bucket_routes: Shard names by bucket name, for buckets
+            that live on one shard
+        :param int virtual_nodes: The number of ring points per shard
+        :param int max_workers: The number of shards queried in parallel
+        """
+        super().__init__()
+        if not isinstance(shards, dict):
+            shards = collections.OrderedDict((str(i), server) for i, server in enumerate(shards))
+        for name, server in shards.items():
+            if not isinstance(server, JSONServer):
+                raise Exception('Need a JSONServer instance for shard "{}" but got {}'.format(name, server))
+        self.shards = collections.OrderedDict(shards)
+        self.id_generator = next(iter(self.shards.values())).id_generator if self.shards else None
+        self.bucket_routes = dict(bucket_routes or {})
+        for bucket, name in self.bucket_routes.items():
+            if name not in self.shards:
+                raise Exception('Bucket "{}" is routed to unknown shard "{}"'.format(bucket, name))
+        self.virtual_nodes = virtual_nodes
+        self.ring = HashRing(self.shards.keys(), virtual_nodes)
+        self.previous_rings = []
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='shard')
+    
+    def shard_name(self, bucket, doc_id):
+        """ Returns the name of the shard the given document lives on.
+        """
+        routed = self.bucket_routes.get(bucket)
+        if routed is not None:
+            return routed
+        return self.ring.owner(str(doc_id))
+    
+    def shard_for(self, bucket, doc_id):
+        """ Returns the server the given document lives on.
+        """
+        return self.shards[self.shard_name(bucket, doc_id)]
+    
+    def previous_shards(self, bucket, doc_id):
+        """ Returns the servers the given document may have lived on before
+        shards were added, newest first, not including its current shard.
+        """
+        if not self.previous_rings or bucket in self.bucket_routes:
+            return []
+        key = str(doc_id)
+        seen = {self.ring.owner(key)}
+        found = []
+        for ring in reversed(self.previous_rings):
+            name = ring.owner(key)
+            if name not in seen:
+                seen.add(name)
+                found.append(self.shards[name])
+        return found
+    
+    def add_shard(self, name, server):
+        """ Adds a shard to the hash ring. Existing documents stay where they
+        are until `rebalance()` moves them.
+        """
+        if not isinstance(server, JSONServer):
+            raise Exception('Need a JSONServer instance but got {}'.format(server))
+        with self.lock:
+            if name in self.shards:
+                raise Exception('There already is a shard named "{}"'.format(name))
+            self.previous_rings.append(self.ring)
+            self.shards[name] = server
+            self.ring = HashRing(self.shards.keys(), self.virtual_nodes)
+    
+    def rebalance(self, buckets, batch_size=500):
+        """ Moves the documents of the given hashed buckets to the shards
+        they belong to. Documents are stored on their new shard before they
+        are removed from the old one.
+        
+        :param list buckets: The names of the buckets to rebalance
+        :param int batch_size: The number of documents to read and move at once
+        :returns: The number of documents moved
+        """
+        moved = 0
+        for bucket in buckets:
+            if bucket in self.bucket_routes:
+                continue
+            for name, server in list(self.shards.items()):
+                misplaced = []
+                for batch in server.find_batches(bucket, {}, batch_size):
+                    targets = collections.defaultdict(list)
+                    for doc in batch:
+                        owner = self.ring.owner(str(doc['_id']))
+                        if owner != name:
+                            targets[owner].append(doc)
+                    for owner, docs in targets.items():
+                        misplaced.extend(doc['_id'] for doc in docs)
+                        self.shards[owner].store_documents(bucket, docs)
+                for doc_id in misplaced:
+                    server.remove_document(bucket, doc_id)
+                moved += len(misplaced)
+        return moved
+    
+    def finish_rebalancing(self):
+        """ Stops looking for documents on the shards they lived on before
+        shards were added, call once all buckets have been rebalanced.
+        """
+        with self.lock:
+            self.previous_rings = []
+    
+    def close(self):
+        """ Shuts down the thread pool used to query shards in parallel.
+        """
+        self.executor.shutdown(wait=True)
+    
+    
+    # MARK: - Overrides
+    
+    def load_document(self, bucket, doc_id):
+        doc = self.shard_for(bucket, doc_id).load_document(bucket, doc_id)
+        if doc is None:
+            for server in self.previous_shards(bucket, doc_id):
+                doc = server.load_document(bucket, doc_id)
+                if doc is not None:
+                    break
+        return doc
+    
+    def load_documents(self, bucket, doc_ids):
+        if self.previous_rings:
+            return super().load_documents(bucket, doc_ids)
+        groups = self._group(bucket, doc_ids, lambda doc_id: doc_id)
+        loaded = self._scatter([(name, 'load_documents', ids) for name, ids in groups.items()], bucket)
+        found = {}
+        for (name, ids), docs in zip(groups.items(), loaded):
+            found.update(zip(ids, docs))
+        return [found.get(doc_id) for doc_id in doc_ids]
+    
+    def add_documents(self, bucket, documents):
+        if isinstance(documents, dict):
+            documents = [documents]
+        for doc in documents:
+            if doc.get('_id') is None:
+                doc['_id'] = self.new_id()
+        groups = self._group(bucket, documents, lambda doc: doc['_id'])
+        self._scatter([(name, 'add_documents', docs) for name, docs in groups.items()], bucket)
+        return [doc['_id'] for doc in documents]
+    
+    def store_document(self, bucket, document):
+        if document.get('_id') is None:
+            document = dict(document)
+            document['_id'] = self.new_id()
+        return self.shard_for(bucket, document['_id']).store_document(bucket, document)
+    
+    def store_documents(self, bucket, documents):
+        documents = [doc if doc.get('_id') is not None else dict(doc, _id=self.new_id()) for doc in documents]
+        groups = self._group(bucket, documents, lambda doc: doc['_id'])
+        self._scatter([(name, 'store_documents', docs) for name, docs in groups.items()], bucket)
+        return [doc['_id'] for doc in documents]
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        found = self.shard_for(bucket, doc_id).update_document(bucket, doc_id, values, unset)
+        if found is False:
+            for server in self.previous_shards(bucket, doc_id):
+                found = server.update_document(bucket, doc_id, values, unset)
+                if found is not False:
+                    break
+        return found
+    
+    def remove_document(self, bucket, doc_id):
+        self.shard_for(bucket, doc_id).remove_document(bucket, doc_id)
+        for server in self.previous_shards(bucket, doc_id):
+            server.remove_document(bucket, doc_id)
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        """ Asks every shard for its first `skip + limit` matches in parallel
+        and merges them.
+        """
+        routed = self.bucket_routes.get(bucket)
+        if routed is not None:
+            if fields is None:
+                return self.shards[routed].find(bucket, dictionary, skip, limit, sort, descending)
+            return self.shards[routed].find(bucket, dictionary, skip, limit, sort, descending, fields)
+        skip = skip or 0
+        end = skip + limit if limit else None
+        shard_fields, fields = self._fields(fields, sort, descending)
+        args = (dictionary, 0, end or limit, sort, descending) + (() if shard_fields is None else (shard_fields,))
+        calls = [(name, 'find') + args for name in self.shards.keys()]
+        found = [list(docs or []) for docs in self._scatter(calls, bucket)]
+        found = list(itertools.islice(self._merge(found, sort, descending), skip, end))
+        if fields is not None:
+            found = [query.project(doc, fields) for doc in found]
+        return found
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Walks the results of all shards at once, merging them in sort
+        order one document at a time.
+        """
+        routed = self.bucket_routes.get(bucket)
+        if routed is not None:
+            if fields is None:
+                yield from self.shards[routed].find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit)
+            else:
+                yield from self.shards[routed].find_batches(bucket, dictionary, batch_size, sort, descending, skip, limit, fields)
+            return
+        skip = skip or 0
+        end = skip + limit if limit else None
+        shard_fields, fields = self._fields(fields, sort, descending)
+        args = (bucket, dictionary, batch_size, sort, descending, 0, end) + (() if shard_fields is None else (shard_fields,))
+        streams = [itertools.chain.from_iterable(server.find_batches(*args)) for server in self.shards.values()]
+        merged = itertools.islice(self._merge(streams, sort, descending), skip, end)
+        while True:
+            batch = list(itertools.islice(merged, batch_size))
+            if fields is not None:
+                batch = [query.project(doc, fields) for doc in batch]
+            if len(batch) > 0:
+                yield batch
+            if len(batch) < batch_size:
+                break
+    
+    def count(self, bucket, dictionary):
+        routed = self.bucket_routes.get(bucket)
+        if routed is not None:
+            return self.shards[routed].count(bucket, dictionary)
+        return sum(self._scatter([(name, 'count', dictionary) for name in self.shards.keys()], bucket))
+    
+    def native_id(self, doc_id):
+        return next(iter(self.shards.values())).native_id(doc_id)
+    
+    def cached_instance(self, cls, bucket, doc_id):
+        return self.shard_for(bucket, doc_id).cached_instance(cls, bucket, doc_id)
+    
+    def cache_instance(self, instance, bucket):
+        self.shard_for(bucket, instance.id).cache_instance(instance, bucket)
+    
+    
+    # MARK: - Internals
+    
+    def _group(self, bucket, items, doc_id_of):
+        groups = collections.OrderedDict()
+        for item in items:
+            groups.setdefault(self.shard_name(bucket, doc_id_of(item)), []).append(item)
+        return groups
+    
+    def _scatter(self, calls, bucket):
+        """ Runs one method call per shard, in parallel if there's more than
+        one, and returns the results in the order of `calls`.
+        """
+        def call(name, method, *args):
+            return getattr(self.shards[name], method)(bucket, *args)
+        if len(calls) < 2:
+            return [call(*c) for c in calls]
+        futures = [self.executor.submit(call, *c) for c in calls]
+        return [future.result() for future in futures]
+    
+    def _fields(self, fields, sort, descending):
+        """ Returns the fields to ask shards for, which include the sort key
+        paths needed to merge, and the fields to project merged results to
+        if those differ.
+        """
+        fields = query.projection_fields(fields)
+        if fields is None:
+            return None, None
+        missing = [keypath for keypath, desc in query.sort_spec(sort, descending) if keypath not in fields]
+        if 0 == len(missing):
+            return fields, None
+        return fields + missing, fields
+    
+    def _merge(self, results, sort, descending):
+        spec = query.sort_spec(sort, descending)
+        if 0 == len(spec):
+            return itertools.chain.from_iterable(results)
+        def key(doc):
+            return tuple(_Descending(query.document_sort_key(doc, keypath, True)) if desc
+                else query.document_sort_key(doc, keypath) for keypath, desc in spec)
+        return heapq.merge(*results, key=key)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest shardedserver_test.py
+
+import unittest
+if __package__:
+    from .jsonserver import JSONServer
+    from .memoryserver import MemoryServer
+    from .shardedserver import ShardedServer
+else:
+    from jsonserver import JSONServer
+    from memoryserver import MemoryServer
+    from shardedserver import ShardedServer
+
+
+class TestShardedServer(unittest.TestCase):
+    
+    def setUp(self):
+        self.shards = [MemoryServer() for i in range(3)]
+        self.server = ShardedServer(self.shards, bucket_routes={'single': '1'})
+        self.reference = MemoryServer()
+        docs = [{'_id': str(i), 'n': i % 7, 'tags': [i % 3, i % 5]} for i in range(100)]
+        self.server.add_documents('b', [dict(d) for d in docs])
+        self.reference.add_documents('b', [dict(d) for d in docs])
+    
+    def tearDown(self):
+        self.server.close()
+    
+    def test_routing(self):
+        """ Test that documents live on exactly one shard. """
+        sizes = [len(shard.bucket('b')) for shard in self.shards]
+        self.assertEqual(100, sum(sizes))
+        self.assertTrue(all(size > 0 for size in sizes), 'Must spread documents across shards')
+        self.assertEqual({'_id': '42', 'n': 0, 'tags': [0, 2]}, self.server.load_document('b', '42'))
+        self.assertEqual(['3', None, '4'], [d['_id'] if d else None for d in self.server.load_documents('b', ['3', 'x', '4'])])
+        self.server.update_document('b', '42', {'n': 100})
+        self.assertEqual(100, self.server.shard_for('b', '42').load_document('b', '42')['n'])
+        self.server.remove_document('b', '42')
+        self.assertIsNone(self.server.load_document('b', '42'))
+        
+        self.server.store_documents('single', [{'_id': str(i)} for i in range(10)])
+        self.assertEqual(10, len(self.shards[1].bucket('single')), 'Must keep routed buckets on one shard')
+        self.assertEqual(10, len(self.server.find('single', {}, limit=None)))
+    
+    def test_find(self):
+        """ Test that merged results match those of a single server. """
+        queries = [
+            ({}, 0, 10, 'n', False),
+            ({}, 15, 20, 'n', True),
+            ({'n': {'$gt': 2}}, 5, 0, [('n', -1), ('_id', 1)], False),
+            ({}, 0, 5, 'tags', True),
+        ]
+        for dictionary, skip, limit, sort, descending in queries:
+            expected = self.reference.find('b', dictionary, skip, limit, sort, descending)
+            found = self.server.find('b', dictionary, skip, limit, sort, descending)
+            if isinstance(sort, list):
+                self.assertEqual(expected, found)
+            else:
+                self.assertEqual([max(d['tags']) if 'tags' == sort else d['n'] for d in expected],
+                    [max(d['tags']) if 'tags' == sort else d['n'] for d in found])
+        self.assertEqual(12, len(self.server.find('b', {}, 88, 50)))
+        
+        batches = list(self.server.find_batches('b', {}, 30, [('n', 1), ('_id', -1)], skip=10, limit=45))
+        self.assertEqual([30, 15], [len(batch) for batch in batches])
+        self.assertEqual(self.reference.find('b', {}, 10, 45, [('n', 1), ('_id', -1)]), batches[0] + batches[1])
+    
+    def test_shards_without_fields(self):
+        """ Test shards whose `find()` predates field projection. """
+        shards = [FieldlessServer() for i in range(2)]
+        server = ShardedServer(shards, bucket_routes={'single': '0'})
+        try:
+            server.add_documents('b', [{'_id': str(i), 'n': i} for i in range(10)])
+            server.add_documents('single', [{'_id': str(i), 'n': i} for i in range(10)])
+            for bucket in ['b', 'single']:
+                self.assertEqual([9, 8], [d['n'] for d in server.find(bucket, {}, 0, 2, 'n', True)])
+                self.assertEqual([4, 3], [len(batch) for batch in server.find_batches(bucket, {'n': {'$gt': 2}}, 4)])
+                self.assertEqual(10, server.count(bucket, {}))
+        finally:
+            server.close()
+    
+    def test_rebalance(self):
+        """ Test moving documents to a new shard. """
+        extra = MemoryServer()
+        self.server.add_shard('new', extra)
+        for i in range(100):
+            self.assertIsNotNone(self.server.load_document('b', str(i)), 'Must find documents before rebalancing')
+        moved = self.server.rebalance(['b'])
+        self.assertEqual(len(extra.bucket('b')), moved)
+        self.assertTrue(0 < moved < 50, 'Must only move documents belonging to the new shard')
+        self.server.finish_rebalancing()
+        self.assertEqual(100, sum(len(shard.bucket('b')) for shard in self.shards + [extra]))
+        for i in range(100):
+            self.assertEqual(str(i), self.server.load_document('b', str(i))['_id'])
+    
+    def test_changes_before_rebalancing(self):
+        """ Test updating and removing documents after adding several
+        shards, before they are rebalanced. """
+        extras = [MemoryServer(), MemoryServer()]
+        self.server.add_shard('new', extras[0])
+        self.server.update_document('b', '1', {'n': 100})
+        self.server.add_shard('newer', extras[1])
+        for i in range(100):
+            self.server.update_document('b', str(i), {'n': -i})
+        for i in range(100):
+            self.assertEqual(-i, self.server.load_document('b', str(i))['n'], 'Must update documents on the shards they live on')
+        for i in range(50):
+            self.server.remove_document('b', str(i))
+        self.server.rebalance(['b'])
+        self.server.finish_rebalancing()
+        self.assertEqual(50, sum(len(shard.bucket('b')) for shard in self.shards + extras))
+        self.assertEqual(list(range(-99, -49)), sorted(doc['n'] for doc in self.server.find('b', {}, limit=None)))
+
+
+class FieldlessServer(MemoryServer):
+    """ A server written before `find()` took `fields`, counting the way
+    `JSONServer` does. """
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False):
+        return super().find(bucket, dictionary, skip, limit, sort, descending)
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None):
+        return JSONServer.find_batches(self, bucket, dictionary, batch_size, sort, descending, skip, limit)
+    
+    def count(self, bucket, dictionary):
+        return JSONServer.count(self, bucket, dictionary)
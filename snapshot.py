@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Exporting buckets to compressed JSON Lines and importing them back
+#
+#   Run with:
+#       python3 snapshot.py export --server sqlite:app.sqlite people people.jsonl.gz
+#       python3 snapshot.py import --server mongo://localhost:27017/app people people.jsonl.gz
+
+import os
+import sys
+import gzip
+import json
+import argparse
+import collections
+import concurrent.futures
+
+if __package__:
+    from .jsonserver import JSONServer
+    from . import query
+else:
+    from jsonserver import JSONServer
+    import query
+
+
+def export_bucket(server, bucket, path, dictionary=None, chunk_size=10000, max_workers=None, level=6, resume=True, on_chunk=None):
+    """ Writes all documents of a bucket, or those matching `dictionary`, to
+    a gzip-compressed JSON Lines file.
+    
+    Documents are read with `find()` one chunk at a time, ordered by id and
+    continuing after the last id of the previous chunk. Each chunk is
+    serialized and compressed by a pool of worker processes into a gzip
+    member of its own; the file is their concatenation, which any gzip
+    reader reads as one stream. At most two chunks per worker are held in
+    memory.
+    
+    Datetimes and ObjectIds are written as MongoDB Extended JSON, like
+    ``{"$date": "2024-01-01T00:00:00"}``, and read back as such by
+    `import_bucket()`; other values JSON can't represent raise.
+    
+    Next to the file, ``<path>.manifest.json`` lists the offset, length and
+    document count of every member and the position to continue from. It's
+    written after each chunk, so an interrupted export picks up where it
+    stopped when run again with `resume`.
+    
+    :param JSONServer server: The server to export from
+    :param str bucket: The bucket/collection to export
+    :param str path: The file to write
+    :param dict dictionary: A query selecting the documents, None for all
+    :param int chunk_size: The number of documents per `find()` and member
+    :param int max_workers: The number of worker processes, the number of
+        CPUs if None, 0 to compress in this process
+    :param int level: The gzip compression level
+    :param bool resume: Whether to continue an interrupted export of the
+        same bucket and query instead of starting over
+    :param on_chunk: Called with the manifest after each chunk is written
+    :returns: The manifest dictionary
+    """
+    if not isinstance(server, JSONServer):
+        raise Exception('Need a JSONServer instance but got {}'.format(server))
+    if chunk_size < 1:
+        raise Exception('Need a positive chunk size, got {}'.format(chunk_size))
+    dictionary = dictionary or {}
+    manifest = read_manifest(path) if resume else None
+    if manifest is not None and (manifest.get('bucket') != bucket or manifest.get('query') != query.copy_json(dictionary)):
+        manifest = None
+    if manifest is not None and manifest.get('complete'):
+        return manifest
+    if manifest is None:
+        manifest = {'format': 1, 'bucket': bucket, 'query': query.copy_json(dictionary), 'count': 0, 'after': None, 'complete': False, 'members': []}
+    
+    size = sum(member['length'] for member in manifest['members'])
+    spec = query.page_sort_spec(None)
+    sort = [(keypath, -1 if desc else 1) for keypath, desc in spec]
+    in_flight = collections.deque()
+    workers = os.cpu_count() if max_workers is None else max_workers
+    
+    with open(path, 'r+b' if size > 0 else 'wb') as handle, _executor(workers) as executor:
+        handle.truncate(size)
+        handle.seek(size)
+        
+        def finish():
+            nonlocal size
+            count, after, future = in_flight.popleft()
+            data = future.result()
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+            manifest['members'].append({'offset': size, 'length': len(data), 'count': count})
+            size += len(data)
+            manifest['count'] += count
+            manifest['after'] = after
+            write_manifest(path, manifest)
+            if on_chunk is not None:
+                on_chunk(manifest)
+        
+        after = manifest['after']
+        while True:
+            dic = dictionary if after is None else query.page_query(dictionary, spec, after, server.native_id)
+            chunk = list(server.find(bucket, dic, 0, chunk_size, sort) or [])
+            if 0 == len(chunk):
+                break
+            after = query.page_token(chunk[-1], spec)
+            if len(in_flight) >= 2 * max(1, workers):
+                finish()
+            in_flight.append((len(chunk), after, executor.submit(_compress, chunk, level)))
+            if len(chunk) < chunk_size:
+                break
+        while len(in_flight) > 0:
+            finish()
+    
+    manifest['complete'] = True
+    write_manifest(path, manifest)
+    return manifest
+
+def import_bucket(server, bucket, path, max_workers=None, validate=None, chunk_size=10000, resume=True, on_chunk=None):
+    """ Inserts the documents of a file written by `export_bucket()` into a
+    bucket, with one `add_documents()` call per chunk.
+    
+    With a manifest, worker processes decompress and parse the gzip members
+    while earlier ones are inserted; without one, e.g. for files from
+    elsewhere, this process decompresses and the workers parse chunks of
+    `chunk_size` lines. Documents go to the server as parsed, unless
+    `validate` names a JSONDocument subclass to instantiate each with first,
+    which raises on documents it doesn't accept.
+    
+    The number of chunks inserted is kept in ``<path>.import.json``, so an
+    interrupted import continues after them when run again with `resume`.
+    The chunk that was being inserted is upserted with `store_documents()`
+    if adding it again fails, since some of it may have made it in.
+    
+    :param JSONServer server: The server to import to
+    :param str bucket: The bucket/collection to import to
+    :param str path: The file to read
+    :param int max_workers: The number of worker processes, the number of
+        CPUs if None, 0 to parse in this process
+    :param validate: A JSONDocument subclass to validate documents with
+    :param int chunk_size: The number of lines per chunk without manifest
+    :param bool resume: Whether to continue an interrupted import
+    :param on_chunk: Called with the number of documents imported so far
+        after each chunk
+    :returns: The number of documents imported, including those imported
+        before resuming
+    """
+    if not isinstance(server, JSONServer):
+        raise Exception('Need a JSONServer instance but got {}'.format(server))
+    checkpoint_path = path + '.import.json'
+    checkpoint = {'bucket': bucket, 'chunks': 0, 'count': 0}
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r', encoding='utf-8') as handle:
+            found = json.load(handle)
+        if found.get('bucket') == bucket:
+            checkpoint = found
+    resuming = checkpoint['chunks'] > 0
+    manifest = read_manifest(path)
+    if manifest is not None and not manifest.get('complete'):
+        raise Exception('The export to "{}" has not completed'.format(path))
+    workers = os.cpu_count() if max_workers is None else max_workers
+    in_flight = collections.deque()
+    
+    def finish():
+        nonlocal resuming
+        documents = in_flight.popleft().result()
+        if validate is not None:
+            documents = [validate(None, json=doc).as_json() for doc in documents]
+        try:
+            server.add_documents(bucket, documents)
+        except Exception:
+            if not resuming:
+                raise
+            server.store_documents(bucket, documents)
+        resuming = False
+        checkpoint['chunks'] += 1
+        checkpoint['count'] += len(documents)
+        _write_json(checkpoint_path, checkpoint)
+        if on_chunk is not None:
+            on_chunk(checkpoint['count'])
+    
+    with open(path, 'rb') as handle, _executor(workers) as executor:
+        if manifest is not None:
+            chunks = (_read_member(handle, member) for member in manifest['members'][checkpoint['chunks']:])
+            parse = _decompress
+        else:
+            chunks = _line_chunks(handle, chunk_size, checkpoint['chunks'])
+            parse = _parse
+        for data in chunks:
+            if len(in_flight) >= 2 * max(1, workers):
+                finish()
+            in_flight.append(executor.submit(parse, data))
+        while len(in_flight) > 0:
+            finish()
+    
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return checkpoint['count']
+
+def read_manifest(path):
+    """ Returns the manifest written next to an export, None if there is
+    none. """
+    manifest_path = path + '.manifest.json'
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as handle:
+        return json.load(handle)
+
+def write_manifest(path, manifest):
+    _write_json(path + '.manifest.json', manifest)
+
+def _write_json(path, obj):
+    """ Replaces the file atomically, so it's never seen half-written. """
+    with open(path + '.tmp', 'w', encoding='utf-8') as handle:
+        json.dump(obj, handle)
+    os.replace(path + '.tmp', path)
+
+
+# MARK: - Workers
+
+def _executor(workers):
+    if workers > 0:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return _InlineExecutor()
+
+class _InlineExecutor(object):
+    """ Stands in for a process pool when there are no workers. """
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        return False
+    
+    def submit(self, func, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def _compress(documents, level):
+    lines = [json.dumps(doc, separators=(',', ':'), ensure_ascii=False, default=query.typed_json_default) for doc in documents]
+    lines.append('')
+    return gzip.compress('\n'.join(lines).encode('utf-8'), compresslevel=level, mtime=0)
+
+def _decompress(data):
+    return _parse(gzip.decompress(data))
+
+def _parse(data):
+    return [json.loads(line, object_hook=query.typed_json_object) for line in data.decode('utf-8').splitlines() if line.strip()]
+
+def _read_member(handle, member):
+    handle.seek(member['offset'])
+    data = handle.read(member['length'])
+    if len(data) != member['length']:
+        raise Exception('The export is shorter than its manifest says')
+    return data
+
+def _line_chunks(handle, chunk_size, skip):
+    """ Yields the lines of a gzip stream, `chunk_size` lines at a time as
+    bytes, skipping the first `skip` chunks. """
+    with gzip.GzipFile(fileobj=handle) as stream:
+        index = 0
+        lines = []
+        for line in stream:
+            lines.append(line)
+            if len(lines) >= chunk_size:
+                if index >= skip:
+                    yield b''.join(lines)
+                index += 1
+                lines = []
+        if len(lines) > 0 and index >= skip:
+            yield b''.join(lines)
+
+
+# MARK: - Command Line
+
+def server_from_spec(spec):
+    """ Creates a server from a spec like ``sqlite:path/to/db.sqlite``,
+    ``log:path/to/directory`` or ``mongo://host:port/database``. """
+    if spec.startswith('sqlite:'):
+        if __package__:
+            from .sqliteserver import SQLiteServer
+        else:
+            from sqliteserver import SQLiteServer
+        return SQLiteServer(spec[len('sqlite:'):])
+    if spec.startswith('log:'):
+        if __package__:
+            from .logserver import LogServer
+        else:
+            from logserver import LogServer
+        return LogServer(spec[len('log:'):])
+    if spec.startswith('mongo://'):
+        if __package__:
+            from .mongoserver import MongoServer
+        else:
+            from mongoserver import MongoServer
+        address, _, database = spec[len('mongo://'):].partition('/')
+        host, _, port = address.partition(':')
+        return MongoServer(host or None, int(port) if port else None, database or None)
+    raise Exception('Unknown server "{}", use sqlite:PATH, log:DIRECTORY or mongo://HOST:PORT/DATABASE'.format(spec))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export buckets to compressed JSON Lines and import them back')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('bucket', help='the bucket/collection to export or import to')
+    parser.add_argument('path', help='the .jsonl.gz file to write or read')
+    parser.add_argument('-s', '--server', required=True, help='sqlite:PATH, log:DIRECTORY or mongo://HOST:PORT/DATABASE')
+    parser.add_argument('-q', '--query', help='export only documents matching this JSON query')
+    parser.add_argument('-c', '--chunk-size', type=int, default=10000, help='documents per chunk, default 10000')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='worker processes, default the number of CPUs')
+    parser.add_argument('--restart', action='store_true', help='start over instead of resuming an interrupted run')
+    args = parser.parse_args(argv)
+    
+    server = server_from_spec(args.server)
+    progress = lambda count: sys.stderr.write('\r{:,} documents'.format(count))
+    if 'export' == args.command:
+        manifest = export_bucket(server, args.bucket, args.path, json.loads(args.query) if args.query else None,
+            args.chunk_size, args.workers, resume=not args.restart, on_chunk=lambda manifest: progress(manifest['count']))
+        count = manifest['count']
+    else:
+        count = import_bucket(server, args.bucket, args.path, args.workers, chunk_size=args.chunk_size, resume=not args.restart, on_chunk=progress)
+    sys.stderr.write('\r{:,} documents {}ed\n'.format(count, args.command))
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
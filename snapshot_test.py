@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest snapshot_test.py
+
+import os
+import gzip
+import json
+import datetime
+import shutil
+import tempfile
+import unittest
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from .sqliteserver import SQLiteServer
+    from . import snapshot
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    from sqliteserver import SQLiteServer
+    import snapshot
+
+
+class Strict(JSONDocument):
+    def __init__(self, ident, doctype=None, json=None):
+        if json is not None and not isinstance(json.get('n'), int):
+            raise Exception('Need an integer "n"')
+        super().__init__(ident, doctype, json)
+
+
+class Interrupt(Exception):
+    pass
+
+
+class TestSnapshot(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'b.jsonl.gz')
+        self.source = MemoryServer()
+        self.source.add_documents('b', [{'_id': '{:04d}'.format(i), 'n': i, 'name': 'Zoë {}'.format(i)} for i in range(1000)])
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def documents(self, server):
+        return sorted(server.find('b', {}, limit=None), key=lambda doc: doc['_id'])
+    
+    def test_roundtrip(self):
+        """ Test exporting with worker processes and importing back. """
+        manifest = snapshot.export_bucket(self.source, 'b', self.path, chunk_size=300, max_workers=2)
+        self.assertEqual(1000, manifest['count'])
+        self.assertEqual([300, 300, 300, 100], [member['count'] for member in manifest['members']])
+        with gzip.open(self.path, 'rt', encoding='utf-8') as handle:
+            lines = [json.loads(line) for line in handle]
+        self.assertEqual(self.documents(self.source), lines, 'Must be one readable gzip stream')
+        
+        target = SQLiteServer()
+        self.assertEqual(1000, snapshot.import_bucket(target, 'b', self.path, max_workers=2))
+        self.assertEqual(self.documents(self.source), self.documents(target))
+        
+        manifest = snapshot.export_bucket(self.source, 'b', self.path, {'n': {'$lt': 10}}, chunk_size=4, max_workers=0)
+        self.assertEqual(10, manifest['count'])
+        os.remove(self.path + '.manifest.json')
+        target = MemoryServer()
+        self.assertEqual(10, snapshot.import_bucket(target, 'b', self.path, max_workers=0, validate=Strict, chunk_size=3))
+        self.assertEqual(self.documents(self.source)[:10], self.documents(target))
+        
+        at = datetime.datetime(2024, 1, 1, 12, 30, tzinfo=datetime.timezone.utc)
+        self.source.store_document('typed', {'_id': 't', 'at': at, 'nested': [{'on': datetime.datetime(2024, 1, 1)}]})
+        snapshot.export_bucket(self.source, 'typed', self.path, max_workers=0, resume=False)
+        target = MemoryServer()
+        snapshot.import_bucket(target, 'typed', self.path, max_workers=0, resume=False)
+        self.assertEqual(self.source.load_document('typed', 't'), target.load_document('typed', 't'), 'Must restore datetimes as such')
+        self.source.store_document('typed', {'_id': 'u', 'data': b'raw'})
+        with self.assertRaises(TypeError):
+            snapshot.export_bucket(self.source, 'typed', self.path, max_workers=0, resume=False)
+    
+    def test_resume(self):
+        """ Test that interrupted exports and imports continue where they
+        stopped. """
+        def interrupt_after(chunks):
+            def on_chunk(progress):
+                on_chunk.calls += 1
+                if on_chunk.calls == chunks:
+                    raise Interrupt()
+            on_chunk.calls = 0
+            return on_chunk
+        
+        with self.assertRaises(Interrupt):
+            snapshot.export_bucket(self.source, 'b', self.path, chunk_size=150, max_workers=0, on_chunk=interrupt_after(3))
+        self.assertEqual(450, snapshot.read_manifest(self.path)['count'])
+        seen = []
+        manifest = snapshot.export_bucket(self.source, 'b', self.path, chunk_size=150, max_workers=0, on_chunk=lambda m: seen.append(m['count']))
+        self.assertEqual([600, 750, 900, 1000], seen, 'Must not export the first chunks again')
+        with gzip.open(self.path, 'rt', encoding='utf-8') as handle:
+            self.assertEqual(1000, sum(1 for line in handle))
+        
+        target = MemoryServer()
+        with self.assertRaises(Interrupt):
+            snapshot.import_bucket(target, 'b', self.path, max_workers=0, on_chunk=interrupt_after(2))
+        target.add_documents('b', [{'_id': '0300', 'n': 300}])
+        self.assertEqual(1000, snapshot.import_bucket(target, 'b', self.path, max_workers=0))
+        self.assertEqual(self.documents(self.source), self.documents(target))
+        self.assertFalse(os.path.exists(self.path + '.import.json'))
+        
+        self.source.store_document('b', {'_id': 'x', 'n': 'x'})
+        snapshot.export_bucket(self.source, 'b', self.path, max_workers=0, resume=False)
+        with self.assertRaises(Exception):
+            snapshot.import_bucket(MemoryServer(), 'b', self.path, max_workers=0, validate=Strict)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   A server keeping documents in an SQLite database, querying them with the
+#   JSON1 functions
+
+import json
+import sqlite3
+import itertools
+import threading
+
+if __package__:
+    from .jsonserver import JSONServer
+    from . import query
+    from . import idgen
+else:
+    from jsonserver import JSONServer
+    import query
+    import idgen
+
+
+class SQLiteServer(JSONServer):
+    """ A server keeping every bucket in an SQLite table of ``(id, json)``
+    rows, in a database file or in memory.
+    
+    `find()` translates query dictionaries to SQL on ``json_extract()``:
+    equality, ``$eq``, ``$ne``, ``$in``, ``$nin``, ``$gt``, ``$gte``,
+    ``$lt``, ``$lte`` and ``$exists`` on nested key paths as well as
+    ``$and``, ``$or`` and ``$nor``. Conditions it can't translate, like
+    those on whole objects or arrays, are evaluated on the loaded documents.
+    
+    Conditions also match array elements, like MongoDB does. Declare
+    expression indexes on hot key paths with `create_index()`, which indexes
+    the value and the array length found there so SQLite can use the
+    indexes for both. Sorting is done by SQLite, which orders arrays by
+    their JSON text rather than by their elements.
+    
+    Each write happens in one transaction. One connection is shared by all
+    threads, calls are serialized.
+    
+    Ids are ULIDs, which increase over time, so inserts append to the
+    primary key's B-tree instead of splitting pages all over it.
+    """
+    
+    id_generator = idgen.ulid
+    
+    def __init__(self, path=':memory:', timeout=5.0):
+        """
+        :param str path: The database file, ":memory:" for a private
+            in-memory database
+        :param float timeout: Seconds to wait for other processes' locks
+        """
+        super().__init__()
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        if ':memory:' != path:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.tables = {}
+        self.indexed = {}
+    
+    def table(self, bucket=None):
+        """ Returns the quoted name of the given bucket's table, creating
+        it if needed.
+        """
+        if not bucket:
+            bucket = 'default'
+        table = self.tables.get(bucket)
+        if table is None:
+            with self.lock:
+                table = _identifier(bucket)
+                with self.connection:
+                    self.connection.execute('CREATE TABLE IF NOT EXISTS {} (id PRIMARY KEY, json TEXT NOT NULL)'.format(table))
+                self.indexes(bucket)
+                self.tables[bucket] = table
+        return table
+    
+    def indexes(self, bucket=None):
+        """ Returns the set of key paths of the bucket that have an index.
+        """
+        if not bucket:
+            bucket = 'default'
+        with self.lock:
+            if bucket not in self.indexed:
+                rows = self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (bucket,))
+                prefix = bucket + '.'
+                self.indexed[bucket] = set(name[len(prefix):] for name, in rows if name.startswith(prefix))
+            return self.indexed[bucket]
+    
+    def create_index(self, bucket, keypath, unique=False):
+        """ Declare an expression index on the given key path.
+        
+        :param str bucket: The bucket/collection name
+        :param str keypath: The dotted path to the indexed value
+        :param bool unique: Whether no two documents may have the same value
+        """
+        path = _path(keypath)
+        if path is None:
+            raise Exception('Can\'t index key path "{}", it has array positions'.format(keypath))
+        table = self.table(bucket)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('CREATE {}INDEX IF NOT EXISTS {} ON {} (json_extract(json, {}))'.format('UNIQUE ' if unique else '',
+                    _identifier('{}.{}'.format(bucket or 'default', keypath)), table, path))
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} (json_array_length(json, {}))'.format(
+                    _identifier('{}[].{}'.format(bucket or 'default', keypath)), table, path))
+            self.indexes(bucket).add(keypath)
+    
+    def close(self):
+        with self.lock:
+            self.connection.close()
+    
+    
+    # MARK: - Overrides
+    
+    def load_document(self, bucket, doc_id):
+        if not doc_id:
+            raise Exception('Need a doc_id to load a document')
+        table = self.table(bucket)
+        with self.lock:
+            row = self.connection.execute('SELECT json FROM {} WHERE id = ?'.format(table), (doc_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+    
+    def load_documents(self, bucket, doc_ids):
+        table = self.table(bucket)
+        doc_ids = list(doc_ids)
+        found = {}
+        with self.lock:
+            for i in range(0, len(doc_ids), 500):
+                chunk = doc_ids[i:i + 500]
+                sql = 'SELECT id, json FROM {} WHERE id IN ({})'.format(table, ','.join('?' * len(chunk)))
+                found.update(self.connection.execute(sql, chunk).fetchall())
+        return [json.loads(found[doc_id]) if doc_id in found else None for doc_id in doc_ids]
+    
+    def add_documents(self, bucket, documents):
+        """ Inserts all documents in one transaction with `executemany()`.
+        """
+        if isinstance(documents, dict):
+            documents = [documents]
+        for doc in documents:
+            if doc.get('_id') is None:
+                doc['_id'] = self.new_id()
+        table = self.table(bucket)
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.executemany('INSERT INTO {} (id, json) VALUES (?, ?)'.format(table), _rows(documents))
+            except sqlite3.IntegrityError as e:
+                raise Exception('Failed to add documents, an id already exists: {}'.format(e))
+        return [doc['_id'] for doc in documents]
+    
+    def store_document(self, bucket, document):
+        return self.store_documents(bucket, [document])[0]
+    
+    def store_documents(self, bucket, documents):
+        documents = [doc if doc.get('_id') is not None else dict(doc, _id=self.new_id()) for doc in documents]
+        table = self.table(bucket)
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.executemany('INSERT INTO {} (id, json) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET json = excluded.json'.format(table), _rows(documents))
+            except sqlite3.IntegrityError as e:
+                raise Exception('Failed to store documents: {}'.format(e))
+        return [doc['_id'] for doc in documents]
+    
+    def update_document(self, bucket, doc_id, values=None, unset=None):
+        """ Reads, updates and writes the document in one transaction. """
+        table = self.table(bucket)
+        with self.lock:
+            with self.connection:
+                row = self.connection.execute('SELECT json FROM {} WHERE id = ?'.format(table), (doc_id,)).fetchone()
+                if row is None:
+                    return False
+                doc = query.apply_update(json.loads(row[0]), values, unset)
+                self.connection.execute('UPDATE {} SET json = ? WHERE id = ?'.format(table), (_dumps(doc), doc_id))
+                return True
+    
+    def remove_document(self, bucket, doc_id):
+        if not doc_id:
+            raise Exception('Need a doc_id to remove a document')
+        table = self.table(bucket)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM {} WHERE id = ?'.format(table), (doc_id,))
+    
+    def find(self, bucket, dictionary, skip=0, limit=50, sort=None, descending=False, fields=None):
+        return list(self._find(bucket, dictionary, skip, limit, sort, descending, fields))
+    
+    def find_batches(self, bucket, dictionary, batch_size=100, sort=None, descending=False, skip=0, limit=None, fields=None):
+        """ Runs the query once and reads and decodes documents one batch
+        at a time. """
+        found = self._find(bucket, dictionary, skip, limit, sort, descending, fields, batch_size)
+        while True:
+            batch = []
+            for doc in found:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    break
+            if len(batch) > 0:
+                yield batch
+            if len(batch) < batch_size:
+                break
+    
+    def count(self, bucket, dictionary):
+        table = self.table(bucket)
+        where, params, residual = _Translator().where(dictionary)
+        if 0 == len(residual):
+            with self.lock:
+                return self.connection.execute('SELECT COUNT(*) FROM {} AS d{}'.format(table, where), params).fetchone()[0]
+        return sum(1 for doc in self._find(bucket, dictionary, 0, None, None, False, None, 1000))
+    
+    
+    # MARK: - Internals
+    
+    def _find(self, bucket, dictionary, skip, limit, sort, descending, fields, batch_size=None):
+        """ Returns an iterator over the matching documents. Reads all
+        matching rows right away, or, if `batch_size` is given, the rowids
+        of all matching rows and then `batch_size` rows at a time, so writes
+        made while iterating can't move rows back into the results. Decodes
+        and filters documents as it goes.
+        """
+        table = self.table(bucket)
+        where, params, residual = _Translator().where(dictionary)
+        spec = query.sort_spec(sort, descending)
+        paths = [_path(keypath) for keypath, desc in spec]
+        sql = 'SELECT {} FROM {} AS d{}'.format('d.rowid' if batch_size else 'd.json', table, where)
+        if len(spec) > 0 and None not in paths:
+            sql += ' ORDER BY ' + ', '.join('json_extract(d.json, {}){}'.format(path, ' DESC' if desc else '') for path, (keypath, desc) in zip(paths, spec))
+        skip = skip or 0
+        in_sql = 0 == len(residual) and None not in paths
+        if in_sql and (limit or skip):
+            sql += ' LIMIT ? OFFSET ?'
+            params = params + [limit or -1, skip]
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        if batch_size:
+            rows = self._fetch(table, [row[0] for row in rows], batch_size)
+        
+        found = (json.loads(row[0]) for row in rows)
+        if not in_sql:
+            if len(residual) > 0:
+                found = (doc for doc in found if query.matches(doc, residual))
+            if None in paths:
+                found = iter(query.sort_documents(list(found), spec))
+            found = itertools.islice(found, skip, skip + limit if limit else None)
+        if fields is not None:
+            fields = query.projection_fields(fields)
+            found = (query.project(doc, fields) for doc in found)
+        return found
+    
+    def _fetch(self, table, rowids, batch_size):
+        """ Yields the rows with the given rowids, in order, reading
+        at most `batch_size` at a time and skipping rows removed in the
+        meantime. """
+        step = min(batch_size, 500)
+        for i in range(0, len(rowids), step):
+            chunk = rowids[i:i + step]
+            sql = 'SELECT rowid, json FROM {} WHERE rowid IN ({})'.format(table, ','.join('?' * len(chunk)))
+            with self.lock:
+                rows = dict(self.connection.execute(sql, chunk).fetchall())
+            for rowid in chunk:
+                if rowid in rows:
+                    yield (rows[rowid],)
+
+
+# MARK: - Query Translation
+
+class _Translator(object):
+    """ Turns a query dictionary into an SQL WHERE clause over the `json`
+    column of the table aliased as `d`, leaving the conditions it can't translate in a residual query.
+    """
+    
+    def where(self, dictionary):
+        """ Returns the WHERE clause, starting with a space if not empty, its
+        parameters and the residual query dictionary.
+        """
+        clauses = []
+        params = []
+        residual = {}
+        for key, cond in (dictionary or {}).items():
+            translated = self.clause(key, cond)
+            if translated is None:
+                residual[key] = cond
+            else:
+                clauses.append(translated[0])
+                params.extend(translated[1])
+        if 0 == len(clauses):
+            return '', params, residual
+        return ' WHERE ' + ' AND '.join(clauses), params, residual
+    
+    def query(self, dictionary):
+        """ Translates a whole query dictionary or returns None. """
+        if not isinstance(dictionary, dict):
+            return None
+        clauses = []
+        params = []
+        for key, cond in dictionary.items():
+            translated = self.clause(key, cond)
+            if translated is None:
+                return None
+            clauses.append(translated[0])
+            params.extend(translated[1])
+        return '(' + (' AND '.join(clauses) or '1') + ')', params
+    
+    def clause(self, key, cond):
+        if key in ('$and', '$or', '$nor'):
+            if not isinstance(cond, list) or 0 == len(cond):
+                return None
+            parts = [self.query(sub) for sub in cond]
+            if None in parts:
+                return None
+            params = [param for sql, sub_params in parts for param in sub_params]
+            if '$and' == key:
+                return '(' + ' AND '.join(sql for sql, p in parts) + ')', params
+            joined = '(' + ' OR '.join(sql for sql, p in parts) + ')'
+            return (joined if '$or' == key else 'NOT IFNULL({}, 0)'.format(joined)), params
+        if key.startswith('$'):
+            return None
+        path = _path(key)
+        if path is None:
+            return None
+        if not query.is_operator_condition(cond):
+            cond = {'$eq': cond}
+        
+        clauses = []
+        params = []
+        for op, arg in cond.items():
+            if '$exists' == op:
+                sql, sub_params = 'json_type(d.json, {}) IS {}NULL'.format(path, 'NOT ' if arg else ''), []
+            else:
+                positive = {'$ne': '$eq', '$nin': '$in'}.get(op, op)
+                element = _element(positive, arg)
+                if element is None:
+                    return None
+                sql, sub_params = self.on_path(path, element)
+                if positive != op:
+                    sql = 'NOT IFNULL({}, 0)'.format(sql)
+            clauses.append(sql)
+            params.extend(sub_params)
+        return '(' + ' AND '.join(clauses) + ')', params
+    
+    def on_path(self, path, element):
+        """ Applies an element condition to the value at the path and, if
+        it's an array, to its elements. Both sides of the OR can use the
+        indexes `create_index()` makes. """
+        template, params = element
+        direct = template.format(v='json_extract(d.json, {})'.format(path), t='json_type(d.json, {})'.format(path))
+        each = template.format(v='json_each.value', t='json_each.type')
+        sql = "({} OR (json_array_length(d.json, {}) > 0 AND EXISTS (SELECT 1 FROM json_each(d.json, {}) WHERE {})))".format(direct, path, path, each)
+        return sql, params + params
+
+
+def _element(op, arg):
+    """ A condition on a single value, as a template with `{v}` for the
+    value and `{t}` for its JSON type, and its parameters; None if it can't
+    be translated.
+    """
+    if '$eq' == op:
+        if arg is None:
+            return '{v} IS NULL', []
+        if isinstance(arg, bool):
+            return "{t} = '" + ('true' if arg else 'false') + "'", []
+        if isinstance(arg, (int, float, str)):
+            return "{v} IS ? AND {t} IN ('integer', 'real', 'text')", [arg]
+        return None
+    if '$in' == op:
+        if not isinstance(arg, (list, tuple)):
+            return None
+        plain = [a for a in arg if isinstance(a, (int, float, str)) and not isinstance(a, bool)]
+        parts = []
+        if len(plain) > 0:
+            parts.append("({v} IN (" + ', '.join('?' * len(plain)) + ") AND {t} IN ('integer', 'real', 'text'))")
+        for a in arg:
+            if a is None or isinstance(a, bool):
+                parts.append(_element('$eq', a)[0])
+            elif not isinstance(a, (int, float, str)):
+                return None
+        if 0 == len(parts):
+            return '0', []
+        return '(' + ' OR '.join(parts) + ')', plain
+    if op in _comparisons:
+        if isinstance(arg, bool) or arg is None:
+            return None
+        if isinstance(arg, (int, float)):
+            return "{v} " + _comparisons[op] + " ? AND {t} IN ('integer', 'real')", [arg]
+        if isinstance(arg, str):
+            return "{v} " + _comparisons[op] + " ? AND {t} = 'text'", [arg]
+    return None
+
+_comparisons = {
+    '$gt': '>',
+    '$gte': '>=',
+    '$lt': '<',
+    '$lte': '<=',
+}
+
+
+def _path(keypath):
+    """ The SQL string literal of the JSON path for a key path, None if it
+    has parts that could be array positions. """
+    keys = keypath.split('.')
+    if any(key.isdigit() for key in keys):
+        return None
+    path = '$' + ''.join('."{}"'.format(key.replace('\\', '\\\\').replace('"', '\\"')) for key in keys)
+    return "'" + path.replace("'", "''") + "'"
+
+def _identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _dumps(document):
+    return json.dumps(document, ensure_ascii=False, separators=(',', ':'))
+
+def _rows(documents):
+    return [(doc['_id'], _dumps(doc)) for doc in documents]
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest sqliteserver_test.py
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+if __package__:
+    from .memoryserver import MemoryServer
+    from .sqliteserver import SQLiteServer, _Translator
+else:
+    from memoryserver import MemoryServer
+    from sqliteserver import SQLiteServer, _Translator
+
+
+class TestSQLiteServer(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = SQLiteServer()
+        self.reference = MemoryServer()
+        docs = [
+            {'_id': '1', 'name': 'alice', 'age': 31, 'tags': ['a', 'b'], 'address': {'city': 'Bern'}, 'admin': True},
+            {'_id': '2', 'name': 'bob', 'age': 25, 'tags': ['b'], 'admin': False},
+            {'_id': '3', 'name': 'carol', 'age': 42.5, 'address': {'city': 'Basel'}, 'nick': None},
+            {'_id': '4', 'name': 'dave', 'age': '42', 'tags': [], 'address': {'city': 'Bern', 'zip': [3000, 3001]}},
+        ]
+        self.server.add_documents('b', [dict(d) for d in docs])
+        self.reference.add_documents('b', [dict(d) for d in docs])
+    
+    def tearDown(self):
+        self.server.close()
+    
+    def check_queries(self):
+        queries = [
+            {'name': 'alice'},
+            {'tags': 'b'},
+            {'tags': {'$in': ['a', 'x']}},
+            {'tags': {'$nin': ['a']}},
+            {'age': {'$gt': 30}},
+            {'age': {'$gte': 25, '$lt': 42.5}},
+            {'age': '42'},
+            {'age': {'$gt': '4'}},
+            {'address.city': 'Bern'},
+            {'address.city': {'$ne': 'Bern'}},
+            {'address.zip': 3001},
+            {'address': None},
+            {'nick': None},
+            {'nick': {'$exists': True}},
+            {'admin': True},
+            {'admin': {'$in': [False, None]}},
+            {'$or': [{'name': 'bob'}, {'address.city': 'Basel'}]},
+            {'$nor': [{'age': {'$lt': 30}}, {'tags': 'a'}]},
+            {'address': {'city': 'Basel'}},
+            {'tags.0': 'a'},
+        ]
+        for dictionary in queries:
+            expected = sorted(d['_id'] for d in self.reference.find('b', dictionary, limit=None))
+            self.assertEqual(expected, sorted(d['_id'] for d in self.server.find('b', dictionary, limit=None)), 'Query {}'.format(dictionary))
+            self.assertEqual(len(expected), self.server.count('b', dictionary))
+        self.assertEqual(['2', '1', '3'], [d['_id'] for d in self.server.find('b', {'age': {'$gt': 0}}, sort='age')])
+        self.assertEqual(['3', '2'], [d['_id'] for d in self.server.find('b', {'name': {'$ne': 'dave'}}, 1, 2, [('address.city', -1), ('_id', 1)])])
+        self.assertEqual(['3'], [d['_id'] for d in self.server.find('b', {'address': {'city': 'Basel'}}, 0, 1, 'name')])
+    
+    def test_crud(self):
+        """ Test storing, loading, updating and removing documents. """
+        self.assertEqual('alice', self.server.load_document('b', '1')['name'])
+        self.assertIsNone(self.server.load_document('b', 'x'))
+        self.assertEqual(['3', None, '1'], [d['_id'] if d else None for d in self.server.load_documents('b', ['3', 'x', '1'])])
+        with self.assertRaises(Exception, msg="Must not add a document with an existing id"):
+            self.server.add_documents('b', [{'_id': '9'}, {'_id': '1'}])
+        self.assertIsNone(self.server.load_document('b', '9'), 'Must add all documents or none')
+        self.server.update_document('b', '1', {'address.zip': 3000}, ['tags'])
+        self.assertEqual({'_id': '1', 'name': 'alice', 'age': 31, 'address': {'city': 'Bern', 'zip': 3000}, 'admin': True}, self.server.load_document('b', '1'))
+        doc_id = self.server.store_document('b', {'name': 'eve'})
+        self.assertEqual('eve', self.server.load_document('b', doc_id)['name'])
+        self.server.remove_document('b', doc_id)
+        self.assertIsNone(self.server.load_document('b', doc_id))
+        self.assertEqual([{'_id': '2', 'name': 'bob'}], self.server.find('b', {'age': 25}, fields=['name']))
+    
+    def test_find(self):
+        """ Test that queries match those of MemoryServer. """
+        self.check_queries()
+    
+    def test_find_indexed(self):
+        """ Test finding with expression indexes, which SQLite must use. """
+        for keypath in ['name', 'age', 'address.city', 'tags']:
+            self.server.create_index('b', keypath)
+        self.check_queries()
+        for dictionary in [{'age': {'$gt': 30}}, {'name': {'$in': ['bob', 'carol']}}, {'address.city': 'Bern'}, {'tags': 'b'}]:
+            where, params, residual = _Translator().where(dictionary)
+            plan = self.server.connection.execute('EXPLAIN QUERY PLAN SELECT d.json FROM "b" AS d' + where, params).fetchall()
+            self.assertIn('USING INDEX', str(plan), 'Must use the index for {}'.format(dictionary))
+    
+    def test_find_batches(self):
+        """ Test walking results while writing to them, and that residual
+        conditions are evaluated as batches are read. """
+        self.server.create_index('r', 'n')
+        self.server.add_documents('r', [{'_id': str(i), 'n': i} for i in range(100)])
+        found = []
+        for batch in self.server.find_batches('r', {'n': {'$gte': 0}}, 7, 'n'):
+            found.extend(doc['_id'] for doc in batch)
+            for doc in batch:
+                self.server.update_document('r', doc['_id'], {'n': doc['n'] + 1000})
+        self.assertEqual([str(i) for i in range(100)], found, 'Must not see rows moved by writes again')
+        
+        with mock.patch.object(json, 'loads', wraps=json.loads) as loads:
+            batches = self.server.find_batches('r', {'n': {'$gte': 1000}, 'x.0': None}, 10, skip=5)
+            self.assertEqual([str(i) for i in range(5, 15)], [doc['_id'] for doc in next(batches)])
+            self.assertLessEqual(loads.call_count, 20, 'Must not decode all documents before the first batch')
+    
+    def test_file(self):
+        """ Test that a database file keeps documents and indexes. """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'db.sqlite')
+            server = SQLiteServer(path)
+            server.create_index('b', 'n', unique=True)
+            server.add_documents('b', [{'_id': str(i), 'n': i} for i in range(100)])
+            server.close()
+            server = SQLiteServer(path)
+            self.assertEqual({'n'}, server.indexes('b'))
+            self.assertEqual(list(range(10, 20)), [d['n'] for d in server.find('b', {'n': {'$gte': 10}}, sort='n', limit=10)])
+            batches = list(server.find_batches('b', {}, 30, 'n', True, 5, 50))
+            self.assertEqual([30, 20], [len(batch) for batch in batches])
+            self.assertEqual(94, batches[0][0]['n'])
+            with self.assertRaises(Exception, msg='Must enforce unique indexes'):
+                server.store_document('b', {'_id': 'x', 'n': 1})
+            server.close()
+        finally:
+            shutil.rmtree(directory)
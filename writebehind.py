@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#   Batching writes to a JSONServer in a background thread
+
+import time
+import atexit
+import logging
+import threading
+import concurrent.futures
+
+if __package__:
+    from .jsonserver import JSONServer
+else:
+    from jsonserver import JSONServer
+
+
+class WriteBehindQueue(object):
+    """ Queues writes to a server and performs them in batches on a
+    background thread, so callers don't wait for a round trip per document.
+    
+    Writes to the same document that are still waiting are coalesced, only
+    the latest version is sent. Queued documents are written once
+    `max_batch` of them are waiting, once the oldest has waited `max_delay`
+    seconds, when `flush()` is called and at interpreter exit. Inserts go
+    through the server's `add_documents()`, stores through
+    `store_documents()` and removals through `remove_document()`.
+    
+    Every call returns a `concurrent.futures.Future` that resolves to the
+    document id, or to the exception if writing failed. Failures are also
+    passed to `on_error`, if given, and logged otherwise.
+    
+    Loading a document that is still queued returns what the server has,
+    call `flush()` first when that matters.
+    """
+    
+    def __init__(self, server, max_batch=1000, max_delay=0.05, max_pending=100000, on_error=None):
+        """
+        :param JSONServer server: The server to write to
+        :param int max_batch: Write as soon as this many documents wait, and
+            at most this many per server call
+        :param float max_delay: Seconds after which a queued write is sent
+        :param int max_pending: Block callers while this many documents wait
+        :param on_error: Called with the exception, the bucket and the list of
+            documents (or ids, for removals) of every failed server call
+        """
+        if not isinstance(server, JSONServer):
+            raise Exception('Need a JSONServer instance but got {}'.format(server))
+        self.server = server
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self.pending = {}
+        self.since = None
+        self.enqueued = 0
+        self.written = 0
+        self.flushing = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+    
+    def store(self, bucket, document):
+        """ Queues storing the complete document, replacing an existing one.
+        
+        :param str bucket: The bucket/collection name
+        :param dict document: The document, which must not be modified
+            afterwards
+        :returns: A Future resolving to the document id
+        """
+        return self._enqueue(bucket, 'store', document)
+    
+    def insert(self, bucket, documents):
+        """ Queues adding one or more new documents. Documents without `_id`
+        get one assigned right away.
+        
+        :param str bucket: The bucket/collection name
+        :param documents: A document/dictionary or a list thereof
+        :returns: A Future resolving to the list of document ids
+        """
+        if isinstance(documents, dict):
+            documents = [documents]
+        futures = []
+        for document in documents:
+            if document.get('_id') is None:
+                document['_id'] = self.server.new_id()
+            futures.append(self._enqueue(bucket, 'add', document))
+        return _gather(futures)
+    
+    def remove(self, bucket, doc_id):
+        """ Queues removing the document, dropping queued writes of it.
+        
+        :returns: A Future resolving to the document id
+        """
+        return self._enqueue(bucket, 'remove', {'_id': doc_id})
+    
+    def flush(self, timeout=None):
+        """ Blocks until everything queued before the call has been written.
+        
+        :param float timeout: Seconds to wait at most
+        :returns: True if everything was written, False on timeout
+        """
+        with self.condition:
+            target = self.enqueued
+            self.flushing = True
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: self.written >= target, timeout)
+    
+    def close(self):
+        """ Writes all queued documents and stops the background thread.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        atexit.unregister(self.close)
+    
+    
+    # MARK: - Queue
+    
+    def _enqueue(self, bucket, op, document):
+        future = concurrent.futures.Future()
+        key = (bucket or None, str(document['_id']))
+        with self.condition:
+            if self.closed:
+                raise Exception('The write-behind queue has been closed')
+            if self.max_pending is not None:
+                self.condition.wait_for(lambda: len(self.pending) < self.max_pending or key in self.pending)
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [op, document, [future]]
+            else:
+                entry[0] = _coalesce(entry[0], op)
+                entry[1] = document
+                entry[2].append(future)
+            self.enqueued += 1
+            if self.since is None:
+                self.since = time.monotonic()
+                self.condition.notify_all()
+            elif len(self.pending) >= self.max_batch:
+                self.condition.notify_all()
+        return future
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self._due():
+                    timeout = None if self.since is None else self.since + self.max_delay - time.monotonic()
+                    self.condition.wait(timeout)
+                pending = self.pending
+                target = self.enqueued
+                self.pending = {}
+                self.since = None
+                self.flushing = False
+                self.condition.notify_all()
+            
+            self._write(pending)
+            with self.condition:
+                self.written = target
+                self.condition.notify_all()
+                if self.closed and 0 == len(self.pending):
+                    return
+    
+    def _due(self):
+        if self.closed or self.flushing:
+            return True
+        if len(self.pending) >= self.max_batch:
+            return True
+        return self.since is not None and time.monotonic() >= self.since + self.max_delay
+    
+    def _write(self, pending):
+        groups = {}
+        for (bucket, doc_id), (op, document, futures) in pending.items():
+            groups.setdefault((bucket, op), []).append((document, futures))
+        for (bucket, op), entries in groups.items():
+            for i in range(0, len(entries), self.max_batch):
+                batch = entries[i:i + self.max_batch]
+                documents = [document for document, futures in batch]
+                try:
+                    if 'add' == op:
+                        doc_ids = self.server.add_documents(bucket, documents)
+                    elif 'store' == op:
+                        doc_ids = self.server.store_documents(bucket, documents)
+                    else:
+                        doc_ids = []
+                        for document in documents:
+                            self.server.remove_document(bucket, document['_id'])
+                            doc_ids.append(document['_id'])
+                except Exception as e:
+                    self._failed(e, bucket, op, batch)
+                    continue
+                for (document, futures), doc_id in zip(batch, doc_ids or [d['_id'] for d in documents]):
+                    for future in futures:
+                        future.set_result(doc_id)
+    
+    def _failed(self, exception, bucket, op, batch):
+        documents = [document['_id'] if 'remove' == op else document for document, futures in batch]
+        if self.on_error is not None:
+            try:
+                self.on_error(exception, bucket, documents)
+            except Exception as e:
+                logging.error("Write-behind error handler failed: {}".format(e))
+        else:
+            logging.error("Failed to write {} document(s) to bucket \"{}\": {}".format(len(batch), bucket, exception))
+        for document, futures in batch:
+            for future in futures:
+                future.set_exception(exception)
+
+
+def _coalesce(queued, op):
+    """ The operation to perform for a document that was queued for `queued`
+    when `op` is queued for it. """
+    if 'remove' == op:
+        return 'remove'
+    if 'add' == queued:
+        return 'add'
+    return 'store'
+
+def _gather(futures):
+    """ Returns a Future resolving to the list of results of all given
+    futures, or to the first exception.
+    """
+    combined = concurrent.futures.Future()
+    lock = threading.Lock()
+    remaining = [len(futures)]
+    def done(future):
+        with lock:
+            if combined.done():
+                return
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+                return
+            remaining[0] -= 1
+            if 0 == remaining[0]:
+                combined.set_result([f.result() for f in futures])
+    if 0 == len(futures):
+        combined.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#  Run with:
+#      python3 -m unittest writebehind_test.py
+
+import unittest
+if __package__:
+    from .jsondocument import JSONDocument
+    from .memoryserver import MemoryServer
+    from .writebehind import WriteBehindQueue
+else:
+    from jsondocument import JSONDocument
+    from memoryserver import MemoryServer
+    from writebehind import WriteBehindQueue
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+    
+    def test_coalesce(self):
+        """ Test that repeated writes of one document are sent once. """
+        server = BatchRecordingServer()
+        queue = WriteBehindQueue(server, max_delay=60)
+        futures = [queue.store('b', {'_id': '1', 'n': n}) for n in range(100)]
+        queue.insert('b', [{'_id': '2'}, {'_id': '3'}])
+        queue.store('b', {'_id': '2', 'n': 1})
+        queue.store('b', {'_id': '4'})
+        queue.remove('b', '4')
+        self.assertTrue(queue.flush(5))
+        self.assertEqual({'_id': '1', 'n': 99}, server.load_document('b', '1'))
+        self.assertEqual({'_id': '2', 'n': 1}, server.load_document('b', '2'), 'Must add the latest version')
+        self.assertIsNone(server.load_document('b', '4'))
+        self.assertEqual([['1']], server.stored)
+        self.assertEqual([['2', '3']], server.added)
+        self.assertEqual(['1'] * 100, [f.result(0) for f in futures])
+        queue.close()
+    
+    def test_thresholds(self):
+        """ Test writing once enough documents wait or waited long enough. """
+        server = BatchRecordingServer()
+        queue = WriteBehindQueue(server, max_batch=10, max_delay=60)
+        futures = [queue.store('b', {'_id': str(n)}) for n in range(10)]
+        self.assertEqual('9', futures[-1].result(5), 'Must write once `max_batch` documents wait')
+        queue.close()
+        
+        queue = WriteBehindQueue(server, max_delay=0.01)
+        self.assertEqual('x', queue.store('b', {'_id': 'x'}).result(5), 'Must write after `max_delay`')
+        queue.close()
+    
+    def test_failure(self):
+        """ Test reporting failed writes. """
+        errors = []
+        queue = WriteBehindQueue(MemoryServer(), on_error=lambda e, bucket, docs: errors.append((bucket, docs)))
+        queue.insert('b', {'_id': '1'}).result(5)
+        future = queue.insert('b', {'_id': '1'})
+        with self.assertRaises(Exception):
+            future.result(5)
+        self.assertEqual([('b', [{'_id': '1'}])], errors)
+        queue.close()
+        with self.assertRaises(Exception, msg="Must not queue writes once closed"):
+            queue.store('b', {'_id': '2'})
+    
+    def test_document(self):
+        """ Test queueing writes of JSONDocument instances. """
+        server = MemoryServer()
+        class Queued(JSONDocument):
+            pass
+        Queued.hookup(server, 'b')
+        Queued.write_behind = WriteBehindQueue(server, max_delay=60)
+        doc = Queued('1', json={'a': 1})
+        future = doc.store()
+        doc.a = 2
+        doc.store()
+        self.assertEqual([], doc.changes)
+        Queued.insert({'_id': '2'})
+        single = Queued(None, json={'n': 3})
+        first = Queued.insert(single)
+        embedded = Queued.from_embedded({'n': 4})
+        second = Queued.insert([Queued('5'), embedded])
+        self.assertIsNotNone(embedded.id, 'Must write assigned ids back onto instances')
+        Queued.write_behind.flush()
+        self.assertEqual([single.id], first.result(0))
+        self.assertEqual(['5', embedded.id], second.result(0))
+        self.assertEqual('1', future.result(0))
+        self.assertEqual({'_id': '1', 'a': 2}, server.load_document('b', '1'))
+        self.assertIsNotNone(server.load_document('b', '2'))
+        self.assertEqual({'_id': embedded.id, 'n': 4}, server.load_document('b', embedded.id))
+        future = doc.remove()
+        Queued.write_behind.flush()
+        self.assertEqual('1', future.result(0))
+        self.assertIsNone(server.load_document('b', '1'))
+        Queued.write_behind.close()
+
+
+class BatchRecordingServer(MemoryServer):
+    """ Records the ids of each batch written. """
+    
+    def __init__(self):
+        super().__init__()
+        self.added = []
+        self.stored = []
+    
+    def add_documents(self, bucket, documents):
+        self.added.append([d['_id'] for d in documents])
+        return super().add_documents(bucket, documents)
+    
+    def store_documents(self, bucket, documents):
+        self.stored.append([d['_id'] for d in documents])
+        return super().store_documents(bucket, documents)